@@ -1,52 +1,80 @@
 import os
-from openai import OpenAI
+import concurrent.futures
+import functools
+import contextvars
+import subprocess
+import time
 import json
-import requests
-from io import BytesIO
+import math
 from dotenv import load_dotenv
-from PIL import Image
-import replicate
-from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
-import utils.download_from_url as download
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.gallery as gallery
+import utils.hls as hls
+import utils.pipeline as pipeline
+import utils.prompt_pool as prompt_pool
+import utils.asset_cache as asset_cache
+import utils.providers as providers
+import utils.rate_limit as rate_limit
+import utils.segments as segments
+import utils.timing as timing
+import utils.tracing as tracing
+import utils.jobs as jobs
+import utils.media_server as media_server
+import utils.job_queue as job_queue
 from pathlib import Path
 import streamlit as st
 
 
 # Load environment variables from .env file
 load_dotenv()
-client = OpenAI(
-        # This is the default and can be omitted
-        api_key=st.secrets["OPENAI_API_KEY"],
-    )
+
+# Number of background worker processes started by the app. Set it to 0 when
+# workers run separately, e.g. `python -m utils.job_queue --workers 4`.
+NUM_WORKERS = int(os.environ.get("XFICTION_WORKERS", 2))
+# Player of the HLS ladders written by utils/hls.py. Safari plays HLS natively,
+# other browsers through hls.js, and the MP4 fallback covers the rest.
+HLS_PLAYER = """
+<video id="player" controls playsinline preload="metadata" style="width: 100%; max-height: {height}px; background: black"></video>
+<script src="https://cdn.jsdelivr.net/npm/hls.js@1.5.15/dist/hls.min.js"></script>
+<script>
+  const video = document.getElementById("player");
+  const master = {master}, fallback = {fallback};
+  if (video.canPlayType("application/vnd.apple.mpegurl")) {{
+    video.src = master;
+  }} else if (window.Hls && Hls.isSupported()) {{
+    const hls = new Hls();
+    hls.loadSource(master);
+    hls.attachMedia(video);
+  }} else {{
+    video.src = fallback;
+  }}
+</script>
+"""
+# Seconds between two progress polls of a running job
+JOB_POLL_INTERVAL = 2
+
+@functools.lru_cache(maxsize=None)
+def example_system_prompt():
+    """Read the system prompt of the example prompts once per process."""
+    with open("systemprompt_gen_examples.txt", "r") as f:
+        return f.read()
 
 def generate_example_prompt():
     """
-    Generate an example prompt from the OpenAI API.
-    :param api_key: OpenAI API key.
+    Generate an example prompt with the configured LLM provider.
     :return: JSON formatted three example prompts
     """
-    # get system prompt from txt file
-    systemprompt = open("systemprompt_gen_examples.txt", "r")
-    systemprompt = systemprompt.read()
+    systemprompt = example_system_prompt()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-1106-preview",
-            messages=[
-                {
-                    "role": "system",
-                    "content": systemprompt
-                },
-                {
-                    "role": "user",
-                    "content": "Generate three very short example prompts for the Dreammachine"
-                }
-            ],
-            response_format={ "type": "json_object" },
-            temperature=1.0,
-
-        )
-        
-        return response.choices[0].message.content
+        provider = providers.get_provider("llm")
+        with tracing.span("llm.example_prompts"):
+            return rate_limit.get_limiter(provider.name, provider.model).call(
+                provider.complete_json,
+                systemprompt,
+                "Generate three very short example prompts for the Dreammachine",
+                temperature=1.0,
+            )
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -56,236 +84,348 @@ def generate_story(story_prompt):
     """
     Generate a story with title, voiceover, and image prompts in JSON format.
 
-    :param api_key: OpenAI API key.
     :param story_prompt: The initial prompt for the story.
     :return: JSON formatted story with title, voiceover, and image prompts.
     """
-
-
-    
     # get system prompt from txt file
     systemprompt = open("systemprompt.txt", "r")
     systemprompt = systemprompt.read()
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-1106-preview",
-            messages=[
-                {
-                    "role": "system",
-                    "content": systemprompt
-                },
-                {
-                    "role": "user",
-                    "content": story_prompt
-                }
-            ],
-            response_format={ "type": "json_object" },
-        )
-        
-        return response.choices[0].message.content
+        provider = providers.get_provider("llm")
+        with tracing.span("llm.story", provider=provider.name):
+            return rate_limit.get_limiter(provider.name, provider.model).call(provider.complete_json, systemprompt, story_prompt)
 
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
-def generate_voiceover(voiceover_text):
+
+def stream_story(story_prompt):
     """
-    Generate a voiceover from text using the OpenAI API.
+    Generate a story like generate_story, yielding the JSON text as it streams in.
+
+    :param story_prompt: The initial prompt for the story.
+    :return: Generator of pieces of the JSON formatted story.
     """
+    # get system prompt from txt file
+    with open("systemprompt.txt", "r") as systemprompt:
+        systemprompt = systemprompt.read()
+
+    provider = providers.get_provider("llm")
+    # The slot is held until the whole response has been streamed
+    with rate_limit.get_limiter(provider.name, provider.model).slot():
+        yield from provider.stream_json(systemprompt, story_prompt)
+
+@tracing.traced("tts")
+def generate_voiceover(voiceover_text, model="tts-1-hd", voice="onyx"):
+    """
+    Generate a voiceover from text with the configured TTS provider.
+    """
+    provider = providers.get_provider("tts")
+    key = asset_cache.cache_key("voiceover", provider=provider.name, model=model, voice=voice, input=voiceover_text)
+    cached_path = asset_cache.default_cache.lookup(key)
+    tracing.set_attributes(cache_hit=bool(cached_path))
+    if cached_path:
+        return cached_path
+
     # make sure the directory exists
     os.makedirs("media/voiceover", exist_ok=True)
-    speech_file_path = Path(__file__).parent / f"media/voiceover/speech_{voiceover_text[:25]}.mp3"
-    response = client.audio.speech.create(
-    model="tts-1-hd",
-    voice="onyx",
-    input=voiceover_text
-    )
-
-    response.stream_to_file(speech_file_path)
+    speech_file_path = Path(__file__).parent / f"media/voiceover/speech_{key}.mp3"
+    with tracing.span("provider.tts", provider=provider.name, characters=len(voiceover_text)):
+        rate_limit.get_limiter(provider.name, model).call(provider.synthesize, voiceover_text, speech_file_path, model=model, voice=voice)
     path_str = str(speech_file_path)
-    return path_str
+    return asset_cache.default_cache.store(key, path_str)
 
+@tracing.traced("image")
 def get_image_from_DALL_E_3_API(user_prompt, image_dimension="1024x1792", image_quality="standard", model="dall-e-3", nb_final_image=1, style="vivid"):
-    response = client.images.generate(
-        model=model,
-        prompt=user_prompt,
-        size=image_dimension,
-        quality=image_quality,
-        n=nb_final_image,
-        style=style,
-    )
+    """
+    Generate an image for a prompt with the configured image provider.
+
+    All nb_final_image candidates are generated and cached, so they can be
+    listed later with get_images_from_DALL_E_3_API without another request.
 
-    image_url = response.data[0].url
+    :return: Path to the first candidate, or None if it failed.
+    """
+    candidates = get_images_from_DALL_E_3_API([user_prompt], nb_final_image, image_dimension, image_quality, model, style)
+    return candidates[0][0] if candidates[0] else None
 
-    # Download the image from the URL
-    response = requests.get(image_url)
-    if response.status_code == 200:
-        # Open the image and save it to a file
-        image = Image.open(BytesIO(response.content))
-        file_path = f"media/images/img_{user_prompt[:50]}.png"  # Limiting prompt length to avoid too long file names
-        os.makedirs("media/images", exist_ok=True)
-        image.save(file_path)
-        return file_path
+@tracing.traced("image.batch")
+def get_images_from_DALL_E_3_API(user_prompts, nb_candidates=1, image_dimension="1024x1792", image_quality="standard", model="dall-e-3", style="vivid"):
+    """
+    Generate candidate images for several prompts at once.
 
-    return None
+    Prompts and candidates are requested in parallel, with as many candidates
+    per request as the model allows (see providers.MULTI_IMAGE_MODELS), so the
+    latency of a story's images does not grow with its number of clips.
 
-def get_video_from_Replicate_API(image_path, video_length="25_frames_with_svd_xt"):
+    :param user_prompts: Image prompts, e.g. one per clip.
+    :param nb_candidates: Number of images to generate per prompt.
+    :return: Dict mapping each prompt's index to the paths of its candidates, in prompt
+        and candidate order. Candidates that failed are left out.
+    """
+    provider = providers.get_provider("image")
+    os.makedirs("media/images", exist_ok=True)
+    candidates = {index: [None] * nb_candidates for index in range(len(user_prompts))}
+    requests = []
+    cache_hits = 0
+
+    for index, user_prompt in enumerate(user_prompts):
+        missing = []
+        for candidate in range(nb_candidates):
+            # The first candidate keeps the key of a single image request
+            extra = {"candidate": candidate} if candidate else {}
+            key = asset_cache.cache_key("image", provider=provider.name, model=model, prompt=user_prompt, size=image_dimension, quality=image_quality, style=style, **extra)
+            cached_path = asset_cache.default_cache.lookup(key)
+            if cached_path:
+                candidates[index][candidate] = cached_path
+                cache_hits += 1
+            else:
+                missing.append((candidate, key))
+
+        batch_size = providers.max_images_per_request(model)
+        for start in range(0, len(missing), batch_size):
+            requests.append((index, user_prompt, missing[start:start + batch_size]))
+
+    tracing.set_attributes(prompts=len(user_prompts), candidates=nb_candidates, cache_hits=cache_hits, requests=len(requests))
+
+    def request_images(index, user_prompt, batch):
+        # Save the images to files named after the request hash
+        file_paths = [f"media/images/img_{key}.png" for _, key in batch]
+        try:
+            with tracing.span("provider.image", provider=provider.name, size=image_dimension, n=len(batch)) as image_span:
+                rate_limit.get_limiter(provider.name, model).call(provider.generate_batch, user_prompt, file_paths, size=image_dimension, quality=image_quality, style=style, model=model)
+                image_span.set(bytes=sum(os.path.getsize(file_path) for file_path in file_paths))
+        except providers.ProviderError as e:
+            print(f"An error occurred: {e}")
+            return
+        for (candidate, key), file_path in zip(batch, file_paths):
+            candidates[index][candidate] = asset_cache.default_cache.store(key, file_path)
+
+    if len(requests) == 1:
+        # A single request, e.g. a clip's image from the pipeline, which already
+        # runs on a provider thread, needs no threads of its own
+        request_images(*requests[0])
+    elif requests:
+        # The rate limiter decides how many of these actually run at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(requests)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, request_images, *request) for request in requests]
+            for future in futures:
+                future.result()
+
+    return {index: [path for path in paths if path] for index, paths in candidates.items()}
+
+@tracing.traced("video")
+async def get_video_from_Replicate_API(image_path, video_length="25_frames_with_svd_xt"):
     """
-    Generate a video from an image using the Replicate API.
+    Generate a video from an image with the configured video provider.
+
+    A coroutine, so a clip waiting for its prediction holds no thread, see
+    utils/predictions.py.
 
     :param image_path: Path to the image to use as input.
     :param video_length: Length of the video to generate.
     :return: Path to the generated video.
     """
-    url = replicate.run(
-        "stability-ai/stable-video-diffusion:3f0457e4619daac51203dedb472816fd4af51f3149fa7a9e0b5ffcf1b8172438",
-        input={"input_image": open(image_path, "rb"), "video_length": video_length}
-    )
-    # download the video from the URL
-    file_path = f"media/clips/clip_{image_path[17:-4]}.mp4"
+    provider = providers.get_provider("video")
+    # Key on the image content rather than its path, so a regenerated image
+    # never reuses the clip of the previous one
+    key = asset_cache.cache_key("clip", provider=provider.name, model=provider.model, image=asset_cache.file_digest(image_path), video_length=video_length)
+    cached_path = asset_cache.default_cache.lookup(key)
+    tracing.set_attributes(cache_hit=bool(cached_path))
+    if cached_path:
+        return cached_path
+
+    file_path = f"media/clips/clip_{key}.mp4"
     os.makedirs("media/clips", exist_ok=True)
-    download.download_video_from_url(url, file_path)
-    
-    return file_path
+    try:
+        with tracing.span("provider.video", provider=provider.name, video_length=video_length) as video_span:
+            await rate_limit.get_limiter(provider.name, provider.model).async_call(provider.generate_async, image_path, file_path, video_length=video_length)
+            video_span.set(bytes=os.path.getsize(file_path))
+    except providers.ProviderError as e:
+        print(f"An error occurred: {e}")
+        return None
+
+    return asset_cache.default_cache.store(key, file_path)
 
-def combine_videos_and_audio(video_paths, audio_path, output_path):
+@tracing.traced("assembly")
+def combine_videos_and_audio(video_paths, audio_path, output_path, profile=None):
     """
     Combine multiple videos into one and add an audio track using MoviePy.
 
     :param video_paths: A list of paths to the video files.
     :param audio_path: Path to the audio file.
     :param output_path: Path where the output video will be saved.
+    :param profile: Encode profile name from utils/encode_profiles.py, defaults to XFICTION_ENCODE_PROFILE.
     """
-    # Load all the video clips
-    video_clips = [VideoFileClip(path) for path in video_paths]
-
-    # Concatenate the video clips
-    final_clip = concatenate_videoclips(video_clips)
-
-    # Load the audio file
-    audio_clip = AudioFileClip(audio_path)
-
-    # Set the audio of the concatenated clip as the audio clip
-    final_clip = final_clip.set_audio(audio_clip)
+    profile = encode_profiles.get_profile(profile)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    # Stretch the clips to the voiceover, planned from the container headers
+    plan = timing.plan_timing(video_paths, audio_path)
+    tracing.set_attributes(video_duration=plan["duration"], audio_duration=plan["audio_duration"], aligned=plan["aligned"])
+
+    # SVD clips normally share codec, resolution and fps, so they can be joined
+    # without decoding, even when their playback speed changes. Holding frames
+    # needs an encode, and MoviePy stays as the last fallback.
+    if not plan["padded"] and ffmpeg_tools.can_stream_copy(video_paths):
+        try:
+            with tracing.span("assembly.stream_copy", clips=len(video_paths), rate=plan["rate"]):
+                return ffmpeg_tools.concat_stream_copy(video_paths, audio_path, output_path, audio_bitrate=profile["audio_bitrate"], time_scale=1 / plan["rate"])
+        except subprocess.CalledProcessError as e:
+            print(f"Stream copy failed, re-encoding: {e.stderr}")
+
+    # Otherwise each clip is normalized once into a segment cached by its
+    # content, so a regenerated clip only costs its own encode
+    try:
+        return segments.assemble_segments(video_paths, audio_path, output_path, profile, plan)
+    except subprocess.CalledProcessError as e:
+        print(f"Segment assembly failed, re-encoding with MoviePy: {e.stderr}")
 
-    os.makedirs("media/videos", exist_ok=True)
+    # MoviePy is slow to import and only needed here, see utils/benchmark.py --imports
+    from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
 
-    # Write the result to the output file
-    final_clip.write_videofile(output_path, codec='libx264', audio_codec='aac')
+    with tracing.span("assembly.moviepy", clips=len(video_paths), profile=profile["name"], threads=profile["threads"]) as encode_span:
+        # Load all the video clips
+        video_clips = [VideoFileClip(path) for path in video_paths]
 
-    # Close the clips
-    final_clip.close()
-    for clip in video_clips:
-        clip.close()
-    audio_clip.close()
+        # Concatenate the video clips
+        final_clip = concatenate_videoclips(video_clips)
 
-    return output_path
+        # Load the audio file
+        audio_clip = AudioFileClip(audio_path)
 
-def generate_video(story_prompt):
-    story_json = generate_story(story_prompt)
-    print(story_json)
-    story_json_dict = json.loads(story_json)
+        # Set the audio of the concatenated clip as the audio clip
+        final_clip = final_clip.set_audio(audio_clip)
 
-    title = story_json_dict["title"]
-    st.header(title)
-    col1, col2, col3 = st.columns(3)
-    video_logline = story_json_dict.get("video_logline", "")
-    col1.subheader("Video Logline")
-    col1.write(video_logline)
-    voiceover_text = story_json_dict["voiceover_text"]
-    col2.subheader("Voiceover Text")
-    col2.write(voiceover_text)
-    visual_style = story_json_dict.get("visual_style", "")
-    col3.subheader("Visual Style")
-    col3.write(visual_style)
-    character = story_json_dict.get("character", "")
-    st.subheader("Character")
-    st.write(character)
-
-    speech_path = generate_voiceover(voiceover_text)
-    display_generated_media('voiceover', lambda *args, **kwargs: speech_path, col2, col3)
-    
-    video_paths = []    
-    
-    # Assuming story_json_dict is already defined and contains your structured data
+        # Write the result to the output file
+        encode_span.set(encode_fps=encode_profiles.write_videofile(final_clip, output_path, profile))
 
+        # Close the clips
+        final_clip.close()
+        for clip in video_clips:
+            clip.close()
+        audio_clip.close()
 
+    return output_path
 
-    if "clips" in story_json_dict:
-        for i, (clip_key, clip_value) in enumerate(story_json_dict["clips"].items()):
-            image_prompt = clip_value.get("image_prompt", "")
-            character_visible = clip_value.get("character_visible", "False") == "True"
+def display_video(video_path, height=640):
+    """
+    Play a final video, from its HLS ladder when it has one.
 
-            # Prepend the character description if the character is visible
-            if character_visible and character:
-                image_prompt = f'{character}, {image_prompt}'
+    :param video_path: Path of the final MP4.
+    :param height: Maximum height of the player in pixels.
+    """
+    ladder = hls.find_ladder(video_path)
+    if not ladder or not media_server.serves(ladder["master"]):
+        st.video(media_server.media_url(video_path))
+        return
+    st.iframe(
+        HLS_PLAYER.format(
+            height=height,
+            master=json.dumps(media_server.media_url(ladder["master"])),
+            fallback=json.dumps(media_server.media_url(ladder["fallback"])),
+        ),
+        height=height + 10,
+    )
 
-            # Append the visual style to the image prompt
-            full_prompt = f'{image_prompt} + {visual_style}'
+def display_job_progress(job_id):
+    """
+    Show the progress and finished assets of a queued job.
 
-            # The rest of your code for generating and displaying images and videos
-            st.subheader(f"Clip {i+1}")
-            col1, col2, col3 = st.columns(3)
-            col1.subheader("Prompt:")
-            col1.write(f"{full_prompt}")
-
-            img_path = get_image_from_DALL_E_3_API(full_prompt)
-            display_generated_media(f'image_{i}', lambda *args, **kwargs: img_path, col2, col3)
-            
-            video_path = get_video_from_Replicate_API(img_path)
-            display_generated_media(f'video_{i}', lambda *args, **kwargs: video_path, col2, col3)
-            video_paths.append(video_path)
-
-    st.subheader("Final Video")
-
-    if video_paths:
-        output_video_path = f"media/videos/{title}.mp4"
-        combine_videos_and_audio(video_paths, speech_path, output_video_path)
-        print(f"Combined video and audio saved to {output_video_path}")
-        st.write(f"Combined video and audio saved to {output_video_path}")        
-        return output_video_path
-
-    else:
-        print("No videos were generated.")
-        st.write("No videos were generated.")
-
-
-
-def display_generated_media(key, generate_media_function, col_image, col_video, *args, **kwargs):
-    # Generate media if not already done or if regeneration is requested
-    if key not in st.session_state or st.session_state.get(f'regenerate_{key}', False):
-        st.session_state[key] = generate_media_function(*args, **kwargs)
-        st.session_state[f'regenerate_{key}'] = False
-
-    media_path = st.session_state[key]
-
-    # Display the generated media based on its file type
-    if media_path:
-        file_extension = os.path.splitext(media_path)[1].lower()
-        if file_extension in ['.jpg', '.jpeg', '.png']:
-            col_image.subheader("Generated Image:")
-            col_image.image(media_path)
-        elif file_extension == '.mp3':
+    :param job_id: Id returned by job_queue.enqueue.
+    :return: True while the job is still queued or running.
+    """
+    status = job_queue.get_status(job_id)
+    if status is None:
+        return False
+
+    st.subheader(f"Job {job_id}")
+    if status["status"] == "queued":
+        st.info(f"Waiting for a worker ({status['position']} jobs ahead).")
+    st.progress(status["progress"], text=status["message"] or status["status"])
+
+    job = jobs.load_job(job_id)
+    if job and job["story"]:
+        story_json_dict = job["story"]
+        st.header(story_json_dict["title"])
+        col1, col2, col3 = st.columns(3)
+        col1.subheader("Video Logline")
+        col1.write(story_json_dict.get("video_logline", ""))
+        col2.subheader("Voiceover Text")
+        col2.write(story_json_dict.get("voiceover_text", ""))
+        col3.subheader("Visual Style")
+        col3.write(story_json_dict.get("visual_style", ""))
+        st.subheader("Character")
+        st.write(story_json_dict.get("character", ""))
+
+        stages = jobs.completed_stages(job)
+        if 'voiceover' in stages:
             st.subheader("Generated Audio:")
-            st.audio(media_path)
-        elif file_extension == '.mp4':
-            col_video.subheader("Generated Video:")
-            col_video.video(media_path)
-
-def list_video_files(directory):
-    """List video files in the given directory."""
-    video_extensions = ['.mp4', '.avi', '.mov']  # Add more extensions as needed
-    return [file for file in os.listdir(directory) if os.path.splitext(file)[1] in video_extensions]
-
-def display_videos(video_files):
-    """Display videos in rows of 3."""
+            st.audio(media_server.media_url(stages['voiceover']))
+        for i, full_prompt in enumerate(pipeline.build_clip_prompts(story_json_dict)):
+            st.subheader(f"Clip {i+1}")
+            col_prompt, col_image, col_video = st.columns(3)
+            col_prompt.subheader("Prompt:")
+            col_prompt.write(full_prompt)
+            if f'image_{i}' in stages:
+                col_image.subheader("Generated Image:")
+                col_image.image(media_server.media_url(stages[f'image_{i}']))
+            if f'video_{i}' in stages:
+                col_video.subheader("Generated Video:")
+                col_video.video(media_server.media_url(stages[f'video_{i}']))
+
+    if status["status"] == "running" and status["preview_path"] and os.path.exists(status["preview_path"]):
+        # Low resolution cut of the clips generated so far, see utils/preview.py
+        st.subheader("Preview")
+        st.video(media_server.media_url(status["preview_path"]))
+
+    if status["status"] == "done":
+        st.success("Video generated!")
+        display_video(status["output_path"])
+    elif status["status"] == "failed":
+        st.error(f"Generation failed: {status['error']}")
+
+    return status["status"] in ("queued", "running")
+
+@st.cache_resource
+def get_prompt_pool():
+    """Load the example prompt pool once per Streamlit server process and top it up."""
+    pool = prompt_pool.PromptPool(generate_example_prompt)
+    pool.refill_if_low()
+    return pool
+
+@st.cache_resource
+def start_media_server():
+    """Start the media server once per Streamlit server process, see utils/media_server.py."""
+    return media_server.start_server()
+
+@st.cache_resource
+def start_background_workers():
+    """Start the generation workers once per Streamlit server process."""
+    return job_queue.start_workers(NUM_WORKERS)
+
+def open_gallery_video(video_path):
+    """Remember which gallery video is played, the others only show their poster."""
+    st.session_state['gallery_video'] = video_path
+
+def display_gallery():
+    """Display one page of the example gallery as poster frames in rows of 3."""
     with st.expander("Example Gallery"):
-        for i in range(0, len(video_files), 3):
+        # Only new or changed files are looked at, see utils/gallery.py
+        nb_videos = gallery.sync()
+        nb_pages = max(1, math.ceil(nb_videos / gallery.PAGE_SIZE))
+        page = st.number_input(f"Page (of {nb_pages})", min_value=1, max_value=nb_pages, value=1) if nb_pages > 1 else 1
+        videos = gallery.list_page(page - 1)
+        for i in range(0, len(videos), 3):
             cols = st.columns(3)
-            for j in range(3):
-                index = i + j
-                if index < len(video_files):
-                    cols[j].video(os.path.join('media/videos', video_files[index]))
+            for col, video in zip(cols, videos[i:i + 3]):
+                if st.session_state.get('gallery_video') == video["path"]:
+                    with col:
+                        display_video(video["path"], height=480)
+                elif video["poster_path"]:
+                    col.image(media_server.media_url(video["poster_path"]))
+                col.caption(f"{video['title']} ({video['duration']:.0f}s, {video['size'] / 1e6:.1f} MB)")
+                col.button("Play", key=f"play_{video['path']}", on_click=open_gallery_video, args=(video["path"],))
 
 
 
@@ -295,6 +435,10 @@ def main():
     st.title("X-Fiction Video Generation 🎥")
     
     st.image("media/header3.png")
+
+    start_background_workers()
+    start_media_server()
+    get_prompt_pool()
     
     st.write("This is a demo. Enter a story prompt and click the 'Start Generation' button to generate a video. Generations take about 12 minutes. Progress can be followed live. Powered by Stable Video Diffusion.")
     
@@ -309,11 +453,14 @@ def main():
     col1, col2, col3 = st.columns(3)
 
     if col3.button("Generate Example Prompt"):
-        example_prompts_json = generate_example_prompt()
-        if example_prompts_json:
-            example_prompts = json.loads(example_prompts_json)
+        # Served from the pool; the LLM is only asked directly while it is empty
+        example_prompts = get_prompt_pool().take(3)
+        if not example_prompts:
+            example_prompts_json = generate_example_prompt()
+            example_prompts = prompt_pool.parse_prompts(example_prompts_json) if example_prompts_json else []
+        if example_prompts:
             col1, col2, col3 = st.columns(3)
-            for i, (prompt_key, prompt_value) in enumerate(example_prompts.items()):
+            for i, prompt_value in enumerate(example_prompts[:3]):
                 
                 if i == 0:
                     col1.subheader("Prompt 1")
@@ -325,23 +472,21 @@ def main():
                     col3.subheader("Prompt 3")
                     col3.write(prompt_value)
     if col1.button("Start Generation (0,80€)"):
-        with st.spinner("Generating video..."):
-            video_path = generate_video(story_prompt)
-            col1, col2 = st.columns(2)
-            col1.success("Video generated!")
+        # Generation runs in the background workers, the page only polls it
+        st.session_state['job_id'] = job_queue.enqueue(story_prompt)
 
+    job_running = False
+    if 'job_id' in st.session_state:
+        job_running = display_job_progress(st.session_state['job_id'])
 
-            col2.video(video_path)   
-    # Directory containing the videos
-    video_directory = 'media/videos'
+    # Display the example videos
+    display_gallery()
 
-    # Get a list of video files
-    videos = list_video_files(video_directory)
+    # Poll the queue until the job is finished
+    if job_running:
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
 
-    # Display videos
-    display_videos(videos)
-        
-   
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The modules under test are imported as utils.*, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.asset_cache as asset_cache  # noqa: E402
+import utils.ffmpeg_tools as ffmpeg_tools  # noqa: E402
+import utils.segments as segments  # noqa: E402
+import utils.tracing as tracing  # noqa: E402
+
+# Manual scripts that call the real APIs when run, not pytest tests
+collect_ignore = [
+    "test_async_main.py",
+    "test_combine.py",
+    "test_openai.py",
+    "test_openai_async.py",
+    "test_rep.py",
+    "test_rep_async.py",
+]
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Keep the asset cache, segments and traces of a test under tmp_path."""
+    monkeypatch.setattr(asset_cache, "default_cache", asset_cache.AssetCache(str(tmp_path / "cache_index.json")))
+    monkeypatch.setattr(segments, "SEGMENT_DIRECTORY", str(tmp_path / "segments"))
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(tmp_path / "traces.jsonl"))
+    return tmp_path
+
+
+@pytest.fixture
+def make_clip(tmp_path):
+    """Write a short test pattern clip, the color telling clips apart."""
+    def make(name, duration=1.0, size=(64, 112), fps=25, color="blue", audio=False, gop=None, codec="libx264"):
+        path = str(tmp_path / name)
+        inputs = ["-f", "lavfi", "-i", f"color=c={color}:s={size[0]}x{size[1]}:r={fps}:d={duration}"]
+        if audio:
+            inputs += ["-f", "lavfi", "-i", f"sine=d={duration}", "-c:a", "aac"]
+        options = ["-c:v", codec, "-pix_fmt", "yuv420p"]
+        if codec == "libx264":
+            options += ["-preset", "ultrafast"]
+        if gop:
+            options += ["-g", str(gop)]
+        subprocess.run([ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", *inputs, *options, path], check=True)
+        return path
+    return make
+
+
+@pytest.fixture
+def make_audio(tmp_path):
+    """Write a sine tone voiceover."""
+    def make(name="voiceover.mp3", duration=2.0):
+        path = str(tmp_path / name)
+        subprocess.run(
+            [ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-i", f"sine=d={duration}", path],
+            check=True,
+        )
+        return path
+    return make
@@ -0,0 +1,80 @@
+import os
+import time
+
+import utils.asset_cache as asset_cache
+
+
+def make_cache(tmp_path, max_bytes=1024):
+    return asset_cache.AssetCache(str(tmp_path / "cache_index.json"), max_bytes=max_bytes)
+
+
+def write(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def test_key_is_stable_and_covers_every_parameter():
+    key = asset_cache.cache_key("image", prompt="a cat", size="1024x1792")
+
+    assert key == asset_cache.cache_key("image", size="1024x1792", prompt="a cat")
+    assert key != asset_cache.cache_key("image", prompt="a cat", size="1024x1024")
+    assert key != asset_cache.cache_key("clip", prompt="a cat", size="1024x1792")
+    assert len(key) == 32
+
+
+def test_file_digest_follows_the_content(tmp_path):
+    first = write(tmp_path, "a.bin", 10)
+    second = write(tmp_path, "b.bin", 10)
+
+    assert asset_cache.file_digest(first) == asset_cache.file_digest(second)
+    (tmp_path / "b.bin").write_bytes(b"y" * 10)
+    assert asset_cache.file_digest(first) != asset_cache.file_digest(second)
+
+
+def test_lookup_hits_stored_assets_and_forgets_deleted_ones(tmp_path):
+    cache = make_cache(tmp_path)
+    path = write(tmp_path, "a.png", 10)
+
+    assert cache.lookup("key") is None
+    assert cache.store("key", path) == path
+    assert cache.lookup("key") == path
+
+    os.remove(path)
+    assert cache.lookup("key") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 0, "bytes": 0}
+
+
+def test_index_is_shared_between_instances(tmp_path):
+    path = write(tmp_path, "a.png", 10)
+    make_cache(tmp_path).store("key", path)
+
+    assert make_cache(tmp_path).lookup("key") == path
+
+
+def test_least_recently_used_assets_are_evicted_over_budget(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=250)
+    paths = {}
+    for name in ("a", "b"):
+        paths[name] = cache.store(name, write(tmp_path, f"{name}.png", 100))
+        time.sleep(0.01)
+    # Using a makes b the least recently used asset
+    assert cache.lookup("a")
+    time.sleep(0.01)
+
+    cache.store("c", write(tmp_path, "c.png", 100))
+
+    assert cache.lookup("b") is None
+    assert not os.path.exists(paths["b"])
+    assert cache.lookup("a") and cache.lookup("c")
+    assert cache.stats()["bytes"] == 200
+
+
+def test_new_asset_is_kept_even_if_larger_than_the_budget(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=50)
+    old = cache.store("old", write(tmp_path, "old.png", 40))
+
+    new = cache.store("new", write(tmp_path, "new.png", 100))
+
+    assert cache.lookup("new") == new
+    assert not os.path.exists(old)
@@ -0,0 +1,67 @@
+import asyncio
+import http.server
+import threading
+
+import pytest
+
+import utils.download_from_url as download
+import utils.tracing as tracing
+
+CONTENT = b"clip" * 1000
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def url(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(tmp_path / "traces.jsonl"))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/clip.mp4"
+    server.shutdown()
+    server.server_close()
+
+
+def download_spans():
+    return [span for span in tracing.load_spans() if span["name"] == "download"]
+
+
+def test_download_span_is_a_child_of_the_caller(url, tmp_path):
+    with tracing.span("job") as job_span:
+        assert download.download_to_file(url, tmp_path / "clip.mp4") == str(tmp_path / "clip.mp4")
+
+    [span] = download_spans()
+    assert (span["trace_id"], span["parent_id"]) == (job_span.trace_id, job_span.span_id)
+    assert span["bytes"] == len(CONTENT)
+
+
+def test_async_download_span_is_a_child_of_the_calling_task(url, tmp_path):
+    async def clip(index):
+        with tracing.span("clip", index=index) as clip_span:
+            await download.async_download_to_file(url, tmp_path / f"clip_{index}.mp4")
+        return clip_span
+
+    async def run():
+        return await asyncio.gather(clip(0), clip(1))
+
+    clip_spans = asyncio.run(run())
+
+    parents = {span["parent_id"] for span in download_spans()}
+    assert parents == {clip_span.span_id for clip_span in clip_spans}
+
+
+def test_download_outside_a_span_starts_its_own_trace(url, tmp_path):
+    download.download_to_file(url, tmp_path / "clip.mp4")
+
+    [span] = download_spans()
+    assert span["parent_id"] is None
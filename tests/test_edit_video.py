@@ -0,0 +1,39 @@
+import pytest
+
+import utils.edit_video as edit_video
+import utils.ffmpeg_tools as ffmpeg_tools
+
+
+def test_cuts_snap_to_the_nearest_keyframe():
+    keyframes = [0.0, 4.0, 9.2, 16.0, 21.0, 28.0]
+
+    assert edit_video._chunk_boundaries(keyframes, 30.0, 3, 25) == [0.0, 9.2, 21.0, 30.0]
+
+
+def test_cuts_land_on_the_output_frame_grid():
+    cuts = edit_video._chunk_boundaries([0.0, 10.013, 19.99], 30.0, 3, 30)
+
+    assert cuts == [0.0, pytest.approx(10.0), pytest.approx(20.0), 30.0]
+    assert all(round(cut * 30, 9).is_integer() for cut in cuts)
+
+
+def test_cuts_sharing_a_keyframe_are_merged():
+    # Both targets (10s and 20s) snap to the only keyframe past the start
+    assert edit_video._chunk_boundaries([0.0, 15.0], 30.0, 3, 25) == [0.0, 15.0, 30.0]
+
+
+def test_cuts_at_the_edges_are_dropped():
+    assert edit_video._chunk_boundaries([0.0, 29.99], 30.0, 2, 25) == [0.0, 30.0]
+    assert edit_video._chunk_boundaries([0.0], 30.0, 4, 25) == [0.0, 30.0]
+
+
+def test_without_keyframes_the_timeline_is_split_evenly():
+    assert edit_video._chunk_boundaries([], 30.0, 3, 25) == [0.0, 10.0, 20.0, 30.0]
+
+
+def test_cuts_follow_the_keyframes_of_a_real_clip(make_clip):
+    clip = make_clip("gen.mp4", duration=6.0, fps=25, gop=50)
+    keyframes = ffmpeg_tools.keyframe_times(clip)
+
+    assert keyframes == pytest.approx([0.0, 2.0, 4.0])
+    assert edit_video._chunk_boundaries(keyframes, 6.0, 3, 25) == [0.0, 2.0, 4.0, 6.0]
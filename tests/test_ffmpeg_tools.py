@@ -0,0 +1,38 @@
+import pytest
+
+import utils.ffmpeg_tools as ffmpeg_tools
+
+
+def test_matching_clips_can_be_stream_copied(make_clip):
+    clips = [make_clip("a.mp4"), make_clip("b.mp4", color="red", duration=2.0), make_clip("c.mp4", audio=True)]
+
+    assert ffmpeg_tools.can_stream_copy(clips)
+
+
+@pytest.mark.parametrize("different", [
+    {"size": (96, 160)},
+    {"fps": 24},
+    {"codec": "mpeg4"},
+])
+def test_mismatched_clips_are_re_encoded(make_clip, different):
+    clips = [make_clip("a.mp4"), make_clip("b.mp4", color="red", **different)]
+
+    assert not ffmpeg_tools.can_stream_copy(clips)
+
+
+def test_unsupported_codec_is_never_stream_copied(make_clip):
+    clips = [make_clip("a.mp4", codec="mpeg4"), make_clip("b.mp4", codec="mpeg4")]
+
+    assert not ffmpeg_tools.can_stream_copy(clips)
+
+
+def test_stream_copy_joins_the_clips_and_cuts_the_audio(make_clip, make_audio, tmp_path):
+    clips = [make_clip("a.mp4"), make_clip("b.mp4", color="red")]
+    output_path = str(tmp_path / "out.mp4")
+
+    ffmpeg_tools.concat_stream_copy(clips, make_audio(duration=5.0), output_path)
+
+    infos = ffmpeg_tools.probe_media(output_path)
+    assert infos["video_codec"] == "h264"
+    assert infos["audio_codec"] == "aac"
+    assert infos["duration"] == pytest.approx(2.0, abs=0.1)
@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import pytest
+
+import utils.gallery as gallery
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(gallery, "GALLERY_DB_PATH", str(tmp_path / "gallery.sqlite3"))
+    monkeypatch.setattr(gallery, "POSTER_DIRECTORY", str(tmp_path / "posters"))
+    path = tmp_path / "videos"
+    path.mkdir()
+    return str(path)
+
+
+def touch_directory(directory, offset):
+    # Directory mtimes can have a coarse resolution; make the change visible to sync
+    stat = os.stat(directory)
+    os.utime(directory, (stat.st_atime, stat.st_mtime + offset))
+
+
+def test_sync_adds_and_removes_videos(directory, make_clip):
+    first = make_clip("first.mp4")
+    shutil.move(first, os.path.join(directory, "First.mp4"))
+    open(os.path.join(directory, "notes.txt"), "w").close()
+
+    assert gallery.sync(directory) == 1
+
+    second = make_clip("second.mp4", color="red")
+    shutil.move(second, os.path.join(directory, "Second.mp4"))
+    os.remove(os.path.join(directory, "First.mp4"))
+    touch_directory(directory, 1)
+
+    assert gallery.sync(directory) == 1
+    assert [video["title"] for video in gallery.list_page(directory=directory)] == ["Second"]
+
+
+def test_sync_skips_an_unchanged_directory(directory, make_clip):
+    shutil.move(make_clip("a.mp4"), os.path.join(directory, "A.mp4"))
+    assert gallery.sync(directory) == 1
+    mtime = os.stat(directory).st_mtime
+
+    shutil.move(make_clip("b.mp4"), os.path.join(directory, "B.mp4"))
+    os.utime(directory, (mtime, mtime))
+
+    assert gallery.sync(directory) == 1
+    assert gallery.sync(directory, force=True) == 2
+
+
+def test_list_page_describes_each_video_once(directory, make_clip):
+    shutil.move(make_clip("a.mp4", duration=2.0), os.path.join(directory, "A.mp4"))
+    gallery.sync(directory)
+
+    [video] = gallery.list_page(directory=directory)
+
+    assert video["duration"] == pytest.approx(2.0, abs=0.1)
+    assert os.path.exists(video["poster_path"])
+    assert gallery.list_page(directory=directory) == [video]
+
+
+def test_list_page_describes_a_video_rewritten_in_place_again(directory, make_clip):
+    path = os.path.join(directory, "Story.mp4")
+    shutil.move(make_clip("a.mp4", duration=2.0), path)
+    gallery.sync(directory)
+    [before] = gallery.list_page(directory=directory)
+
+    # A story rendered again under the same title; the directory itself is unchanged
+    directory_mtime = os.stat(directory).st_mtime
+    shutil.copyfile(make_clip("b.mp4", duration=4.0, color="red"), path)
+    os.utime(path, (before["mtime"] + 5, before["mtime"] + 5))
+    os.utime(directory, (directory_mtime, directory_mtime))
+    gallery.sync(directory)
+
+    [after] = gallery.list_page(directory=directory)
+
+    assert after["duration"] == pytest.approx(4.0, abs=0.1)
+    assert after["mtime"] == before["mtime"] + 5
+    assert after["poster_path"] != before["poster_path"]
+    assert gallery.list_page(directory=directory) == [after]
+
+
+def test_list_page_hides_deleted_videos(directory, make_clip):
+    shutil.move(make_clip("a.mp4"), os.path.join(directory, "A.mp4"))
+    gallery.sync(directory)
+    directory_mtime = os.stat(directory).st_mtime
+
+    os.remove(os.path.join(directory, "A.mp4"))
+    os.utime(directory, (directory_mtime, directory_mtime))
+
+    assert gallery.list_page(directory=directory) == []
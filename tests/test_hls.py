@@ -0,0 +1,37 @@
+import pytest
+
+import utils.hls as hls
+import utils.job_queue as job_queue
+import utils.media_server as media_server
+
+
+@pytest.mark.parametrize("mode, server, expected", [
+    ("auto", "off", False),
+    ("auto", "app", True),
+    ("auto", "external", True),
+    ("1", "off", True),
+    ("0", "app", False),
+])
+def test_packaging_follows_the_media_server(monkeypatch, mode, server, expected):
+    monkeypatch.setattr(hls, "HLS_MODE", mode)
+    monkeypatch.setattr(media_server, "MEDIA_SERVER", server)
+
+    assert hls.packaging_enabled() is expected
+
+
+def test_workers_skip_the_ladder_when_it_would_never_be_played(monkeypatch):
+    monkeypatch.setattr(hls, "HLS_MODE", "auto")
+    monkeypatch.setattr(media_server, "MEDIA_SERVER", "off")
+
+    assert job_queue.load_stage_functions()["package_video"] is None
+
+    monkeypatch.setattr(media_server, "MEDIA_SERVER", "app")
+
+    assert job_queue.load_stage_functions()["package_video"] is hls.package_hls
+
+
+def test_plan_ladder_never_upscales():
+    renditions = hls.plan_ladder(576, 1024)
+
+    assert [rendition["name"] for rendition in renditions] == ["360p", "576p"]
+    assert renditions[-1]["width"] == 576 and renditions[-1]["height"] == 1024
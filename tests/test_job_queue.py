@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+import utils.job_queue as job_queue
+import utils.jobs as jobs
+
+
+@pytest.fixture(autouse=True)
+def queue_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DIRECTORY", str(tmp_path / "reports"))
+    monkeypatch.setattr(job_queue, "QUEUE_DB_PATH", str(tmp_path / "reports" / "queue.sqlite3"))
+
+
+def claim_concurrently(nb_claimers):
+    # Every claimer opens its own connection, like separate worker processes
+    barrier = threading.Barrier(nb_claimers)
+    claims = [None] * nb_claimers
+
+    def claim(index):
+        barrier.wait()
+        claims[index] = job_queue.claim_next_job(f"worker-{index}")
+
+    threads = [threading.Thread(target=claim, args=(index,)) for index in range(nb_claimers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return claims
+
+
+def make_stale(job_id):
+    conn = job_queue._connect()
+    try:
+        conn.execute("UPDATE queue SET updated_at = ? WHERE job_id = ?", (time.time() - job_queue.STALE_AFTER - 1, job_id))
+    finally:
+        conn.close()
+
+
+def test_each_job_is_claimed_by_one_worker():
+    job_id = job_queue.enqueue("a prompt")
+
+    claims = claim_concurrently(2)
+
+    assert claims.count(job_id) == 1
+    assert claims.count(None) == 1
+    assert job_queue.get_status(job_id)["worker"] == f"worker-{claims.index(job_id)}"
+
+
+def test_jobs_are_spread_over_concurrent_workers():
+    job_ids = [job_queue.enqueue(f"prompt {i}") for i in range(3)]
+
+    claims = claim_concurrently(5)
+
+    assert sorted(claim for claim in claims if claim) == sorted(job_ids)
+    assert claims.count(None) == 2
+
+
+def test_oldest_job_is_claimed_first():
+    first = job_queue.enqueue("first")
+    second = job_queue.enqueue("second")
+
+    assert job_queue.get_status(second)["position"] == 1
+    assert job_queue.claim_next_job("worker") == first
+    assert job_queue.claim_next_job("worker") == second
+
+
+def test_stale_running_job_is_reclaimed():
+    job_id = job_queue.enqueue("a prompt")
+    assert job_queue.claim_next_job("crashed") == job_id
+    assert job_queue.claim_next_job("other") is None
+
+    make_stale(job_id)
+
+    assert job_queue.claim_next_job("other") == job_id
+    assert job_queue.get_status(job_id)["worker"] == "other"
+
+
+def test_heartbeat_keeps_a_running_job():
+    job_id = job_queue.enqueue("a prompt")
+    job_queue.claim_next_job("worker")
+    make_stale(job_id)
+
+    job_queue.update_progress(job_id, 0.5, "Generated image_0")
+
+    assert job_queue.claim_next_job("other") is None
+
+
+def test_resubmitted_prompt_reuses_its_unfinished_job():
+    job_id = job_queue.enqueue("a prompt")
+    assert job_queue.enqueue("a prompt") == job_id
+    job_queue.claim_next_job("worker")
+    assert job_queue.enqueue("a prompt") == job_id
+    assert job_queue.get_status(job_id)["status"] == "running"
+
+    jobs.finish_job(jobs.load_job(job_id), None, status="failed")
+    job_queue._update(job_id, status="failed", progress=0.4, error="Replicate error")
+
+    assert job_queue.enqueue("a prompt") == job_id
+    status = job_queue.get_status(job_id)
+    assert (status["status"], status["progress"], status["error"]) == ("queued", 0, None)
+    assert jobs.load_job(job_id)["status"] == "queued"
+    assert job_queue.claim_next_job("worker") == job_id
+
+
+def test_finished_prompt_gets_a_new_job():
+    job_id = job_queue.enqueue("a prompt")
+    jobs.finish_job(jobs.load_job(job_id), "video.mp4")
+
+    assert job_queue.enqueue("a prompt") != job_id
+
+
+def test_offline_jobs_are_only_claimed_by_offline_workers():
+    offline_job = job_queue.enqueue("load test", offline=True)
+    real_job = job_queue.enqueue("a prompt")
+
+    assert job_queue.claim_next_job("worker") == real_job
+    assert job_queue.claim_next_job("worker") is None
+    assert job_queue.claim_next_job("offline-worker", offline=True) == offline_job
@@ -0,0 +1,87 @@
+import pytest
+
+import utils.jobs as jobs
+import utils.pipeline as pipeline
+
+STORY = {
+    "title": "Test Story",
+    "voiceover_text": "Once upon a time.",
+    "character": "a fox",
+    "visual_style": "watercolor",
+    "clips": {"clip_1": {"image_prompt": "a forest"}, "clip_2": {"image_prompt": "a river"}},
+}
+
+
+@pytest.fixture(autouse=True)
+def jobs_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DIRECTORY", str(tmp_path / "reports"))
+
+
+def asset(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b"asset")
+    return str(path)
+
+
+def test_completed_stages_only_keeps_finished_assets_on_disk(tmp_path):
+    job = jobs.create_job("a prompt")
+    jobs.complete_stage(job, "voiceover", asset(tmp_path, "voiceover.mp3"))
+    jobs.complete_stage(job, "image_0", str(tmp_path / "deleted.png"))
+    job["stages"]["video_0"] = {"status": "running", "path": asset(tmp_path, "partial.mp4")}
+    jobs.save_job(job)
+
+    assert jobs.completed_stages(jobs.load_job(job["job_id"])) == {"voiceover": str(tmp_path / "voiceover.mp3")}
+
+
+def test_find_resumable_job_returns_the_latest_unfinished_job():
+    finished = jobs.create_job("a prompt")
+    jobs.finish_job(finished, "video.mp4")
+    failed = jobs.create_job("a prompt")
+    jobs.finish_job(failed, None, status="failed")
+    jobs.create_job("another prompt")
+
+    assert jobs.find_resumable_job("a prompt")["job_id"] == failed["job_id"]
+    jobs.finish_job(failed, "video.mp4")
+    assert jobs.find_resumable_job("a prompt") is None
+
+
+def test_resumed_job_only_generates_missing_stages(tmp_path):
+    job = jobs.create_job("a prompt")
+    jobs.set_story(job, STORY)
+    jobs.complete_stage(job, "voiceover", asset(tmp_path, "voiceover.mp3"))
+    jobs.complete_stage(job, "image_0", asset(tmp_path, "image_0.png"))
+    jobs.complete_stage(job, "video_0", asset(tmp_path, "video_0.mp4"))
+    calls = []
+
+    def generate(kind):
+        def func(source):
+            calls.append((kind, source))
+            return asset(tmp_path, f"{kind}_{len(calls)}")
+        return func
+
+    def combine(video_paths, audio_path, output_path):
+        calls.append(("combine", video_paths, audio_path))
+
+    def story_generation_is_skipped(prompt):
+        raise AssertionError("The story was generated again")
+
+    output_path = pipeline.run_story_job(
+        jobs.load_job(job["job_id"]),
+        story_generation_is_skipped,
+        generate("voiceover"),
+        generate("image"),
+        generate("video"),
+        combine,
+        output_directory=str(tmp_path / "videos"),
+    )
+
+    image_prompt = pipeline.build_clip_prompts(STORY)[1]
+    assert calls == [
+        ("image", image_prompt),
+        ("video", str(tmp_path / "image_1")),
+        ("combine", [str(tmp_path / "video_0.mp4"), str(tmp_path / "video_2")], str(tmp_path / "voiceover.mp3")),
+    ]
+    assert output_path == str(tmp_path / "videos" / "Test Story.mp4")
+    finished = jobs.load_job(job["job_id"])
+    assert finished["status"] == "done"
+    assert set(jobs.completed_stages(finished)) == {"voiceover", "image_0", "video_0", "image_1", "video_1"}
@@ -0,0 +1,129 @@
+import http.client
+import threading
+
+import pytest
+
+import utils.media_server as media_server
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-", (10, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    (" bytes=0-0 ", (0, 0)),
+])
+def test_parse_range(header, expected):
+    assert media_server._parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=-0",
+    "bytes=-",
+    "bytes=1000-",
+    "bytes=50-10",
+    "bytes=0-9,20-29",
+    "items=0-9",
+])
+def test_parse_range_rejects_unsatisfiable_ranges(header):
+    assert media_server._parse_range(header, 1000) is None
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # Served directories are relative to the working directory, as in the app
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "media" / "videos").mkdir(parents=True)
+    (tmp_path / "media" / "videos" / "clip one.mp4").write_bytes(CONTENT)
+    (tmp_path / "secret.txt").write_text("not media")
+
+    server = media_server._Server(("127.0.0.1", 0), media_server.MediaRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path="/media/videos/clip%20one.mp4", method="GET", **headers):
+    connection = http.client.HTTPConnection(*server.server_address)
+    try:
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+    finally:
+        connection.close()
+
+
+def test_full_response_has_etag_and_mime_type(server):
+    response, body = get(server)
+
+    assert response.status == 200
+    assert body == CONTENT
+    assert response.getheader("Content-Type") == "video/mp4"
+    assert response.getheader("Accept-Ranges") == "bytes"
+    assert response.getheader("ETag")
+
+
+def test_head_sends_headers_only(server):
+    response, body = get(server, method="HEAD")
+
+    assert response.status == 200
+    assert body == b""
+    assert response.getheader("Content-Length") == str(len(CONTENT))
+
+
+def test_matching_etag_is_not_modified(server):
+    etag = get(server)[0].getheader("ETag")
+
+    response, body = get(server, **{"If-None-Match": f'"other", {etag}'})
+
+    assert response.status == 304
+    assert body == b""
+
+
+def test_etag_changes_with_the_file(server, tmp_path):
+    etag = get(server)[0].getheader("ETag")
+    (tmp_path / "media" / "videos" / "clip one.mp4").write_bytes(CONTENT + b"more")
+
+    response, _ = get(server, **{"If-None-Match": etag})
+
+    assert response.status == 200
+    assert response.getheader("ETag") != etag
+
+
+def test_range_request_returns_partial_content(server):
+    response, body = get(server, Range="bytes=100-199")
+
+    assert response.status == 206
+    assert body == CONTENT[100:200]
+    assert response.getheader("Content-Range") == f"bytes 100-199/{len(CONTENT)}"
+
+
+def test_range_of_an_outdated_version_returns_the_whole_file(server):
+    response, body = get(server, Range="bytes=100-199", **{"If-Range": '"outdated"'})
+
+    assert response.status == 200
+    assert body == CONTENT
+
+
+def test_empty_suffix_range_is_not_satisfiable(server):
+    response, body = get(server, Range="bytes=-0")
+
+    assert response.status == 416
+    assert body == b""
+    assert response.getheader("Content-Range") == f"bytes */{len(CONTENT)}"
+
+
+@pytest.mark.parametrize("path", [
+    "/secret.txt",
+    "/media/videos/../../secret.txt",
+    "/media/videos/%2e%2e/%2e%2e/secret.txt",
+    "/media/videos/missing.mp4",
+    "/media/videos",
+])
+def test_files_outside_the_served_directories_are_not_found(server, path):
+    assert get(server, path)[0].status == 404
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import socket
+import time
+
+import pytest
+from PIL import Image
+
+import utils.download_from_url as download
+import utils.predictions as predictions
+import utils.providers as providers
+import utils.rate_limit as rate_limit
+from utils.fake_replicate import FakeReplicateServer
+
+MODEL = providers.ReplicateVideoProvider.model
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "image.png"
+    Image.new("RGB", (64, 112), "purple").save(path)
+    return str(path)
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(predictions, "POLL_INTERVAL", 0.05)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    # The shared client retries 429s on its own before the manager gives up
+    monkeypatch.setattr(download, "BACKOFF_BASE", 0.0)
+    monkeypatch.setattr(rate_limit, "BACKOFF_BASE", 0.0)
+
+
+def make_manager(server, **options):
+    return predictions.PredictionManager("fake", api_url=server.api_url, **options)
+
+
+def submit(manager, image_path, output_path):
+    return manager.submit(MODEL, {"video_length": "14_frames_with_svd"}, str(output_path), files={"input_image": image_path})
+
+
+def test_successful_prediction_is_downloaded(fast_polls, image_path, tmp_path):
+    with FakeReplicateServer(latency=0.2) as server:
+        manager = make_manager(server)
+
+        output_path = submit(manager, image_path, tmp_path / "clip.mp4").result(timeout=30)
+
+    assert output_path == str(tmp_path / "clip.mp4")
+    assert os.path.getsize(output_path) > 0
+    assert manager.pending == 0
+
+
+def test_failed_prediction_raises_provider_error(fast_polls, image_path, tmp_path):
+    with FakeReplicateServer(latency=0.1, failure_rate=1.0) as server:
+        manager = make_manager(server)
+
+        with pytest.raises(providers.ProviderError, match="failed: Injected prediction failure"):
+            submit(manager, image_path, tmp_path / "clip.mp4").result(timeout=30)
+
+    assert not os.path.exists(tmp_path / "clip.mp4")
+
+
+def test_throttled_creation_is_retried_by_the_limiter(fast_polls, no_backoff, image_path, tmp_path):
+    limiter = rate_limit.AdaptiveLimiter("test/replicate", max_concurrency=4, db_path=str(tmp_path / "limits.sqlite3"))
+    attempts = []
+
+    with FakeReplicateServer(latency=0.1, throttle_rate=1.0) as server:
+        manager = make_manager(server)
+
+        async def create():
+            attempts.append(None)
+            try:
+                return await asyncio.wrap_future(submit(manager, image_path, tmp_path / "clip.mp4"))
+            finally:
+                # Only the first creation is throttled
+                server.throttle_rate = 0.0
+
+        output_path = asyncio.run(limiter.async_call(create))
+
+    assert len(attempts) == 2
+    assert os.path.getsize(output_path) > 0
+    assert limiter.stats()["limit"] == 2
+
+
+def test_throttled_creation_is_reported_as_a_429(no_backoff, image_path, tmp_path):
+    with FakeReplicateServer(throttle_rate=1.0) as server:
+        manager = make_manager(server)
+
+        with pytest.raises(predictions.PredictionError) as error:
+            submit(manager, image_path, tmp_path / "clip.mp4").result(timeout=30)
+
+    assert error.value.status_code == 429
+    assert rate_limit.is_throttled(error.value)
+
+
+def test_prediction_past_the_deadline_is_canceled(fast_polls, image_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(predictions, "PREDICTION_TIMEOUT", 0.5)
+
+    with FakeReplicateServer(latency=30) as server:
+        manager = make_manager(server)
+
+        start = time.monotonic()
+        with pytest.raises(predictions.PredictionError, match="did not complete within"):
+            submit(manager, image_path, tmp_path / "clip.mp4").result(timeout=30)
+
+        assert time.monotonic() - start < 5
+        assert server.canceled == list(server.predictions)
+        assert manager.pending == 0
+
+
+def test_webhook_wakes_the_poller_early(image_path, tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    with FakeReplicateServer(latency=0.2) as server:
+        # With a webhook the poller only runs every WEBHOOK_POLL_INTERVAL seconds
+        manager = make_manager(server, webhook_url=f"http://127.0.0.1:{port}/", webhook_port=port)
+
+        start = time.monotonic()
+        output_path = submit(manager, image_path, tmp_path / "clip.mp4").result(timeout=30)
+
+    assert time.monotonic() - start < predictions.WEBHOOK_POLL_INTERVAL / 2
+    assert os.path.getsize(output_path) > 0
+    # The delivery itself is not trusted, the prediction was fetched once
+    assert server.status_requests == 1
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import utils.prompt_pool as prompt_pool
+
+
+def test_repeated_keys_keep_every_prompt():
+    text = '{"Prompt": "A robot learns to paint", "Prompt": "A city under the sea", "Prompt": "The last bakery on Mars"}'
+
+    assert prompt_pool.parse_prompts(text) == [
+        "A robot learns to paint",
+        "A city under the sea",
+        "The last bakery on Mars",
+    ]
+
+
+def test_numbered_keys_lists_and_whitespace():
+    text = json.dumps({
+        "Prompt 1": "  Spaced out  ",
+        "Prompt 2": "",
+        "Prompts": ["From a list", 3, "  "],
+        "count": 3,
+    })
+
+    assert prompt_pool.parse_prompts(text) == ["Spaced out", "From a list"]
+
+
+def test_invalid_json_raises_value_error():
+    with pytest.raises(ValueError):
+        prompt_pool.parse_prompts('{"Prompt": "unterminated')
+
+
+def test_pool_skips_prompts_it_has_seen_and_persists(tmp_path):
+    path = str(tmp_path / "pool.json")
+    pool = prompt_pool.PromptPool(lambda: None, path=path, low_water_mark=0)
+
+    assert pool.add(["A lost dog", "a lost dog.", "  A  LOST dog ", "A found cat"]) == 2
+    assert pool.take(1) == ["A lost dog"]
+    # Served prompts are still remembered
+    assert pool.add(["A lost dog"]) == 0
+
+    reloaded = prompt_pool.PromptPool(lambda: None, path=path, low_water_mark=0)
+    assert list(reloaded.prompts) == ["A found cat"]
+    assert reloaded.add(["A LOST DOG"]) == 0
@@ -0,0 +1,42 @@
+import base64
+import io
+import types
+
+import pytest
+from PIL import Image
+
+import utils.providers as providers
+
+
+def png_base64():
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), "green").save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def images_returned(monkeypatch):
+    # Number of images the fake OpenAI client answers with, whatever n was asked
+    returned = {"count": None}
+
+    def generate(n, **options):
+        return types.SimpleNamespace(data=[types.SimpleNamespace(b64_json=png_base64()) for _ in range(returned["count"] or n)])
+
+    client = types.SimpleNamespace(images=types.SimpleNamespace(generate=generate))
+    monkeypatch.setattr(providers, "_get_openai_client", lambda: client)
+    return returned
+
+
+def test_batch_writes_every_candidate(images_returned, tmp_path):
+    paths = [str(tmp_path / f"img_{i}.png") for i in range(3)]
+
+    assert providers.OpenAIImageProvider("b64_json").generate_batch("a cat", paths, model="dall-e-2") == paths
+    assert all(Image.open(path).size == (8, 8) for path in paths)
+
+
+def test_short_batch_raises_provider_error(images_returned, tmp_path):
+    images_returned["count"] = 1
+    paths = [str(tmp_path / f"img_{i}.png") for i in range(3)]
+
+    with pytest.raises(providers.ProviderError, match="Requested 3 images, received 1"):
+        providers.OpenAIImageProvider("b64_json").generate_batch("a cat", paths, model="dall-e-2")
@@ -0,0 +1,201 @@
+import asyncio
+
+import pytest
+
+import utils.rate_limit as rate_limit
+
+
+class Throttled(Exception):
+    status_code = 429
+
+
+@pytest.fixture
+def make_limiter(tmp_path, monkeypatch):
+    # No real waiting between throttle retries
+    monkeypatch.setattr(rate_limit, "BACKOFF_BASE", 0.0)
+
+    def make(name="test/model", **options):
+        return rate_limit.AdaptiveLimiter(name, db_path=str(tmp_path / "limits.sqlite3"), **options)
+    return make
+
+
+def throttle(limiter):
+    with pytest.raises(Throttled):
+        with limiter.slot():
+            raise Throttled("Too Many Requests")
+
+
+def test_throttling_halves_the_window_down_to_the_minimum(make_limiter):
+    limiter = make_limiter(max_concurrency=8, min_concurrency=1)
+
+    limits = []
+    for _ in range(5):
+        throttle(limiter)
+        limits.append(limiter.stats()["limit"])
+
+    assert limits == [4, 2, 1, 1, 1]
+
+
+def test_successes_grow_the_window_by_one_per_window_of_calls(make_limiter):
+    limiter = make_limiter(max_concurrency=8)
+    throttle(limiter)
+    throttle(limiter)
+
+    # 2 -> 2.5 -> 2.9 -> 3.24
+    limits = []
+    for _ in range(3):
+        slot_id, _ = limiter.acquire()
+        limiter.release(slot_id, latency=1.0)
+        limits.append(limiter.stats()["limit"])
+    assert limits == [2, 2, 3]
+
+    for _ in range(100):
+        slot_id, _ = limiter.acquire()
+        limiter.release(slot_id, latency=1.0)
+    assert limiter.stats()["limit"] == 8
+
+
+def test_latency_spike_counts_as_congestion(make_limiter):
+    limiter = make_limiter(max_concurrency=8)
+    for _ in range(3):
+        slot_id, _ = limiter.acquire()
+        limiter.release(slot_id, latency=1.0)
+
+    slot_id, _ = limiter.acquire()
+    limiter.release(slot_id, latency=1.0 * rate_limit.LATENCY_TOLERANCE * 2)
+
+    stats = limiter.stats()
+    assert stats["limit"] == 4
+    # The outlier is capped before it enters the average
+    assert stats["typical_latency"] < rate_limit.LATENCY_TOLERANCE
+
+
+def test_window_caps_requests_in_flight(make_limiter):
+    limiter = make_limiter(max_concurrency=2)
+
+    first, _ = limiter.acquire()
+    second, _ = limiter.acquire()
+    assert limiter.try_acquire() == (None, None)
+
+    limiter.release(first, latency=0.1)
+    slot_id, timeout = limiter.try_acquire()
+    assert slot_id and timeout is None
+    assert limiter.stats()["in_flight"] == 2
+
+
+def test_token_bucket_reports_wait_for_next_token(make_limiter):
+    limiter = make_limiter(requests_per_minute=60, max_concurrency=2)
+
+    for _ in range(2):
+        slot_id, _ = limiter.acquire()
+        limiter.release(slot_id, latency=0.1)
+
+    slot_id, timeout = limiter.try_acquire()
+    assert slot_id is None
+    assert 0.9 < timeout <= 1.0
+
+
+def test_limiters_of_the_same_name_share_their_state(make_limiter):
+    first, second = make_limiter(max_concurrency=1), make_limiter(max_concurrency=1)
+    other_model = make_limiter(name="test/other", max_concurrency=1)
+
+    slot_id, _ = first.acquire()
+
+    assert second.try_acquire() == (None, None)
+    assert other_model.try_acquire()[0]
+    first.release(slot_id)
+    assert second.try_acquire()[0]
+
+
+def test_call_retries_throttled_calls_and_shrinks_the_window(make_limiter):
+    limiter = make_limiter(max_concurrency=8)
+    attempts = []
+
+    def flaky():
+        attempts.append(len(attempts))
+        if len(attempts) < 3:
+            raise Throttled("rate limit exceeded")
+        return "done"
+
+    assert limiter.call(flaky) == "done"
+    assert len(attempts) == 3
+    assert limiter.stats() == {"limit": 2, "in_flight": 0, "typical_latency": pytest.approx(0, abs=0.1)}
+
+
+def test_call_gives_up_after_the_last_retry(make_limiter):
+    limiter = make_limiter()
+    attempts = []
+
+    def always_throttled():
+        attempts.append(None)
+        raise Throttled("Too Many Requests")
+
+    with pytest.raises(Throttled):
+        limiter.call(always_throttled)
+    assert len(attempts) == rate_limit.MAX_THROTTLE_RETRIES + 1
+
+
+def test_call_does_not_retry_other_errors(make_limiter):
+    limiter = make_limiter(max_concurrency=8)
+    attempts = []
+
+    def broken():
+        attempts.append(None)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(broken)
+    assert len(attempts) == 1
+    assert limiter.stats()["limit"] == 8
+
+
+def test_async_call_retries_throttled_coroutines(make_limiter):
+    limiter = make_limiter(max_concurrency=4)
+    attempts = []
+
+    async def flaky():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise Throttled("Too Many Requests")
+        return "done"
+
+    assert asyncio.run(limiter.async_call(flaky)) == "done"
+    assert len(attempts) == 2
+    assert limiter.stats()["limit"] == 2
+
+
+def test_async_slot_keeps_the_database_off_the_event_loop(make_limiter, monkeypatch):
+    limiter = make_limiter(max_concurrency=1)
+    called_on_loop = []
+
+    def recorded(func):
+        def wrapper(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                called_on_loop.append(True)
+            except RuntimeError:
+                called_on_loop.append(False)
+            return func(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(limiter, "try_acquire", recorded(limiter.try_acquire))
+    monkeypatch.setattr(limiter, "release", recorded(limiter.release))
+
+    async def work():
+        async with limiter.async_slot():
+            pass
+
+    asyncio.run(work())
+    assert called_on_loop == [False, False]
+
+
+def test_stats_reads_while_another_process_writes(make_limiter):
+    limiter = make_limiter(max_concurrency=4)
+    limiter.release(limiter.acquire()[0], throttled=True)
+    writer = rate_limit._connect(limiter.db_path)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        assert limiter.stats() == {"limit": 2, "in_flight": 0, "typical_latency": None}
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
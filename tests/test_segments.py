@@ -0,0 +1,50 @@
+import pytest
+
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.segments as segments
+import utils.tracing as tracing
+
+
+def spans(name):
+    return [span for span in tracing.load_spans() if span["name"] == name]
+
+
+def test_assembly_reports_its_encode_fps(workspace, make_clip, make_audio):
+    clips = [make_clip("a.mp4", size=(64, 112)), make_clip("b.mp4", size=(96, 160), color="red")]
+    output_path = str(workspace / "out.mp4")
+
+    segments.assemble_segments(clips, make_audio(duration=2.0), output_path, encode_profiles.get_profile("preview"))
+
+    assert ffmpeg_tools.probe_media(output_path)["duration"] > 1.5
+    assert len(spans("assembly.segment")) == 2
+    assert all(span["encode_fps"] > 0 for span in spans("assembly.segment"))
+    assert spans("assembly.segments")[0]["encode_fps"] > 0
+
+
+def test_changing_one_clip_only_re_encodes_its_segment(workspace, make_clip, make_audio):
+    profile = encode_profiles.get_profile("preview")
+    clips = [make_clip("a.mp4"), make_clip("b.mp4", color="red"), make_clip("c.mp4", color="green", size=(96, 160))]
+    audio_path = make_audio(duration=3.0)
+    segments.assemble_segments(clips, audio_path, str(workspace / "first.mp4"), profile)
+
+    # The regenerated clip has new content under the same path
+    make_clip("b.mp4", color="yellow")
+    segments.assemble_segments(clips, audio_path, str(workspace / "second.mp4"), profile)
+
+    assert [span["reused_segments"] for span in spans("assembly.segments")] == [0, 2]
+    assert len(spans("assembly.segment")) == 4
+
+
+def test_segment_cache_key_follows_the_retiming(workspace, make_clip):
+    profile = encode_profiles.get_profile("preview")
+    clip = make_clip("a.mp4")
+    frame = segments.target_frame([clip])
+
+    first_path, first_cached = segments.encode_segment(clip, frame, profile)
+    same_path, same_cached = segments.encode_segment(clip, frame, profile)
+    slower_path, slower_cached = segments.encode_segment(clip, frame, profile, rate=0.9, pad=0.2)
+
+    assert (first_cached, same_cached, slower_cached) == (False, True, False)
+    assert same_path == first_path != slower_path
+    assert ffmpeg_tools.probe_media(slower_path)["duration"] == pytest.approx(1 / 0.9 + 0.2, abs=0.1)
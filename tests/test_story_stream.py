@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from utils.story_stream import StoryStreamParser
+
+
+STORY = {
+    "title": "The {Brace} \"Quoted\" Tale",
+    "voiceover_text": "He wrote \\\"}{\\\" on the wall, then a backslash: \\\\ and left.",
+    "video_logline": "Nested [brackets] and {braces} in text",
+    "character": "A detective, 40 years old",
+    "visual_style": "b/w, film grain",
+    "clips": {
+        "clip1": {"character_visible": "True", "image_prompt": "A door marked }"},
+        "clip2": {"character_visible": "False", "image_prompt": "Rain \\ on {glass}"},
+        "clip3": {"character_visible": "True", "image_prompt": "An empty street"},
+    },
+    "duration": 42,
+    "tags": ["noir", "mystery"],
+}
+
+
+def feed_in_chunks(text, size):
+    parser = StoryStreamParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return parser, events
+
+
+def expected_events(story):
+    events = []
+    for key, value in story.items():
+        if key == "clips":
+            events.extend(("clip", clip_key, clip) for clip_key, clip in value.items())
+        events.append(("field", key, value))
+    return events
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, 64, 10_000])
+def test_events_do_not_depend_on_chunking(indent, size):
+    text = json.dumps(STORY, indent=indent)
+
+    parser, events = feed_in_chunks(text, size)
+
+    assert events == expected_events(STORY)
+    assert parser.done
+    assert parser.result() == STORY
+    assert parser.fields == STORY
+
+
+def test_braces_and_quotes_inside_strings_are_not_structure():
+    text = '{"title": "a } b { c", "voiceover_text": "say \\"}\\" twice \\\\", "clips": {}}'
+
+    parser, events = feed_in_chunks(text, 1)
+
+    assert events == [
+        ("field", "title", "a } b { c"),
+        ("field", "voiceover_text", 'say "}" twice \\'),
+        ("field", "clips", {}),
+    ]
+    assert parser.done
+
+
+def test_clip_is_reported_as_soon_as_it_closes():
+    parser = StoryStreamParser()
+    head = '{"character": "X", "clips": {"clip1": {"image_prompt": "one"}, "clip2": {"image_prompt": "t'
+
+    assert parser.feed(head) == [
+        ("field", "character", "X"),
+        ("clip", "clip1", {"image_prompt": "one"}),
+    ]
+    assert not parser.done
+    assert parser.feed('wo"}}}') == [
+        ("clip", "clip2", {"image_prompt": "two"}),
+        ("field", "clips", {"clip1": {"image_prompt": "one"}, "clip2": {"image_prompt": "two"}}),
+    ]
+    assert parser.done
+
+
+def test_primitive_fields_complete_at_their_delimiter():
+    parser = StoryStreamParser()
+
+    assert parser.feed('{"duration": 4') == []
+    assert parser.feed('2, "final": true') == [("field", "duration", 42)]
+    assert parser.feed("}") == [("field", "final", True)]
@@ -0,0 +1,73 @@
+import pytest
+
+import utils.timing as timing
+
+
+@pytest.fixture
+def durations(monkeypatch):
+    # Container durations by path, instead of probing real files
+    known = {}
+    monkeypatch.setattr(timing.ffmpeg_tools, "probe_media", lambda path: {"duration": known[path]})
+    return known
+
+
+def plan(durations, clips, audio):
+    paths = [f"clip_{i}.mp4" for i in range(len(clips))]
+    durations.update(zip(paths, clips))
+    durations["voiceover.mp3"] = audio
+    return timing.plan_timing(paths, "voiceover.mp3")
+
+
+def test_mismatch_within_tolerance_is_left_alone(durations):
+    result = plan(durations, [3.0, 3.0], 6.05)
+
+    assert result["aligned"]
+    assert not result["padded"]
+    assert result["rate"] == 1.0
+    assert [clip["duration"] for clip in result["clips"]] == [3.0, 3.0]
+
+
+def test_small_gap_is_covered_by_slowing_down(durations):
+    result = plan(durations, [3.0, 3.0, 3.0], 10.0)
+
+    assert not result["aligned"]
+    assert not result["padded"]
+    assert result["rate"] == pytest.approx(0.9)
+    assert result["duration"] == pytest.approx(10.0)
+    assert all(clip["pad"] == 0 for clip in result["clips"])
+
+
+def test_large_gap_is_padded_in_proportion_to_each_clip(durations):
+    result = plan(durations, [2.0, 4.0], 12.0)
+
+    rate = 1 - timing.MAX_RATE_CHANGE
+    assert result["rate"] == pytest.approx(rate)
+    assert result["padded"]
+    assert result["duration"] == pytest.approx(12.0)
+    # One rate for every clip, which keeps their relative lengths
+    assert [clip["rate"] for clip in result["clips"]] == [result["rate"]] * 2
+    pads = [clip["pad"] for clip in result["clips"]]
+    assert pads[1] == pytest.approx(2 * pads[0])
+    assert sum(pads) == pytest.approx(12.0 - 6.0 / rate)
+
+
+def test_long_video_is_sped_up_but_never_padded(durations):
+    slight = plan(durations, [5.0, 5.0], 9.0)
+    assert slight["rate"] == pytest.approx(10.0 / 9.0)
+    assert slight["duration"] == pytest.approx(9.0)
+
+    capped = plan(durations, [10.0, 10.0], 9.0)
+    assert capped["rate"] == pytest.approx(1 + timing.MAX_RATE_CHANGE)
+    assert not capped["padded"]
+    # The video keeps running past the voiceover
+    assert capped["duration"] == pytest.approx(20.0 / 1.15)
+
+
+def test_missing_durations_do_not_retime(durations):
+    silent = plan(durations, [3.0], None)
+    assert silent["aligned"]
+    assert silent["audio_duration"] == 0
+
+    empty = plan(durations, [None], 5.0)
+    assert empty["aligned"]
+    assert empty["clips"][0]["pad"] == 0.0
@@ -0,0 +1,139 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Generated assets are evicted least-recently-used first once the cached
+# files under media/ grow past this size.
+DEFAULT_MAX_BYTES = int(os.environ.get("XFICTION_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+DEFAULT_INDEX_PATH = "media/cache_index.json"
+
+
+def cache_key(kind, **params):
+    """
+    Build a content-addressed key for a generation request.
+
+    :param kind: Asset kind, e.g. 'image', 'clip' or 'voiceover'.
+    :param params: Every parameter that influences the output (model, prompt, size, ...).
+    :return: Hex digest identifying the request.
+    """
+    payload = json.dumps({"kind": kind, **params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AssetCache:
+    """
+    On-disk index of generated assets keyed by cache_key.
+
+    The index is a compact JSON file mapping each key to [path, size, last_access].
+    It is re-read and rewritten under a file lock on every change, so the app
+    and the worker processes can share one cache; a thread lock does the same
+    for the threads of the concurrent pipeline. Without fcntl, e.g. on Windows,
+    only the thread lock is taken.
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked_entries(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        with self._lock, open(f"{self.index_path}.lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path, "r") as f:
+                    entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                entries = {}
+
+            yield entries
+
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f, separators=(",", ":"))
+            os.replace(tmp_path, self.index_path)
+
+    def lookup(self, key):
+        """
+        Return the cached path for a key, or None on a miss.
+
+        :param key: Key built with cache_key.
+        :return: Path to the cached asset or None.
+        """
+        with self._locked_entries() as entries:
+            entry = entries.get(key)
+            if entry and os.path.exists(entry[0]):
+                entry[2] = time.time()
+                self.hits += 1
+                return entry[0]
+
+            if entry:
+                # The file was removed behind our back, forget about it
+                del entries[key]
+            self.misses += 1
+            return None
+
+    def store(self, key, path):
+        """
+        Register a freshly generated asset and evict old ones if over budget.
+
+        :param key: Key built with cache_key.
+        :param path: Path to the generated asset.
+        :return: The path, for chaining.
+        """
+        with self._locked_entries() as entries:
+            entries[key] = [str(path), os.path.getsize(path), time.time()]
+            self._evict(entries, keep=key)
+        return path
+
+    def _evict(self, entries, keep=None):
+        total = sum(entry[1] for entry in entries.values())
+        if total <= self.max_bytes:
+            return
+
+        for key, entry in sorted(entries.items(), key=lambda item: item[1][2]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(entry[0])
+            except FileNotFoundError:
+                pass
+            total -= entry[1]
+            del entries[key]
+
+    def stats(self):
+        """Return this process's hit/miss counters and the current cache size."""
+        with self._locked_entries() as entries:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(entries),
+                "bytes": sum(entry[1] for entry in entries.values()),
+            }
+
+
+default_cache = AssetCache()
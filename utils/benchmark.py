@@ -0,0 +1,340 @@
+import argparse
+import asyncio
+import inspect
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import utils.asset_cache as asset_cache
+import utils.pipeline as pipeline
+import utils.providers as providers
+import utils.segments as segments
+
+
+# End-to-end benchmark of the generation pipeline against the offline
+# providers. Every run goes through the same functions as a real job and
+# records wall time, CPU time and peak RSS per stage.
+BENCHMARK_DIRECTORY = "media/reports/benchmarks"
+STAGES = ("story", "tts", "image", "clip", "assembly")
+
+# A configuration is flagged as a regression when its total wall time grows
+# by more than this factor compared to the baseline
+REGRESSION_THRESHOLD = 1.2
+
+# Entry points whose import time is measured with --imports, and the slow
+# packages they should only load on first use
+IMPORT_TARGETS = ("main", "utils.job_queue", "utils.pipeline", "utils.gallery")
+HEAVY_MODULES = ("moviepy", "imageio", "numpy", "PIL", "openai", "replicate", "requests", "httpx")
+
+
+def _rss_bytes():
+    # Current resident set size of this process, read from /proc on Linux
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (FileNotFoundError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageRecorder:
+    """
+    Collect timings of the calls made for each stage.
+
+    RSS is sampled by a background thread while at least one call of a stage
+    is running, so concurrent stages each see the peak of their own window.
+    """
+
+    def __init__(self, sample_interval=0.01):
+        self.sample_interval = sample_interval
+        self.calls = {stage: [] for stage in STAGES}
+        self._active = {stage: 0 for stage in STAGES}
+        self._peak_rss = {stage: 0 for stage in STAGES}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = _rss_bytes()
+            with self._lock:
+                for stage, active in self._active.items():
+                    if active:
+                        self._peak_rss[stage] = max(self._peak_rss[stage], rss)
+
+    def wrap(self, stage, func):
+        """Return func instrumented to record its calls under stage, keeping coroutine functions coroutines."""
+        if inspect.iscoroutinefunction(func):
+            async def timed_async(*args, **kwargs):
+                # The thread time of the event loop would include every other
+                # task, so only the CPU of child processes is counted
+                call = self._start(stage, thread_time=False)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._finish(stage, call)
+            return timed_async
+
+        def timed(*args, **kwargs):
+            call = self._start(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._finish(stage, call)
+        return timed
+
+    def _start(self, stage, thread_time=True):
+        with self._lock:
+            self._active[stage] += 1
+            self._peak_rss[stage] = max(self._peak_rss[stage], _rss_bytes())
+        return {
+            "start": time.perf_counter(),
+            "thread_cpu": time.thread_time() if thread_time else None,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN),
+        }
+
+    def _finish(self, stage, call):
+        children, children_after = call["children"], resource.getrusage(resource.RUSAGE_CHILDREN)
+        # Child CPU covers the ffmpeg processes; it is process-wide, so
+        # with concurrent stages it is attributed to whoever finishes first
+        cpu = (children_after.ru_utime - children.ru_utime) + (children_after.ru_stime - children.ru_stime)
+        if call["thread_cpu"] is not None:
+            cpu += time.thread_time() - call["thread_cpu"]
+        with self._lock:
+            self._active[stage] -= 1
+            self.calls[stage].append({
+                "start": call["start"],
+                "end": time.perf_counter(),
+                "cpu": cpu,
+            })
+
+    def summary(self):
+        """Return per-stage totals as a JSON-serializable dict."""
+        result = {}
+        for stage, calls in self.calls.items():
+            if not calls:
+                continue
+            result[stage] = {
+                "calls": len(calls),
+                "wall_span": max(call["end"] for call in calls) - min(call["start"] for call in calls),
+                "wall_sum": sum(call["end"] - call["start"] for call in calls),
+                "cpu_time": sum(call["cpu"] for call in calls),
+                "peak_rss_mb": self._peak_rss[stage] / 1024 ** 2,
+            }
+        return result
+
+
+def run_once(nb_clips, image_dimension, concurrency, latency_scale=0.0):
+    """
+    Run one offline story through the pipeline and measure every stage.
+
+    :param nb_clips: Number of clips in the story.
+    :param image_dimension: DALL-E size of the clip images, which sets the clip resolution.
+    :param concurrency: Per-provider concurrency limit.
+    :param latency_scale: Multiplier of the simulated provider latencies.
+    :return: Dict with the configuration, total wall time and per-stage results.
+    """
+    # Imported here so that importing the benchmark stays cheap
+    import main
+
+    providers.use_offline_providers(latency_scale=latency_scale)
+    providers.get_provider("llm").nb_clips = nb_clips
+
+    # Use a private cache and a unique prompt so nothing is served from earlier runs.
+    # Assembly segments go to the run directory too, as the private cache index
+    # is deleted with it and could never evict them.
+    run_directory = tempfile.mkdtemp(prefix="xfiction_bench_")
+    shared_cache = asset_cache.default_cache
+    shared_segment_directory = segments.SEGMENT_DIRECTORY
+    asset_cache.default_cache = asset_cache.AssetCache(os.path.join(run_directory, "cache_index.json"))
+    segments.SEGMENT_DIRECTORY = os.path.join(run_directory, "segments")
+    produced_paths = []
+
+    try:
+        with StageRecorder() as recorder:
+            start = time.perf_counter()
+
+            story_json = recorder.wrap("story", main.generate_story)(f"Benchmark story {uuid.uuid4().hex}")
+            story_json_dict = json.loads(story_json)
+
+            speech_path, video_paths = asyncio.run(pipeline.render_story_assets(
+                story_json_dict,
+                recorder.wrap("tts", main.generate_voiceover),
+                recorder.wrap("image", lambda prompt: main.get_image_from_DALL_E_3_API(prompt, image_dimension=image_dimension)),
+                recorder.wrap("clip", main.get_video_from_Replicate_API),
+                on_media=lambda key, path: produced_paths.append(path),
+                concurrency={"images": concurrency, "videos": concurrency, "tts": concurrency},
+            ))
+
+            output_path = os.path.join(run_directory, "output.mp4")
+            recorder.wrap("assembly", main.combine_videos_and_audio)(video_paths, speech_path, output_path)
+            wall_time = time.perf_counter() - start
+    finally:
+        asset_cache.default_cache = shared_cache
+        segments.SEGMENT_DIRECTORY = shared_segment_directory
+        for path in produced_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+    return {
+        "nb_clips": nb_clips,
+        "image_dimension": image_dimension,
+        "concurrency": concurrency,
+        "latency_scale": latency_scale,
+        "wall_time": wall_time,
+        "stages": recorder.summary(),
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except FileNotFoundError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def run_sweep(clip_counts, image_dimensions, concurrencies, repeats=1, latency_scale=0.0):
+    """
+    Run the benchmark for every combination of the swept parameters.
+
+    :return: Dict with the environment and one result per run.
+    """
+    results = []
+    for nb_clips, image_dimension, concurrency in itertools.product(clip_counts, image_dimensions, concurrencies):
+        for _ in range(repeats):
+            result = run_once(nb_clips, image_dimension, concurrency, latency_scale)
+            results.append(result)
+            stages = ", ".join(f"{stage} {infos['wall_span']:.2f}s" for stage, infos in result["stages"].items())
+            print(f"clips={nb_clips} size={image_dimension} concurrency={concurrency}: {result['wall_time']:.2f}s ({stages})")
+    return {"environment": _environment(), "results": results}
+
+
+def _config_key(result):
+    return (result["nb_clips"], result["image_dimension"], result["concurrency"], result["latency_scale"])
+
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare a report with a baseline report and print the slowdowns.
+
+    :return: List of configurations slower than threshold times the baseline.
+    """
+    def best_times(results):
+        times = {}
+        for result in results:
+            key = _config_key(result)
+            times[key] = min(times.get(key, float("inf")), result["wall_time"])
+        return times
+
+    current, previous = best_times(report["results"]), best_times(baseline["results"])
+    regressions = []
+    for key in sorted(current.keys() & previous.keys()):
+        ratio = current[key] / previous[key]
+        flag = "REGRESSION" if ratio > threshold else "ok"
+        print(f"clips={key[0]} size={key[1]} concurrency={key[2]}: {previous[key]:.2f}s -> {current[key]:.2f}s (x{ratio:.2f}) {flag}")
+        if ratio > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def measure_import(module, repeats=3):
+    """
+    Import a module in fresh interpreters and measure what it costs.
+
+    :param module: Dotted name of the module.
+    :param repeats: Number of interpreters, the fastest one is reported.
+    :return: Dict with module, seconds, nb_modules, the HEAVY_MODULES it loaded
+        and its five slowest direct imports as [name, seconds] pairs.
+    """
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))"
+    )
+    best = None
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True, check=True)
+        run = json.loads(result.stdout.strip().splitlines()[-1])
+        if best is None or run["seconds"] < best[0]["seconds"]:
+            best = (run, result.stderr)
+    run, importtime = best
+
+    # -X importtime prints "import time: self | cumulative | name", nested
+    # imports being indented by two more spaces per level
+    direct_imports = []
+    for line in importtime.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[2].startswith("   ") and not fields[2].startswith("     "):
+            direct_imports.append([fields[2].strip(), int(fields[1]) / 1e6])
+    loaded = {name.split(".")[0] for name in run["modules"]}
+    return {
+        "module": module,
+        "seconds": run["seconds"],
+        "nb_modules": len(run["modules"]),
+        "heavy": [name for name in HEAVY_MODULES if name in loaded],
+        "slowest": sorted(direct_imports, key=lambda item: -item[1])[:5],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the X-Fiction pipeline with the offline providers")
+    parser.add_argument("--clips", type=int, nargs="+", default=[1, 3, 6], help="clip counts to sweep")
+    parser.add_argument("--sizes", nargs="+", default=["1024x1024", "1024x1792"], help="image sizes to sweep")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 6], help="per-provider concurrency to sweep")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per configuration")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="offline provider latency multiplier")
+    parser.add_argument("--output", help="result file, defaults to media/reports/benchmarks/bench_<time>.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="baseline result file to compare against")
+    parser.add_argument("--imports", action="store_true", help="only measure the import time of the entry points")
+    args = parser.parse_args()
+
+    if args.imports:
+        for target in IMPORT_TARGETS:
+            result = measure_import(target)
+            print(f"{target}: {result['seconds'] * 1000:.0f} ms, {result['nb_modules']} modules, heavy: {', '.join(result['heavy']) or 'none'}")
+            for name, seconds in result["slowest"]:
+                print(f"    {name}: {seconds * 1000:.0f} ms")
+        return
+
+    report = run_sweep(args.clips, args.sizes, args.concurrency, args.repeats, args.latency_scale)
+
+    output_path = args.output or os.path.join(BENCHMARK_DIRECTORY, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output_path}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(report, baseline):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
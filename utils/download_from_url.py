@@ -1,5 +1,192 @@
-import requests
-from pathlib import Path
+import asyncio
+import os
+import random
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+import utils.tracing as tracing
+
+
+# Every asset fetch (DALL-E images, SVD clips) goes through one pooled
+# httpx.AsyncClient running on a dedicated event loop thread. Connections
+# are kept alive and reused across clips, jobs and asyncio.run calls instead
+# of paying a new TLS handshake per download.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+MAX_CONNECTIONS = 32
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_RETRIES = 3
+# Seconds before the first retry, doubled on every attempt
+BACKOFF_BASE = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_loop = None
+_client = None
+_host_limits = {}
+
+
+def _get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="download-client", daemon=True).start()
+        return _loop
+
+
+def _get_client():
+    # Only called on the download loop, so no locking is needed
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=TIMEOUT,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+    return _client
+
+
+def _host_limit(url):
+    host = urlsplit(url).netloc
+    if host not in _host_limits:
+        _host_limits[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+    return _host_limits[host]
+
+
+def _retry_delay(attempt, response=None):
+    # Honour Retry-After from throttled responses, otherwise back off exponentially with jitter
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return BACKOFF_BASE * 2 ** attempt * (0.5 + random.random())
+
+
+async def _fetch(url, output_path=None):
+    with tracing.span("download", host=urlsplit(url).netloc) as download_span:
+        async with _host_limit(url):
+            for attempt in range(MAX_RETRIES + 1):
+                download_span.set(attempts=attempt + 1)
+                response = None
+                try:
+                    async with _get_client().stream("GET", url) as response:
+                        download_span.set(status_code=response.status_code, http_version=response.http_version)
+                        if response.status_code == 200:
+                            return await _read_body(response, output_path, download_span)
+                except httpx.TransportError as e:
+                    print(f"Download attempt {attempt + 1} failed: {e!r}")
+                    response = None
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        break
+
+                if attempt < MAX_RETRIES:
+                    await asyncio.sleep(_retry_delay(attempt, response))
+
+    status = response.status_code if response is not None else "no response"
+    print(f"Failed to download {url}. Status code: {status}")
+    return None
+
+
+async def _read_body(response, output_path, download_span):
+    if output_path is None:
+        body = await response.aread()
+        download_span.set(bytes=len(body))
+        return body
+
+    # Write next to the target and rename at the end, so an interrupted
+    # download never leaves a truncated file under the final name
+    nb_bytes = 0
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, "wb") as output_file:
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            output_file.write(chunk)
+            nb_bytes += len(chunk)
+    os.replace(tmp_path, output_path)
+    download_span.set(bytes=nb_bytes)
+    return output_path
+
+
+async def _with_parent(coroutine, parent):
+    with tracing.attach(parent):
+        return await coroutine
+
+
+def _submit(coroutine):
+    # The loop runs on its own thread, so the caller's span is handed over
+    # explicitly and download spans stay in the trace of the job they serve
+    return asyncio.run_coroutine_threadsafe(_with_parent(coroutine, tracing.current_span()), _get_loop())
+
+
+def submit(coroutine):
+    """
+    Run a coroutine on the shared client's event loop.
+
+    :param coroutine: Coroutine that may use request and async_download_to_file.
+    :return: concurrent.futures.Future of its result.
+    """
+    return _submit(coroutine)
+
+
+async def request(method, url, **kwargs):
+    """
+    Send an API request with the shared client, retrying transport errors and throttled responses.
+
+    Must be awaited on the shared client's event loop, see submit.
+
+    :param method: HTTP method.
+    :param url: Request URL.
+    :param kwargs: Keyword arguments for httpx.AsyncClient.request, e.g. json or headers.
+    :return: The httpx.Response of the last attempt.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            async with _host_limit(url):
+                response = await _get_client().request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"{method} {url} attempt {attempt + 1} failed: {e!r}")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                return response
+        await asyncio.sleep(_retry_delay(attempt, response))
+
+
+def download_to_file(url, output_path):
+    """
+    Download a URL to a file through the shared connection pool.
+
+    :param url: URL to download.
+    :param output_path: Path where the file will be saved.
+    :return: The output path, or None if the download failed after retries.
+    """
+    return _submit(_fetch(str(url), str(output_path))).result()
+
+
+def download_bytes(url):
+    """
+    Download a URL into memory through the shared connection pool.
+
+    :param url: URL to download.
+    :return: The response body, or None if the download failed after retries.
+    """
+    return _submit(_fetch(str(url))).result()
+
+
+async def async_download_to_file(url, output_path):
+    """Awaitable version of download_to_file, usable from any event loop."""
+    return await asyncio.wrap_future(_submit(_fetch(str(url), str(output_path))))
+
 
 def download_video_from_url(url, output_path):
     """
@@ -9,17 +196,11 @@ def download_video_from_url(url, output_path):
     :param output_path: Path where the video file will be saved.
     :return: Path to the saved video file.
     """
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(output_path, "wb") as video_file:
-            for chunk in response.iter_content(chunk_size=1024 * 1024):  # Downloading in chunks of 1 MB
-                video_file.write(chunk)
-        return output_path
-    else:
-        print(f"Failed to download video. Status code: {response.status_code}")
-        return None
-
-# Example usage
-video_url = "https://replicate.delivery/pbxt/TbxBrGUhebScPSMs53TgNew2xcwQnHo4fDeb3LIIdRA7jWLIB/000021.mp4"  # Replace with the actual video URL
-output_video_path = "media/clips/my_video.mp4"  # Replace with your desired output path
-download_video_from_url(video_url, output_video_path)
+    return download_to_file(url, output_path)
+
+
+if __name__ == "__main__":
+    # Example usage
+    video_url = "https://replicate.delivery/pbxt/TbxBrGUhebScPSMs53TgNew2xcwQnHo4fDeb3LIIdRA7jWLIB/000021.mp4"  # Replace with the actual video URL
+    output_video_path = "media/clips/my_video.mp4"  # Replace with your desired output path
+    download_video_from_url(video_url, output_video_path)
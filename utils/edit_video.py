@@ -1,12 +1,178 @@
 
-from moviepy.editor import VideoFileClip, CompositeVideoClip, AudioFileClip, concatenate_videoclips
-
-import numpy as np
+import concurrent.futures
+import math
 import os
+import subprocess
+import tempfile
+import time
+
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.tracing as tracing
+
+
+
+# Height of the avatar as a fraction of the background video
+AVATAR_SCALE = 4
+OUTPUT_PATH = 'media/react/final.mp4'
+# Parallel encodes of a long reaction video, each one an ffmpeg process
+REACT_WORKERS = int(os.environ.get("XFICTION_REACT_WORKERS") or os.cpu_count() or 1)
+# Shortest piece of the timeline worth its own encode
+MIN_CHUNK_SECONDS = 10
 
 
+def assemble_video(gen_path, original_video_path, audio_path, profile=None, workers=None):
+    """
+    Overlay the avatar video on the original video and add the audio.
 
-def assemble_video(gen_path, original_video_path, audio_path):
+    Long videos are cut into chunks that are composited and encoded in
+    parallel, then joined without re-encoding.
+
+    :param profile: Encode profile name from utils/encode_profiles.py, defaults to XFICTION_ENCODE_PROFILE.
+    :param workers: Number of chunks encoded at once, defaults to XFICTION_REACT_WORKERS or the number of cores.
+    :return: Achieved encode speed in frames per second.
+    """
+    profile = encode_profiles.get_profile(profile)
+    workers = workers or REACT_WORKERS
+    os.makedirs('media/react', exist_ok=True)
+
+    # The original video loops for the full length of the avatar video, read
+    # from the container header; ffmpeg restarts it as often as needed.
+    background = ffmpeg_tools.probe_media(original_video_path)
+    duration = ffmpeg_tools.probe_media(gen_path)["duration"]
+    nb_chunks = max(1, min(workers, int(duration // MIN_CHUNK_SECONDS)))
+
+    with tracing.span("react.assemble", profile=profile["name"], threads=profile["threads"], chunks=nb_chunks) as encode_span:
+        start = time.perf_counter()
+        try:
+            if nb_chunks > 1:
+                overlay_video_parallel(gen_path, original_video_path, audio_path, OUTPUT_PATH, duration, background, profile, nb_chunks)
+            else:
+                overlay_video(gen_path, original_video_path, audio_path, OUTPUT_PATH, duration, background, profile)
+            encode_fps = duration * (background["fps"] or 25) / (time.perf_counter() - start)
+            print(f"Encoded {OUTPUT_PATH} with the {profile['name']} profile at {encode_fps:.1f} fps")
+            encode_span.set(compositor="ffmpeg")
+        except subprocess.CalledProcessError as e:
+            print(f"Overlay filter graph failed, compositing with MoviePy: {e.stderr}")
+            encode_fps = _assemble_with_moviepy(gen_path, original_video_path, audio_path, duration, profile)
+            encode_span.set(compositor="moviepy")
+        encode_span.set(encode_fps=encode_fps)
+    return encode_fps
+
+
+def overlay_video(gen_path, original_video_path, audio_path, output_path, duration, background, profile, start=0.0, threads=None):
+    """
+    Composite the avatar over the looping original video with one ffmpeg filter graph.
+
+    Frames stream through ffmpeg's decoders, scaler and overlay filter, so
+    memory stays constant whatever the length and resolution of the inputs.
+
+    :param audio_path: Path of the voiceover, or None for a silent video.
+    :param duration: Length of the output, that of the avatar video.
+    :param background: probe_media infos of the original video.
+    :param profile: Dict from encode_profiles.get_profile.
+    :param start: Time in the avatar video to start from, for a chunk of the timeline.
+    :param threads: Encoder threads, defaults to the profile's.
+    :return: Path to the output video.
+    """
+    # The background loops, so the chunk starts at the matching point of its cycle
+    offset = start % background["duration"] if start and background["duration"] else 0.0
+    if offset:
+        # -stream_loop restarts at the seek point rather than at the beginning,
+        # so the seeked pass is followed by a separate looping input
+        inputs = ["-ss", _seek_time(offset), "-i", original_video_path, "-stream_loop", "-1", "-i", original_video_path]
+        filters = ["[0:v][1:v]concat=n=2:v=1:a=0[background]"]
+        background_label, avatar_index = "[background]", 2
+    else:
+        # The background is looped by the demuxer, without extra copies
+        inputs = ["-stream_loop", "-1", "-i", original_video_path]
+        filters = []
+        background_label, avatar_index = "[0:v]", 1
+    inputs += ["-ss", _seek_time(start), "-i", gen_path] if start else ["-i", gen_path]
+
+    # The avatar goes to the bottom right corner at a quarter of the background height
+    avatar_height = background["height"] // AVATAR_SCALE // 2 * 2
+    filters.append(f"[{avatar_index}:v]scale=-2:{avatar_height}[avatar]")
+    overlay = f"{background_label}[avatar]overlay=W-w:H-h:eof_action=pass"
+    if profile["max_height"] and background["height"] > profile["max_height"]:
+        overlay += f",scale=-2:{profile['max_height']}"
+    filters.append(overlay + "[video]")
+
+    if audio_path:
+        inputs += ["-i", audio_path]
+        audio_args = ["-map", f"{avatar_index + 1}:a:0"]
+    else:
+        audio_args = ["-an"]
+
+    subprocess.run(
+        [
+            ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+            *inputs,
+            "-filter_complex", ";".join(filters),
+            "-map", "[video]", *audio_args,
+            *encode_profiles.ffmpeg_output_args({**profile, "threads": threads or profile["threads"]}),
+            # The frame count keeps chunks exact, -t cuts the audio
+            "-frames:v", str(round(duration * (background["fps"] or 25))), "-t", f"{duration:.3f}",
+            output_path,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return output_path
+
+
+def overlay_video_parallel(gen_path, original_video_path, audio_path, output_path, duration, background, profile, nb_chunks):
+    """
+    Composite and encode chunks of the timeline in parallel, then join them.
+
+    The timeline is cut at keyframes of the avatar video, so every chunk
+    starts decoding right at its first frame. Each chunk is encoded as a
+    silent video by its own ffmpeg process; the chunks are then joined with
+    a stream copy and the voiceover is added in one piece.
+
+    :param nb_chunks: Number of chunks, all encoded at once.
+    :return: Path to the output video.
+    """
+    cuts = _chunk_boundaries(ffmpeg_tools.keyframe_times(gen_path), duration, nb_chunks, background["fps"] or 25)
+    # The cores are shared between the chunks
+    threads = max(1, profile["threads"] // (len(cuts) - 1))
+
+    with tempfile.TemporaryDirectory(prefix="chunks_", dir=os.path.dirname(output_path) or ".") as chunk_directory:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(cuts) - 1) as executor:
+            futures = [
+                executor.submit(
+                    overlay_video, gen_path, original_video_path, None, os.path.join(chunk_directory, f"chunk_{i:03d}.mp4"),
+                    end - start, background, profile, start, threads,
+                )
+                for i, (start, end) in enumerate(zip(cuts, cuts[1:]))
+            ]
+            chunk_paths = [future.result() for future in futures]
+        ffmpeg_tools.concat_stream_copy(chunk_paths, audio_path, output_path, audio_bitrate=profile["audio_bitrate"])
+    return output_path
+
+
+def _seek_time(seconds):
+    # ffmpeg reads times in microseconds. Rounding down keeps the frame at
+    # exactly that time, which a rounded up time would skip.
+    return f"{math.floor(seconds * 1e6) / 1e6:.6f}"
+
+
+def _chunk_boundaries(keyframes, duration, nb_chunks, fps):
+    # Snap evenly spaced cuts to the nearest keyframe, then to the output frame
+    # grid so no frame is dropped or doubled at a cut
+    cuts = [0.0]
+    for i in range(1, nb_chunks):
+        target = duration * i / nb_chunks
+        cut = min(keyframes, key=lambda keyframe: abs(keyframe - target)) if keyframes else target
+        cut = round(cut * fps) / fps
+        if cuts[-1] < cut < duration:
+            cuts.append(cut)
+    return cuts + [duration]
+
+
+def _assemble_with_moviepy(gen_path, original_video_path, audio_path, duration, profile):
+    # MoviePy is slow to import and only needed by this fallback
+    from moviepy.editor import VideoFileClip, CompositeVideoClip, AudioFileClip
 
     # Load the original video, the avatar video, and the audio
     original_video = VideoFileClip(original_video_path)
@@ -16,18 +182,11 @@ def assemble_video(gen_path, original_video_path, audio_path):
     # Lower the volume of the original video
     original_video = original_video.volumex(0.1)  # Adjust the volume level as needed
 
-    # Check if the avatar video is longer than the original video
-    if avatar_video.duration > original_video.duration:
-        # Calculate how many times the original video needs to be repeated
-        repeat_times = int(np.ceil(avatar_video.duration / original_video.duration))
-        # Repeat the original video
-        original_video = concatenate_videoclips([original_video] * repeat_times)
-
     # Make the original video loop for the full length of the avatar video
-    original_video = original_video.loop(duration=avatar_video.duration)
+    original_video = original_video.loop(duration=duration)
 
     # Resize the avatar video to the desired size and position it at the bottom right corner
-    avatar_video = avatar_video.resize(height=original_video.h // 4).set_position(('right', 'bottom'))
+    avatar_video = avatar_video.resize(height=original_video.h // AVATAR_SCALE).set_position(('right', 'bottom'))
 
     # Overlay the avatar video on the original video
     composite_video = CompositeVideoClip([original_video, avatar_video])
@@ -36,11 +195,11 @@ def assemble_video(gen_path, original_video_path, audio_path):
     composite_video = composite_video.set_audio(audio)
 
     # Write the final video to a file
-    os.makedirs('media/react', exist_ok=True)
-    composite_video.write_videofile('media/react/final.mp4')
+    return encode_profiles.write_videofile(composite_video, OUTPUT_PATH, profile)
 
 
 def edit_video():
+    from moviepy.editor import VideoFileClip
 
     input = VideoFileClip("data/input_video.mp4")
     avatar = VideoFileClip("data/avatar.mp4")
@@ -0,0 +1,84 @@
+import os
+import time
+
+
+# Named x264/AAC settings for every render. "preview" trades quality for speed
+# and a lower resolution, "final" spends CPU on a slower preset at constant
+# quality. Encodes use every core unless XFICTION_ENCODE_THREADS says otherwise.
+ENCODE_PROFILES = {
+    "preview": {
+        "preset": "ultrafast",
+        "crf": 30,
+        "audio_bitrate": "96k",
+        "pix_fmt": "yuv420p",
+        # Output height cap, None keeps the source resolution
+        "max_height": 480,
+    },
+    "final": {
+        "preset": "slow",
+        "crf": 20,
+        "audio_bitrate": "192k",
+        "pix_fmt": "yuv420p",
+        "max_height": None,
+    },
+}
+DEFAULT_PROFILE = os.environ.get("XFICTION_ENCODE_PROFILE", "final")
+
+
+def get_profile(name=None):
+    """
+    Return the settings of an encode profile, with the thread count filled in.
+
+    :param name: Profile name, defaults to XFICTION_ENCODE_PROFILE or 'final'.
+    :return: Dict with preset, crf, audio_bitrate, pix_fmt, max_height and threads.
+    """
+    name = name or DEFAULT_PROFILE
+    if name not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile '{name}', available: {sorted(ENCODE_PROFILES)}")
+    return {
+        **ENCODE_PROFILES[name],
+        "name": name,
+        "threads": int(os.environ.get("XFICTION_ENCODE_THREADS") or os.cpu_count() or 1),
+    }
+
+
+def ffmpeg_output_args(profile):
+    """Return the ffmpeg output options of a profile, for renders that call ffmpeg directly."""
+    return [
+        "-c:v", "libx264", "-preset", profile["preset"], "-crf", str(profile["crf"]),
+        "-pix_fmt", profile["pix_fmt"], "-threads", str(profile["threads"]),
+        "-c:a", "aac", "-b:a", profile["audio_bitrate"],
+        "-movflags", "+faststart",
+    ]
+
+
+def write_videofile(clip, output_path, profile=None):
+    """
+    Encode a MoviePy clip with an encode profile.
+
+    :param clip: MoviePy clip to write.
+    :param output_path: Path of the output MP4.
+    :param profile: Profile name or dict from get_profile.
+    :return: Achieved encode speed in frames per second.
+    """
+    if not isinstance(profile, dict):
+        profile = get_profile(profile)
+
+    ffmpeg_params = ["-crf", str(profile["crf"]), "-pix_fmt", profile["pix_fmt"], "-movflags", "+faststart"]
+    if profile["max_height"] and clip.h > profile["max_height"]:
+        # Scaled by ffmpeg on the way out rather than frame by frame in Python
+        ffmpeg_params += ["-vf", f"scale=-2:{profile['max_height']}"]
+
+    start = time.perf_counter()
+    clip.write_videofile(
+        output_path,
+        codec="libx264",
+        audio_codec="aac",
+        audio_bitrate=profile["audio_bitrate"],
+        preset=profile["preset"],
+        threads=profile["threads"],
+        ffmpeg_params=ffmpeg_params,
+    )
+    encode_fps = clip.duration * clip.fps / (time.perf_counter() - start)
+    print(f"Encoded {output_path} with the {profile['name']} profile at {encode_fps:.1f} fps")
+    return encode_fps
@@ -0,0 +1,231 @@
+import argparse
+import email.parser
+import email.policy
+import http.server
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+import utils.providers as providers
+
+
+# Local stand-in for the parts of the Replicate HTTP API used by
+# utils.predictions: file uploads, prediction creation, status and
+# cancellation, webhooks and output files. Predictions turn the uploaded image
+# into a clip with the offline video backend after a configurable delay. Point
+# the app at it with
+#   XFICTION_REPLICATE_API_URL=http://127.0.0.1:8787/v1 REPLICATE_API_TOKEN=fake
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    # Hundreds of predictions can be created at once
+    request_queue_size = 256
+
+
+class FakeReplicateServer:
+    """
+    Fake Replicate API served from a background thread.
+
+    :param port: Port to listen on, 0 for any free port.
+    :param latency: Seconds a prediction takes to complete.
+    :param failure_rate: Probability in [0, 1] that a prediction fails.
+    :param throttle_rate: Probability in [0, 1] that a prediction creation is rejected with a 429.
+    """
+
+    def __init__(self, port=0, latency=5.0, failure_rate=0.0, throttle_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.directory = tempfile.mkdtemp(prefix="fake_replicate_")
+        self.predictions = {}
+        self.status_requests = 0
+        self.canceled = []
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._server = _Server(("127.0.0.1", port), self._handler_class())
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self.api_url = f"{self.url}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-replicate", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _store_upload(self, content_type, body):
+        # Parse the multipart body with the email parser, since cgi is gone from the stdlib
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        part = next(message.iter_parts())
+        name = f"{uuid.uuid4().hex}{os.path.splitext(part.get_filename() or '')[1]}"
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(part.get_payload(decode=True))
+        return {"id": name, "urls": {"get": f"{self.url}/files/{name}"}}
+
+    def _create_prediction(self, body):
+        prediction_id = uuid.uuid4().hex
+        prediction = {
+            "id": prediction_id,
+            "version": body.get("version"),
+            "input": body.get("input", {}),
+            "status": "starting",
+            "output": None,
+            "error": None,
+            "metrics": {},
+            "urls": {"get": f"{self.api_url}/predictions/{prediction_id}"},
+        }
+        with self._lock:
+            self.predictions[prediction_id] = prediction
+        timer = threading.Timer(self.latency, self._complete, args=(prediction_id, body.get("webhook")))
+        # A pending prediction does not keep the process alive
+        timer.daemon = True
+        timer.start()
+        return prediction
+
+    def _cancel_prediction(self, prediction_id):
+        with self._lock:
+            prediction = self.predictions.get(prediction_id)
+            if prediction is None:
+                return None
+            if prediction["status"] not in ("succeeded", "failed", "canceled"):
+                prediction["status"] = "canceled"
+                self.canceled.append(prediction_id)
+            return dict(prediction)
+
+    def _complete(self, prediction_id, webhook):
+        prediction = self.predictions[prediction_id]
+        if prediction["status"] == "canceled":
+            return
+        start = time.perf_counter()
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+        try:
+            if failed:
+                raise providers.ProviderError("Injected prediction failure")
+            # Uploaded inputs are referenced by their URL on this server
+            image_path = os.path.join(self.directory, os.path.basename(prediction["input"]["input_image"]))
+            output_name = f"{prediction_id}.mp4"
+            providers.OfflineVideoProvider(latency_scale=0).generate(
+                image_path,
+                os.path.join(self.directory, output_name),
+                video_length=prediction["input"].get("video_length", "25_frames_with_svd_xt"),
+            )
+            update = {"status": "succeeded", "output": f"{self.url}/files/{output_name}"}
+        except Exception as e:
+            update = {"status": "failed", "error": str(e)}
+        update["metrics"] = {"predict_time": self.latency + time.perf_counter() - start}
+
+        with self._lock:
+            prediction.update(update)
+        if webhook:
+            request = urllib.request.Request(webhook, data=json.dumps(prediction).encode(), headers={"Content-Type": "application/json"})
+            try:
+                urllib.request.urlopen(request, timeout=10).close()
+            except OSError as e:
+                print(f"Webhook delivery to {webhook} failed: {e!r}")
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _authorized(self):
+                if self.headers.get("Authorization", "").startswith(("Bearer ", "Token ")):
+                    return True
+                self._send_json(401, {"detail": "Missing API token"})
+                return False
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self._authorized():
+                    return
+                if self.path == "/v1/files":
+                    self._send_json(201, server._store_upload(self.headers["Content-Type"], body))
+                elif self.path == "/v1/predictions":
+                    with server._lock:
+                        throttled = server._random.random() < server.throttle_rate
+                    if throttled:
+                        self._send_json(429, {"detail": "Request was throttled."})
+                    else:
+                        self._send_json(201, server._create_prediction(json.loads(body)))
+                elif self.path.startswith("/v1/predictions/") and self.path.endswith("/cancel"):
+                    prediction = server._cancel_prediction(self.path.split("/")[-2])
+                    if prediction:
+                        self._send_json(200, prediction)
+                    else:
+                        self._send_json(404, {"detail": "Not found"})
+                else:
+                    self._send_json(404, {"detail": "Not found"})
+
+            def do_GET(self):
+                if self.path.startswith("/files/"):
+                    path = os.path.join(server.directory, os.path.basename(self.path))
+                    if not os.path.exists(path):
+                        self._send_json(404, {"detail": "Not found"})
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(os.path.getsize(path)))
+                    self.end_headers()
+                    with open(path, "rb") as f:
+                        shutil.copyfileobj(f, self.wfile)
+                    return
+
+                if not self._authorized():
+                    return
+                prediction_id = self.path.rsplit("/", 1)[-1]
+                with server._lock:
+                    server.status_requests += 1
+                    prediction = dict(server.predictions.get(prediction_id) or {})
+                if prediction:
+                    self._send_json(200, prediction)
+                else:
+                    self._send_json(404, {"detail": "Not found"})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake of the Replicate prediction API")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=5.0, help="seconds per prediction")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeReplicateServer(args.port, args.latency, args.failure_rate, args.throttle_rate).start()
+    print(f"Fake Replicate API on {server.api_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
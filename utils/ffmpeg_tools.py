@@ -0,0 +1,166 @@
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+# Codecs that the concat demuxer can join without re-encoding into an MP4
+STREAM_COPY_CODECS = ("h264", "hevc")
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_binary():
+    """
+    Return the ffmpeg executable MoviePy is configured with.
+
+    It is resolved from FFMPEG_BINARY like moviepy.config does, but without
+    importing MoviePy, which is slow to import.
+    """
+    binary = os.environ.get("FFMPEG_BINARY", "ffmpeg-imageio")
+    if binary == "ffmpeg-imageio":
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    if binary == "auto-detect":
+        return shutil.which("ffmpeg") or shutil.which("ffmpeg.exe") or "unset"
+    return binary
+
+
+def probe_media(path):
+    """
+    Read stream information from a media file's container metadata.
+
+    Only the header is parsed, nothing is decoded.
+
+    :param path: Path to the media file.
+    :return: Dict with duration, video_codec, width, height, fps, pix_fmt and audio_codec.
+        Missing streams or fields are None.
+    """
+    stat = os.stat(path)
+    return dict(_probe_media(os.path.abspath(path), stat.st_mtime, stat.st_size))
+
+
+@functools.lru_cache(maxsize=1024)
+def _probe_media(path, mtime, size):
+    # mtime and size are part of the cache key so rewritten files are probed again
+    result = subprocess.run([ffmpeg_binary(), "-hide_banner", "-i", path], capture_output=True, text=True)
+    infos = {
+        "duration": None,
+        "video_codec": None,
+        "width": None,
+        "height": None,
+        "fps": None,
+        "pix_fmt": None,
+        "audio_codec": None,
+    }
+
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+\.\d+)", result.stderr)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        infos["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in result.stderr.splitlines():
+        if "Stream #" not in line:
+            continue
+        if "Video:" in line and infos["video_codec"] is None:
+            infos["video_codec"] = re.search(r"Video: (\w+)", line).group(1)
+            size = re.search(r", (\d{2,5})x(\d{2,5})", line)
+            if size:
+                infos["width"], infos["height"] = int(size.group(1)), int(size.group(2))
+            fps = re.search(r", ([\d.]+) fps", line)
+            if fps:
+                infos["fps"] = float(fps.group(1))
+            pix_fmt = re.search(r"Video: [^,]+, (\w+)", line)
+            if pix_fmt:
+                infos["pix_fmt"] = pix_fmt.group(1)
+        elif "Audio:" in line and infos["audio_codec"] is None:
+            infos["audio_codec"] = re.search(r"Audio: (\w+)", line).group(1)
+
+    return infos
+
+
+def keyframe_times(path):
+    """
+    List the timestamps of a video's keyframes.
+
+    Only the keyframes are decoded, the other frames are skipped.
+
+    :param path: Path to the video file.
+    :return: Sorted list of keyframe times in seconds.
+    """
+    result = subprocess.run(
+        [ffmpeg_binary(), "-hide_banner", "-skip_frame", "nokey", "-i", path, "-an", "-vf", "showinfo", "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+    )
+    return sorted(float(time) for time in re.findall(r"pts_time:\s*([\d.]+)", result.stderr))
+
+
+def can_stream_copy(video_paths):
+    """
+    Check whether videos can be joined without re-encoding.
+
+    :param video_paths: A list of paths to the video files.
+    :return: True if all videos share codec, resolution, fps and pixel format.
+    """
+    signatures = set()
+    for path in video_paths:
+        infos = probe_media(path)
+        if infos["video_codec"] not in STREAM_COPY_CODECS:
+            return False
+        signatures.add((infos["video_codec"], infos["width"], infos["height"], infos["fps"], infos["pix_fmt"]))
+    return len(signatures) == 1
+
+
+def _write_concat_list(video_paths):
+    # The concat demuxer needs single quotes escaped inside quoted paths
+    list_file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+    with list_file:
+        for path in video_paths:
+            escaped_path = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped_path}'\n")
+    return list_file.name
+
+
+def concat_stream_copy(video_paths, audio_path, output_path, audio_bitrate="192k", copy_audio=False, time_scale=1.0):
+    """
+    Join videos with the ffmpeg concat demuxer and add an audio track.
+
+    The video stream is copied as is; only the audio is encoded to AAC. The
+    output is cut to the length of the video, like the MoviePy route.
+
+    :param video_paths: A list of paths to the video files, all with the same encoding.
+    :param audio_path: Path to the audio file, or None for a silent video.
+    :param output_path: Path where the output video will be saved.
+    :param audio_bitrate: Bitrate of the AAC track.
+    :param copy_audio: True if audio_path already holds an AAC track to copy as is.
+    :param time_scale: Factor applied to the video timestamps, e.g. 1.1 to play 10% slower.
+        The frames are still copied, only their timing changes.
+    :return: Path to the output video.
+    """
+    list_path = _write_concat_list(video_paths)
+    video_duration = sum(probe_media(path)["duration"] or 0 for path in video_paths) * time_scale
+    if audio_path:
+        audio_codec = ["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", audio_bitrate]
+        audio_args = ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", *audio_codec]
+    else:
+        audio_args = ["-map", "0:v:0"]
+    try:
+        subprocess.run(
+            [
+                ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                "-itsscale", f"{time_scale:.6f}", "-f", "concat", "-safe", "0", "-i", list_path,
+                *audio_args,
+                "-c:v", "copy",
+                "-t", f"{video_duration:.3f}",
+                "-movflags", "+faststart",
+                output_path,
+            ],
+            check=True,
+            capture_output=True,
+        )
+    finally:
+        os.remove(list_path)
+
+    return output_path
@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import subprocess
+import time
+
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.jobs as jobs
+
+
+# SQLite index of the example gallery. A sync only stats the files of the
+# gallery directory, and only when the directory changed; the files of a page
+# are stat'ed again when it is shown, which catches videos rewritten in place.
+# Durations and poster frames are read once per video version, when its page
+# is first shown. A page of the gallery therefore costs the same with ten or
+# ten thousand videos, and the MP4 itself is only sent to the browser once it
+# is opened.
+GALLERY_DB_PATH = os.path.join(jobs.JOBS_DIRECTORY, "gallery.sqlite3")
+GALLERY_DIRECTORY = "media/videos"
+POSTER_DIRECTORY = "media/gallery/posters"
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+# Height of the poster frames, small enough for a grid of thumbnails
+POSTER_HEIGHT = 320
+# Position of the poster frame as a fraction of the video, past intro frames
+POSTER_POSITION = 0.2
+PAGE_SIZE = 12
+
+
+def _connect():
+    os.makedirs(os.path.dirname(GALLERY_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(GALLERY_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS videos (
+            path TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            created_at REAL NOT NULL,
+            duration REAL,
+            poster_path TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_created_at ON videos (created_at DESC)")
+    conn.execute("CREATE TABLE IF NOT EXISTS directories (directory TEXT PRIMARY KEY, mtime REAL NOT NULL)")
+    return conn
+
+
+def sync(directory=GALLERY_DIRECTORY, force=False):
+    """
+    Bring the index in line with the videos of a directory.
+
+    Files are only stat'ed, and not even that while the directory itself is
+    unchanged. Videos that were replaced lose their duration and poster,
+    which are read again when they are next shown.
+
+    :param directory: Gallery directory.
+    :param force: Rescan even if the directory did not change.
+    :return: Number of videos in the index.
+    """
+    directory_mtime = os.stat(directory).st_mtime
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT mtime FROM directories WHERE directory = ?", (directory,)).fetchone()
+        if force or row is None or row["mtime"] != directory_mtime:
+            files = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS:
+                        stat = entry.stat()
+                        files[entry.path] = (os.path.splitext(entry.name)[0], stat.st_size, stat.st_mtime)
+
+            conn.execute("BEGIN IMMEDIATE")
+            indexed = {
+                row["path"]: (row["size"], row["mtime"])
+                for row in conn.execute("SELECT path, size, mtime FROM videos WHERE path LIKE ?", (os.path.join(directory, "%"),))
+            }
+            for path in indexed.keys() - files.keys():
+                conn.execute("DELETE FROM videos WHERE path = ?", (path,))
+            for path, (title, size, mtime) in files.items():
+                if indexed.get(path) != (size, mtime):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO videos (path, title, size, mtime, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (path, title, size, mtime, mtime),
+                    )
+            conn.execute("INSERT OR REPLACE INTO directories (directory, mtime) VALUES (?, ?)", (directory, directory_mtime))
+            conn.execute("COMMIT")
+        return conn.execute("SELECT COUNT(*) FROM videos WHERE path LIKE ?", (os.path.join(directory, "%"),)).fetchone()[0]
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def list_page(page=0, page_size=PAGE_SIZE, directory=GALLERY_DIRECTORY):
+    """
+    Return one page of the gallery, newest videos first.
+
+    Videos shown for the first time get their duration and poster frame here,
+    and so do videos that changed since they were indexed. A story rendered
+    again under an existing title rewrites its file in place, which does not
+    change the directory mtime sync relies on.
+
+    :param page: Page number, starting at 0.
+    :param page_size: Number of videos per page.
+    :param directory: Gallery directory.
+    :return: List of dicts with path, title, size, mtime, created_at, duration and poster_path.
+    """
+    conn = _connect()
+    try:
+        rows = [
+            dict(row)
+            for row in conn.execute(
+                "SELECT * FROM videos WHERE path LIKE ? ORDER BY created_at DESC, path LIMIT ? OFFSET ?",
+                (os.path.join(directory, "%"), page_size, page * page_size),
+            )
+        ]
+        for video in list(rows):
+            try:
+                stat = os.stat(video["path"])
+            except FileNotFoundError:
+                # Deleted since the last sync; the next sync drops it from the index
+                rows.remove(video)
+                continue
+            if (stat.st_size, stat.st_mtime) != (video["size"], video["mtime"]):
+                video.update(size=stat.st_size, mtime=stat.st_mtime, created_at=stat.st_mtime, duration=None, poster_path=None)
+                conn.execute(
+                    "UPDATE videos SET size = ?, mtime = ?, created_at = ? WHERE path = ?",
+                    (video["size"], video["mtime"], video["created_at"], video["path"]),
+                )
+            if video["duration"] is None or not (video["poster_path"] and os.path.exists(video["poster_path"])):
+                _describe(video)
+                conn.execute(
+                    "UPDATE videos SET duration = ?, poster_path = ? WHERE path = ?",
+                    (video["duration"], video["poster_path"], video["path"]),
+                )
+        return rows
+    finally:
+        conn.close()
+
+
+def _describe(video):
+    # The duration comes from the container header, the poster from a single
+    # decoded frame
+    video["duration"] = ffmpeg_tools.probe_media(video["path"])["duration"] or 0
+    name = hashlib.sha1(f"{video['path']}:{video['size']}:{video['mtime']}".encode()).hexdigest()[:16]
+    poster_path = os.path.join(POSTER_DIRECTORY, f"{name}.jpg")
+    if not os.path.exists(poster_path):
+        os.makedirs(POSTER_DIRECTORY, exist_ok=True)
+        try:
+            subprocess.run(
+                [
+                    ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                    "-ss", f"{video['duration'] * POSTER_POSITION:.3f}", "-i", video["path"],
+                    "-frames:v", "1", "-vf", f"scale=-2:{POSTER_HEIGHT}", "-q:v", "4",
+                    poster_path,
+                ],
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"Poster extraction failed for {video['path']}: {e.stderr}")
+            poster_path = None
+    video["poster_path"] = poster_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the example gallery and time a page render")
+    parser.add_argument("--directory", default=GALLERY_DIRECTORY)
+    parser.add_argument("--pages", type=int, default=1, help="pages to render after the sync")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = sync(args.directory, force=True)
+    print(f"Indexed {count} videos in {time.perf_counter() - start:.3f}s")
+    for page in range(args.pages):
+        start = time.perf_counter()
+        videos = list_page(page, directory=args.directory)
+        print(f"Page {page}: {len(videos)} videos in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
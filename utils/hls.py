@@ -0,0 +1,212 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.media_server as media_server
+import utils.tracing as tracing
+
+
+# Final videos are also packaged as an HLS ladder, so players start on a small
+# rendition and switch up as bandwidth allows instead of downloading the full
+# resolution MP4. The source is decoded once and split into every rendition in
+# the same ffmpeg pass; each rendition is then remuxed into a faststart MP4 for
+# players without HLS support.
+HLS_DIRECTORY = "media/hls"
+# '1' or '0' to always or never package. By default videos are only packaged
+# when the media server is enabled, since the app plays ladders from it alone.
+HLS_MODE = os.environ.get("XFICTION_HLS", "auto")
+# Renditions as (short side, video bitrate cap, audio bitrate), the short side
+# being the width of the portrait story videos
+LADDER = (
+    (360, "800k", "96k"),
+    (720, "2800k", "128k"),
+    (1080, "5000k", "192k"),
+)
+SEGMENT_SECONDS = 4
+MANIFEST_NAME = "manifest.json"
+MASTER_NAME = "master.m3u8"
+
+
+def packaging_enabled():
+    """Return True if final videos should be packaged, see HLS_MODE."""
+    if HLS_MODE == "auto":
+        return media_server.MEDIA_SERVER != "off"
+    return HLS_MODE != "0"
+
+
+def ladder_directory(video_path):
+    """Return the directory the ladder of a video is written to."""
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    digest = hashlib.sha1(os.path.realpath(video_path).encode()).hexdigest()[:12]
+    slug = "".join(char if char.isalnum() else "_" for char in name)[:40]
+    return os.path.join(HLS_DIRECTORY, f"{slug}_{digest}")
+
+
+def plan_ladder(width, height):
+    """
+    Pick the renditions of a video, never upscaling it.
+
+    :return: List of dicts with name, width, height, video_bitrate and audio_bitrate.
+    """
+    short_side = min(width, height)
+    rungs = [rung for rung in LADDER if rung[0] < short_side]
+    # The top rendition keeps the source resolution, with the bitrate of the
+    # rung it falls under
+    top = next((rung for rung in LADDER if rung[0] >= short_side), LADDER[-1])
+    rungs.append((min(short_side, top[0]), top[1], top[2]))
+
+    renditions = []
+    for side, video_bitrate, audio_bitrate in rungs:
+        scale = side / short_side
+        renditions.append({
+            "name": f"{side}p",
+            "width": int(width * scale) // 2 * 2,
+            "height": int(height * scale) // 2 * 2,
+            "video_bitrate": video_bitrate,
+            "audio_bitrate": audio_bitrate,
+        })
+    return renditions
+
+
+def package_hls(video_path, profile=None):
+    """
+    Write the HLS ladder and MP4 fallbacks of a video.
+
+    :param video_path: Path of the final MP4.
+    :param profile: Encode profile name or dict, defaults to XFICTION_ENCODE_PROFILE.
+    :return: The manifest, see find_ladder, or None if packaging failed.
+    """
+    if not isinstance(profile, dict):
+        profile = encode_profiles.get_profile(profile)
+    infos = ffmpeg_tools.probe_media(video_path)
+    renditions = plan_ladder(infos["width"], infos["height"])
+    directory = ladder_directory(video_path)
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    for rendition in renditions:
+        os.makedirs(os.path.join(tmp_directory, rendition["name"]))
+
+    # Every rendition is scaled from the same decoded frames
+    filters = [f"[0:v]split={len(renditions)}" + "".join(f"[s{i}]" for i in range(len(renditions)))]
+    stream_args, stream_map = [], []
+    for i, rendition in enumerate(renditions):
+        filters.append(f"[s{i}]scale={rendition['width']}:{rendition['height']}[v{i}]")
+        stream_args += ["-map", f"[v{i}]"]
+        rate_args = [f"-maxrate:v:{i}", rendition["video_bitrate"], f"-bufsize:v:{i}", f"{2 * int(rendition['video_bitrate'][:-1])}k"]
+        if infos["audio_codec"]:
+            stream_args += ["-map", "0:a:0"]
+            rate_args += [f"-b:a:{i}", rendition["audio_bitrate"]]
+            stream_map.append(f"v:{i},a:{i},name:{rendition['name']}")
+        else:
+            stream_map.append(f"v:{i},name:{rendition['name']}")
+        stream_args += rate_args
+    # Keyframes line up across renditions so players can switch at any segment
+    gop = str(round((infos["fps"] or 25) * SEGMENT_SECONDS))
+
+    try:
+        with tracing.span("hls.package", renditions=len(renditions), profile=profile["name"]):
+            subprocess.run(
+                [
+                    ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                    "-i", video_path,
+                    "-filter_complex", ";".join(filters),
+                    *stream_args,
+                    "-c:v", "libx264", "-preset", profile["preset"], "-crf", str(profile["crf"]),
+                    "-pix_fmt", profile["pix_fmt"], "-threads", str(profile["threads"]),
+                    "-g", gop, "-keyint_min", gop, "-sc_threshold", "0",
+                    "-c:a", "aac",
+                    "-f", "hls", "-hls_time", str(SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+                    "-hls_flags", "independent_segments",
+                    # Fragmented MP4 segments play in hls.js and Safari and remux cleanly
+                    "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", "init.mp4",
+                    "-hls_segment_filename", os.path.join(tmp_directory, "%v", "segment_%03d.m4s"),
+                    "-master_pl_name", MASTER_NAME,
+                    "-var_stream_map", " ".join(stream_map),
+                    os.path.join(tmp_directory, "%v", "index.m3u8"),
+                ],
+                check=True,
+                capture_output=True,
+            )
+            for rendition in renditions:
+                # The segments are copied into the fallback, nothing is encoded again
+                subprocess.run(
+                    [
+                        ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                        "-i", os.path.join(tmp_directory, rendition["name"], "index.m3u8"),
+                        "-c", "copy", "-movflags", "+faststart",
+                        os.path.join(tmp_directory, f"{rendition['name']}.mp4"),
+                    ],
+                    check=True,
+                    capture_output=True,
+                )
+    except subprocess.CalledProcessError as e:
+        print(f"HLS packaging failed for {video_path}: {e.stderr}")
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        return None
+
+    stat = os.stat(video_path)
+    manifest = {
+        "source": os.path.realpath(video_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "master": MASTER_NAME,
+        "renditions": [
+            {**rendition, "playlist": f"{rendition['name']}/index.m3u8", "mp4": f"{rendition['name']}.mp4"}
+            for rendition in renditions
+        ],
+    }
+    with open(os.path.join(tmp_directory, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    # Players never see a half written ladder
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+    return find_ladder(video_path)
+
+
+def find_ladder(video_path):
+    """
+    Return the ladder of a video if it is up to date.
+
+    :param video_path: Path of the final MP4.
+    :return: Dict with master, the master playlist path, fallback, the path of the
+        largest MP4 fallback, and renditions, or None if the video was not packaged
+        or changed since.
+    """
+    directory = ladder_directory(video_path)
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), "r") as f:
+            manifest = json.load(f)
+        stat = os.stat(video_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (manifest["size"], manifest["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return {
+        "master": os.path.join(directory, manifest["master"]),
+        "fallback": os.path.join(directory, manifest["renditions"][-1]["mp4"]),
+        "renditions": manifest["renditions"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Package final videos as HLS ladders with MP4 fallbacks")
+    parser.add_argument("videos", nargs="+", help="MP4 files, e.g. media/videos/*.mp4")
+    parser.add_argument("--profile", help="encode profile, defaults to XFICTION_ENCODE_PROFILE")
+    parser.add_argument("--force", action="store_true", help="package videos that already have a ladder")
+    args = parser.parse_args()
+
+    for video_path in args.videos:
+        if not args.force and find_ladder(video_path):
+            continue
+        ladder = package_hls(video_path, args.profile)
+        if ladder:
+            print(f"{video_path}: {', '.join(rendition['name'] for rendition in ladder['renditions'])}")
+
+
+if __name__ == "__main__":
+    main()
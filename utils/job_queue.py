@@ -0,0 +1,316 @@
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import traceback
+import uuid
+
+import utils.hls as hls
+import utils.jobs as jobs
+import utils.pipeline as pipeline
+import utils.preview as preview
+import utils.tracing as tracing
+
+
+# SQLite-backed queue shared by the Streamlit app and the worker processes.
+# The per-stage state of each job lives in its record in utils.jobs; the
+# queue only tracks who owns a job and how far it got.
+QUEUE_DB_PATH = os.path.join(jobs.JOBS_DIRECTORY, "queue.sqlite3")
+
+# A running job whose worker has not reported progress for this many seconds
+# is considered abandoned and handed to the next free worker.
+STALE_AFTER = 15 * 60
+
+# Final videos of offline jobs are kept out of the example gallery
+OFFLINE_OUTPUT_DIRECTORY = "media/offline"
+
+
+def _connect():
+    os.makedirs(os.path.dirname(QUEUE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(QUEUE_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS queue (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            worker TEXT,
+            output_path TEXT,
+            preview_path TEXT,
+            offline INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            enqueued_at REAL NOT NULL,
+            started_at REAL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    # Queues created before previews and offline jobs existed lack the columns
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(queue)")]
+    if "preview_path" not in columns:
+        conn.execute("ALTER TABLE queue ADD COLUMN preview_path TEXT")
+    if "offline" not in columns:
+        conn.execute("ALTER TABLE queue ADD COLUMN offline INTEGER NOT NULL DEFAULT 0")
+    return conn
+
+
+def enqueue(story_prompt, offline=False):
+    """
+    Queue a story for generation by the background workers.
+
+    :param story_prompt: The story prompt.
+    :param offline: Queue the job for the offline workers, e.g. for a load test.
+        Workers only claim jobs of their own kind, so real jobs never get
+        synthetic output and offline jobs never spend API credits.
+    :return: The job id. An unfinished job for the same prompt is reused: it is
+        returned as is while it is queued or running, and queued again with
+        its story and finished stages after a failure, so only the missing
+        stages are generated.
+    """
+    job = jobs.find_resumable_job(story_prompt)
+    if job:
+        status = get_status(job["job_id"])
+        if status and status["status"] in ("queued", "running"):
+            return job["job_id"]
+        job["status"] = "queued"
+        jobs.save_job(job)
+    else:
+        job = jobs.create_job(story_prompt, status="queued")
+    now = time.time()
+    conn = _connect()
+    try:
+        # Replacing the row of a failed job also clears its progress and error
+        conn.execute(
+            "INSERT OR REPLACE INTO queue (job_id, status, message, offline, enqueued_at, updated_at) VALUES (?, 'queued', 'Waiting for a worker', ?, ?, ?)",
+            (job["job_id"], int(offline), now, now),
+        )
+    finally:
+        conn.close()
+    return job["job_id"]
+
+
+def claim_next_job(worker_id, offline=False):
+    """
+    Atomically take the oldest queued (or abandoned) job.
+
+    :param worker_id: Identifier of the claiming worker.
+    :param offline: Claim offline jobs instead of real ones.
+    :return: The job id, or None if the queue is empty.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """
+            SELECT job_id FROM queue
+            WHERE offline = ? AND (status = 'queued' OR (status = 'running' AND updated_at < ?))
+            ORDER BY enqueued_at LIMIT 1
+            """,
+            (int(offline), now - STALE_AFTER),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE queue SET status = 'running', worker = ?, started_at = ?, updated_at = ?, message = 'Started' WHERE job_id = ?",
+            (worker_id, now, now, row["job_id"]),
+        )
+        conn.execute("COMMIT")
+        return row["job_id"]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    conn = _connect()
+    try:
+        conn.execute(f"UPDATE queue SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+    finally:
+        conn.close()
+
+
+def update_progress(job_id, progress, message):
+    """Record the progress of a running job, which also acts as its heartbeat."""
+    _update(job_id, progress=progress, message=message)
+
+
+def get_status(job_id):
+    """
+    Return the queue entry of a job as a dict, or None if it is unknown.
+
+    The dict also contains 'position', the number of queued jobs ahead of it.
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM queue WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        status = dict(row)
+        status["position"] = conn.execute(
+            "SELECT COUNT(*) FROM queue WHERE status = 'queued' AND offline = ? AND enqueued_at < ?",
+            (row["offline"], row["enqueued_at"]),
+        ).fetchone()[0]
+        return status
+    finally:
+        conn.close()
+
+
+def count_jobs(status):
+    """Return the number of jobs with the given status."""
+    conn = _connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM queue WHERE status = ?", (status,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def load_stage_functions(offline=False):
+    """
+    Return the functions a worker uses for each stage.
+
+    :param offline: Use the offline backends from utils.providers instead of the real APIs.
+    :return: Dict of keyword arguments for pipeline.run_story_job.
+    """
+    output_directory = "media/videos"
+    if offline:
+        import utils.providers as providers
+        providers.use_offline_providers()
+        output_directory = OFFLINE_OUTPUT_DIRECTORY
+
+    # Imported lazily so the app can import this module without a cycle
+    import main
+
+    return {
+        "generate_story": main.generate_story,
+        "stream_story": main.stream_story,
+        "generate_voiceover": main.generate_voiceover,
+        "get_image": main.get_image_from_DALL_E_3_API,
+        "get_video": main.get_video_from_Replicate_API,
+        "combine_videos_and_audio": main.combine_videos_and_audio,
+        "package_video": hls.package_hls if hls.packaging_enabled() else None,
+        "output_directory": output_directory,
+    }
+
+
+def process_job(job_id, stage_functions):
+    """Run one claimed job to completion and record the outcome in the queue."""
+    status = get_status(job_id)
+    tracing.record("queue.wait", status["started_at"] - status["enqueued_at"], job_id=job_id)
+
+    job = jobs.load_job(job_id)
+    job["status"] = "running"
+    jobs.save_job(job)
+
+    try:
+        with tracing.span("job", job_id=job_id):
+            output_path = pipeline.run_story_job(
+                job,
+                on_progress=lambda progress, message: update_progress(job_id, progress, message),
+                preview_path=os.path.join(preview.PREVIEW_DIRECTORY, f"preview_{job_id}.mp4"),
+                on_preview=lambda path, nb_clips: _update(job_id, preview_path=path),
+                **stage_functions,
+            )
+        _update(job_id, status="done", progress=1.0, message="Done", output_path=output_path)
+    except Exception as e:
+        traceback.print_exc()
+        jobs.finish_job(job, None, status="failed")
+        _update(job_id, status="failed", message="Failed", error=str(e))
+
+
+def run_worker(worker_id=None, offline=False, poll_interval=1.0, exit_when_empty=False):
+    """
+    Process queued jobs one at a time until stopped.
+
+    :param worker_id: Identifier recorded on claimed jobs. Defaults to a random one.
+    :param offline: Use the offline providers.
+    :param poll_interval: Seconds to wait before polling an empty queue again.
+    :param exit_when_empty: Return instead of polling once the queue is empty.
+    """
+    worker_id = worker_id or f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stage_functions = load_stage_functions(offline)
+
+    while True:
+        job_id = claim_next_job(worker_id, offline)
+        if job_id is None:
+            if exit_when_empty:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker_id}] processing job {job_id}")
+        process_job(job_id, stage_functions)
+
+
+def start_workers(num_workers, offline=False, exit_when_empty=False):
+    """
+    Start worker processes in the background.
+
+    :param num_workers: Number of worker processes.
+    :param offline: Use the offline providers.
+    :param exit_when_empty: Let the workers exit once the queue is drained.
+    :return: List of subprocess.Popen handles.
+    """
+    command = [sys.executable, "-m", "utils.job_queue", "--worker"]
+    if offline:
+        command.append("--offline")
+    if exit_when_empty:
+        command.append("--exit-when-empty")
+    return [subprocess.Popen(command) for _ in range(num_workers)]
+
+
+def load_test(num_jobs, num_workers, latency_scale=0.1, failure_rate=0.0):
+    """
+    Queue num_jobs offline stories, drain them with num_workers workers and report throughput.
+
+    :param latency_scale: Multiplier of the offline provider latencies.
+    :param failure_rate: Probability that an offline provider call fails.
+    """
+    os.environ["XFICTION_OFFLINE_LATENCY_SCALE"] = str(latency_scale)
+    os.environ["XFICTION_OFFLINE_FAILURE_RATE"] = str(failure_rate)
+    job_ids = [enqueue(f"Load test story {i}", offline=True) for i in range(num_jobs)]
+
+    start_time = time.time()
+    workers = start_workers(num_workers, offline=True, exit_when_empty=True)
+    for worker in workers:
+        worker.wait()
+    elapsed = time.time() - start_time
+
+    statuses = [get_status(job_id)["status"] for job_id in job_ids]
+    print(f"{statuses.count('done')}/{num_jobs} jobs done with {num_workers} workers in {elapsed:.1f}s "
+          f"({num_jobs / elapsed * 60:.1f} jobs/min)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="X-Fiction background generation workers")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes to start")
+    parser.add_argument("--offline", action="store_true", help="use the offline providers")
+    parser.add_argument("--load-test", type=int, metavar="N", help="queue N offline jobs and measure throughput")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="offline latency multiplier for --load-test")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="offline failure probability for --load-test")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--exit-when-empty", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(offline=args.offline, exit_when_empty=args.exit_when_empty)
+    elif args.load_test:
+        load_test(args.load_test, args.workers, args.latency_scale, args.failure_rate)
+    else:
+        workers = start_workers(args.workers, offline=args.offline)
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+
+# Job records live next to the story reports so a job survives crashes,
+# Streamlit reruns and closed browser tabs.
+JOBS_DIRECTORY = "media/reports"
+
+_lock = threading.Lock()
+
+
+def job_path(job_id):
+    """Return the path of the record file for a job."""
+    return os.path.join(JOBS_DIRECTORY, f"job_{job_id}.json")
+
+
+def create_job(story_prompt, status="running"):
+    """
+    Create and persist a new job record.
+
+    :param story_prompt: The story prompt the job was started with.
+    :param status: Initial status, 'queued' for jobs handed to the worker queue.
+    :return: The job record as a dict.
+    """
+    now = time.time()
+    job = {
+        "job_id": uuid.uuid4().hex[:12],
+        "story_prompt": story_prompt,
+        "status": status,
+        "created_at": now,
+        "updated_at": now,
+        "story": None,
+        "stages": {},
+        "output_path": None,
+    }
+    save_job(job)
+    return job
+
+
+def load_job(job_id):
+    """Load a job record, or return None if it does not exist."""
+    try:
+        with open(job_path(job_id), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_job(job):
+    """Atomically write a job record to disk."""
+    with _lock:
+        job["updated_at"] = time.time()
+        os.makedirs(JOBS_DIRECTORY, exist_ok=True)
+        path = job_path(job["job_id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def list_jobs():
+    """Return all job records, most recently updated first."""
+    if not os.path.isdir(JOBS_DIRECTORY):
+        return []
+
+    jobs = []
+    for file in os.listdir(JOBS_DIRECTORY):
+        if file.startswith("job_") and file.endswith(".json"):
+            job = load_job(file[len("job_"):-len(".json")])
+            if job:
+                jobs.append(job)
+    return sorted(jobs, key=lambda job: job["updated_at"], reverse=True)
+
+
+def find_resumable_job(story_prompt):
+    """
+    Find the latest unfinished job for a story prompt.
+
+    :param story_prompt: The story prompt to match.
+    :return: The job record, or None if every job for this prompt finished.
+    """
+    for job in list_jobs():
+        if job["story_prompt"] == story_prompt and job["status"] != "done":
+            return job
+    return None
+
+
+def set_story(job, story_json_dict):
+    """Checkpoint the generated story so a restart does not ask the LLM again."""
+    job["story"] = story_json_dict
+    save_job(job)
+
+
+def complete_stage(job, key, path):
+    """
+    Checkpoint a finished stage.
+
+    :param job: The job record.
+    :param key: Stage key, e.g. 'voiceover', 'image_0' or 'video_0'.
+    :param path: Path to the generated asset.
+    """
+    job["stages"][key] = {"status": "done", "path": path}
+    save_job(job)
+
+
+def completed_stages(job):
+    """
+    Return the finished stages of a job whose assets still exist on disk.
+
+    :param job: The job record.
+    :return: Dict mapping stage key to asset path.
+    """
+    return {
+        key: stage["path"]
+        for key, stage in job["stages"].items()
+        if stage.get("status") == "done" and stage.get("path") and os.path.exists(stage["path"])
+    }
+
+
+def finish_job(job, output_path, status="done"):
+    """Mark a job as finished and record the final video path."""
+    job["status"] = status
+    job["output_path"] = output_path
+    save_job(job)
@@ -0,0 +1,208 @@
+import argparse
+import http.server
+import mimetypes
+import os
+import re
+import threading
+import urllib.parse
+
+
+# Generated media is served by a small HTTP server next to Streamlit instead of
+# being loaded into Streamlit's in-memory media manager on every rerun. The
+# browser fetches videos with Range requests, revalidates them with ETags,
+# and the bytes go from the page cache to the socket with sendfile.
+MEDIA_DIRECTORIES = (
+    "media/videos",
+    "media/clips",
+    "media/voiceover",
+    "media/images",
+    "media/previews",
+    "media/offline",
+    "media/gallery",
+    "media/hls",
+)
+# 'app' starts the server inside the Streamlit process, 'external' when it runs
+# separately (`python -m utils.media_server`), 'off' leaves media to Streamlit.
+# The default is 'off' unless XFICTION_MEDIA_URL is set: a localhost URL only
+# works for browsers on the server host, and http URLs are blocked as mixed
+# content on https pages such as Streamlit Cloud.
+MEDIA_SERVER = os.environ.get("XFICTION_MEDIA_SERVER", "app" if os.environ.get("XFICTION_MEDIA_URL") else "off")
+MEDIA_HOST = os.environ.get("XFICTION_MEDIA_HOST", "0.0.0.0")
+MEDIA_PORT = int(os.environ.get("XFICTION_MEDIA_PORT", 8502))
+# Address the browser reaches the server at, e.g. an https reverse proxy
+MEDIA_URL = os.environ.get("XFICTION_MEDIA_URL", f"http://localhost:{MEDIA_PORT}")
+# Seconds browsers may reuse a file before revalidating it with its ETag
+CACHE_MAX_AGE = 60
+
+_server = None
+_lock = threading.Lock()
+
+# HLS playlists and segments, which mimetypes does not all know
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+
+
+def _roots():
+    return [os.path.realpath(directory) for directory in MEDIA_DIRECTORIES]
+
+
+def resolve(url_path):
+    """
+    Map a URL path to a file inside one of the served directories.
+
+    :param url_path: Path of the request, e.g. '/media/videos/title.mp4'.
+    :return: Absolute file path, or None if it is outside the served directories or missing.
+    """
+    path = os.path.realpath(urllib.parse.unquote(urllib.parse.urlsplit(url_path).path).lstrip("/"))
+    if not any(path.startswith(root + os.sep) for root in _roots()):
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def serves(path):
+    """Return True if media_url turns the path into a URL on the media server."""
+    if not path or (_server is None and MEDIA_SERVER != "external"):
+        return False
+    real_path = os.path.realpath(path)
+    return any(real_path.startswith(root + os.sep) for root in _roots())
+
+
+def media_url(path):
+    """
+    Return the URL a media file is served at, for st.video, st.audio and st.image.
+
+    :param path: Path of a generated file, relative to the app directory or absolute.
+    :return: URL on the media server, or the path itself if the server is not
+        running or does not serve the file, in which case Streamlit serves it.
+    """
+    if not serves(path):
+        return path
+    return f"{MEDIA_URL}/{urllib.parse.quote(os.path.relpath(os.path.realpath(path)))}"
+
+
+def _parse_range(header, size):
+    # Single byte ranges only, which is what video and audio elements send
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # A zero-length suffix selects nothing and cannot be satisfied
+        length = min(int(end), size)
+        if not length:
+            return None
+        return size - length, size - 1
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class MediaRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        path = resolve(self.path)
+        if path is None:
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        # A range only applies to the version of the file the client has
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            byte_range = _parse_range(range_header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            status = 206
+
+        length = max(0, end - start + 1)
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.send_header("Cache-Control", f"public, max-age={CACHE_MAX_AGE}")
+        # The page is served by Streamlit from another port
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if send_body and length:
+            with open(path, "rb") as f:
+                try:
+                    # Zero-copy from the file to the socket where the OS supports it
+                    self.connection.sendfile(f, offset=start, count=length)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Players drop connections when they seek
+                    self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def start_server(host=MEDIA_HOST, port=MEDIA_PORT):
+    """
+    Start the media server on a background thread, once per process.
+
+    :return: The server, or None if it runs elsewhere or the port is not available.
+        Without a server media_url keeps returning file paths, unless XFICTION_MEDIA_SERVER is 'external'.
+    """
+    global _server
+    if MEDIA_SERVER != "app":
+        return None
+    with _lock:
+        if _server is None:
+            try:
+                _server = _Server((host, port), MediaRequestHandler)
+            except OSError as e:
+                print(f"Media server could not listen on {host}:{port}, Streamlit serves the media instead: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="media-server", daemon=True).start()
+        return _server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generated media with Range and ETag support")
+    parser.add_argument("--host", default=MEDIA_HOST)
+    parser.add_argument("--port", type=int, default=MEDIA_PORT)
+    args = parser.parse_args()
+
+    server = _Server((args.host, args.port), MediaRequestHandler)
+    print(f"Serving {', '.join(MEDIA_DIRECTORIES)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import inspect
+import json
+import time
+
+import utils.jobs as jobs
+import utils.tracing as tracing
+from utils.preview import PreviewRenderer
+from utils.story_stream import StoryStreamParser
+
+
+# Maximum number of requests in flight per provider. DALL-E 3, Replicate and
+# the TTS endpoint have independent rate limits, so each gets its own cap.
+PROVIDER_CONCURRENCY = {
+    "images": 6,
+    "videos": 6,
+    "tts": 2,
+}
+
+# Clip count assumed for progress reporting until a streamed story is complete
+STREAMED_CLIPS_ESTIMATE = 6
+
+
+def build_clip_prompt(clip_value, character, visual_style):
+    """
+    Build the full image prompt of one clip.
+
+    :param clip_value: Clip entry of the story's 'clips' object.
+    :param character: The story's character description.
+    :param visual_style: The story's visual style.
+    :return: The image prompt.
+    """
+    image_prompt = clip_value.get("image_prompt", "")
+    character_visible = clip_value.get("character_visible", "False") == "True"
+
+    # Prepend the character description if the character is visible
+    if character_visible and character:
+        image_prompt = f'{character}, {image_prompt}'
+
+    # Append the visual style to the image prompt
+    return f'{image_prompt} + {visual_style}'
+
+
+def build_clip_prompts(story_json_dict):
+    """
+    Build the full image prompt for every clip of a story, in clip order.
+
+    :param story_json_dict: Story as returned by generate_story, parsed from JSON.
+    :return: List of image prompts, one per clip.
+    """
+    character = story_json_dict.get("character", "")
+    visual_style = story_json_dict.get("visual_style", "")
+    return [build_clip_prompt(clip_value, character, visual_style) for clip_value in story_json_dict.get("clips", {}).values()]
+
+
+async def _run_limited(semaphore, executor, func, *args, **kwargs):
+    # The provider calls are blocking, so they run in worker threads while the
+    # semaphore keeps the number of concurrent requests under the provider cap.
+    # The context is copied like asyncio.to_thread does, for the tracing spans.
+    # Coroutine functions, e.g. the video stage, are awaited on the loop.
+    async with semaphore:
+        if inspect.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+class _AssetStages:
+    # Shared by render_story_assets and render_streamed_story: runs the
+    # voiceover and clip stages under the per-provider limits, skipping stages
+    # that are already completed and reporting every asset to on_media.
+    # The blocking calls get their own threads, one per allowed request, since
+    # the default executor (min(32, cores + 4) threads) would cap them first.
+
+    def __init__(self, generate_voiceover, get_image, get_video, on_media, concurrency, completed):
+        limits = {**PROVIDER_CONCURRENCY, **(concurrency or {})}
+        self.image_limit = asyncio.Semaphore(limits["images"])
+        self.video_limit = asyncio.Semaphore(limits["videos"])
+        self.tts_limit = asyncio.Semaphore(limits["tts"])
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=sum(limits.values()), thread_name_prefix="provider")
+        self.generate_voiceover = generate_voiceover
+        self.get_image = get_image
+        self.get_video = get_video
+        self.on_media = on_media
+        self.completed = completed or {}
+
+    async def run_stage(self, key, semaphore, func, *args):
+        # Skip stages that a previous run already finished
+        path = self.completed.get(key)
+        if not path:
+            path = await _run_limited(semaphore, self.executor, func, *args)
+        if self.on_media and path:
+            self.on_media(key, path)
+        return path
+
+    async def voiceover(self, voiceover_text):
+        return await self.run_stage('voiceover', self.tts_limit, self.generate_voiceover, voiceover_text)
+
+    async def clip(self, clip_index, full_prompt):
+        img_path = await self.run_stage(f'image_{clip_index}', self.image_limit, self.get_image, full_prompt)
+        if not img_path:
+            print(f"No image was generated for clip {clip_index + 1}.")
+            return None
+
+        return await self.run_stage(f'video_{clip_index}', self.video_limit, self.get_video, img_path)
+
+    def close(self):
+        # Calls of cancelled stages finish in the background
+        self.executor.shutdown(wait=False)
+
+
+async def render_story_assets(story_json_dict, generate_voiceover, get_image, get_video, on_media=None, concurrency=None, completed=None):
+    """
+    Generate the voiceover and all clips of a story concurrently.
+
+    The voiceover runs alongside the clips. Each clip generates its image and
+    then its video, and different clips run in parallel up to the per-provider
+    limits in PROVIDER_CONCURRENCY.
+
+    :param story_json_dict: Story as returned by generate_story, parsed from JSON.
+    :param generate_voiceover: Callable taking the voiceover text, returning an audio path.
+    :param get_image: Callable taking an image prompt, returning an image path.
+    :param get_video: Callable or coroutine function taking an image path, returning a video path.
+    :param on_media: Optional callback called with (key, path) as soon as an asset is ready.
+        Keys are 'voiceover', 'image_{i}' and 'video_{i}'.
+    :param concurrency: Optional dict overriding PROVIDER_CONCURRENCY.
+    :param completed: Optional dict of already finished stages (key -> path), e.g. from a
+        resumed job. Those stages are not generated again but still reported to on_media.
+    :return: Tuple of (speech_path, video_paths), with video_paths in clip order.
+    """
+    stages = _AssetStages(generate_voiceover, get_image, get_video, on_media, concurrency, completed)
+    clip_tasks = [stages.clip(i, prompt) for i, prompt in enumerate(build_clip_prompts(story_json_dict))]
+
+    try:
+        # gather keeps results in submission order, so clips stay in story order
+        speech_path, *video_paths = await asyncio.gather(stages.voiceover(story_json_dict["voiceover_text"]), *clip_tasks)
+    finally:
+        stages.close()
+
+    return speech_path, [path for path in video_paths if path]
+
+
+async def _iterate_in_thread(iterable):
+    # Consume a blocking iterator (e.g. an LLM stream) in a worker thread and
+    # hand its items to the event loop as they arrive
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+
+    def pump():
+        try:
+            for item in iterable:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, end)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(pump))
+    while True:
+        item = await queue.get()
+        if item is end:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    await producer
+
+
+async def render_streamed_story(story_chunks, generate_voiceover, get_image, get_video, on_media=None, concurrency=None, on_story=None):
+    """
+    Generate a story's assets while the story itself is still streaming in.
+
+    The voiceover starts as soon as 'voiceover_text' is complete and each clip
+    as soon as its object in 'clips' is closed, instead of waiting for the whole
+    LLM response.
+
+    :param story_chunks: Iterable of text pieces of the story JSON, e.g. from stream_story.
+    :param on_story: Optional callback called with the parsed story once the stream is complete.
+    :return: Tuple of (story_json_dict, speech_path, video_paths), with video_paths in clip order.
+    See render_story_assets for the other parameters.
+    """
+    stages = _AssetStages(generate_voiceover, get_image, get_video, on_media, concurrency, None)
+    parser = StoryStreamParser()
+    voiceover_task = None
+    clip_tasks = []
+    pending_clips = []
+    start = time.perf_counter()
+    first_dispatch = None
+
+    def dispatch_clips():
+        # A clip prompt needs the character and visual style, which the system
+        # prompt asks for before the clips; hold clips back until both are known
+        while pending_clips and "character" in parser.fields and "visual_style" in parser.fields:
+            clip_value = pending_clips.pop(0)
+            full_prompt = build_clip_prompt(clip_value, parser.fields["character"], parser.fields["visual_style"])
+            clip_tasks.append(asyncio.ensure_future(stages.clip(len(clip_tasks), full_prompt)))
+
+    try:
+        async for chunk in _iterate_in_thread(story_chunks):
+            for event in parser.feed(chunk):
+                if event[0] == "clip":
+                    pending_clips.append(event[2])
+                elif event[1] == "voiceover_text":
+                    voiceover_task = asyncio.ensure_future(stages.voiceover(event[2]))
+            dispatch_clips()
+            if first_dispatch is None and clip_tasks:
+                first_dispatch = time.perf_counter() - start
+
+        story_json_dict = parser.result()
+        tracing.record("llm.story_stream", time.perf_counter() - start, first_clip_after=first_dispatch)
+        if on_story:
+            on_story(story_json_dict)
+
+        # Fields missing from the stream order are picked up from the full story
+        parser.fields.setdefault("character", story_json_dict.get("character", ""))
+        parser.fields.setdefault("visual_style", story_json_dict.get("visual_style", ""))
+        dispatch_clips()
+        if voiceover_task is None:
+            voiceover_task = asyncio.ensure_future(stages.voiceover(story_json_dict["voiceover_text"]))
+
+        speech_path, *video_paths = await asyncio.gather(voiceover_task, *clip_tasks)
+    except BaseException:
+        for task in [voiceover_task, *clip_tasks]:
+            if task:
+                task.cancel()
+        raise
+    finally:
+        stages.close()
+
+    return story_json_dict, speech_path, [path for path in video_paths if path]
+
+
+def run_story_job(job, generate_story, generate_voiceover, get_image, get_video, combine_videos_and_audio, on_progress=None, concurrency=None, output_directory="media/videos", stream_story=None, preview_path=None, on_preview=None, package_video=None):
+    """
+    Run a whole story job without any UI: story, assets and final video.
+
+    Every stage is checkpointed in the job record, so running the same job
+    again after a crash only generates what is still missing.
+
+    :param job: Job record from utils.jobs.
+    :param generate_story: Callable taking the story prompt, returning the story JSON string.
+    :param generate_voiceover: See render_story_assets.
+    :param get_image: See render_story_assets.
+    :param get_video: See render_story_assets.
+    :param combine_videos_and_audio: Callable taking (video_paths, audio_path, output_path).
+    :param on_progress: Optional callback called with (fraction_done, message).
+    :param concurrency: Optional dict overriding PROVIDER_CONCURRENCY.
+    :param output_directory: Directory the final video is written to.
+    :param stream_story: Optional callable taking the story prompt and yielding the story JSON
+        text as it is generated. When given, clips start while the story is still streaming.
+    :param preview_path: Optional path of a low resolution preview, updated as clips arrive.
+    :param on_preview: Optional callback called with (preview_path, nb_clips) after each preview update.
+    :param package_video: Optional callable taking the final video path, e.g. hls.package_hls
+        to also write a streaming ladder.
+    :return: Path to the final video.
+    """
+    def report(fraction, message):
+        if on_progress:
+            on_progress(fraction, message)
+
+    # story + voiceover + image and video per clip + final assembly
+    done_stages = [1]
+    total_stages = [3]
+
+    preview = PreviewRenderer(preview_path, on_update=on_preview) if preview_path else None
+
+    def on_media(key, path):
+        jobs.complete_stage(job, key, path)
+        if preview and key == 'voiceover':
+            preview.set_audio(path)
+        elif preview and key.startswith('video_'):
+            preview.add_clip(int(key.split('_')[1]), path)
+        done_stages[0] += 1
+        report(done_stages[0] / total_stages[0], f"Generated {key}")
+
+    def on_story(story_json_dict):
+        jobs.set_story(job, story_json_dict)
+        total_stages[0] = 3 + 2 * len(story_json_dict.get("clips", {}))
+
+    try:
+        if job["story"] is None and stream_story is not None:
+            report(0.0, "Generating story and clips")
+            # Stages of an earlier story do not belong to the new one
+            job["stages"] = {}
+            total_stages[0] = 3 + 2 * STREAMED_CLIPS_ESTIMATE
+            try:
+                story_json_dict, speech_path, video_paths = asyncio.run(render_streamed_story(
+                    stream_story(job["story_prompt"]),
+                    generate_voiceover,
+                    get_image,
+                    get_video,
+                    on_media=on_media,
+                    concurrency=concurrency,
+                    on_story=on_story,
+                ))
+            except Exception:
+                jobs.finish_job(job, None, status="failed")
+                raise
+        else:
+            if job["story"] is None:
+                report(0.0, "Generating story")
+                story_json = generate_story(job["story_prompt"])
+                if not story_json:
+                    jobs.finish_job(job, None, status="failed")
+                    raise RuntimeError("Story generation failed.")
+                job["stages"] = {}
+                on_story(json.loads(story_json))
+            story_json_dict = job["story"]
+            total_stages[0] = 3 + 2 * len(story_json_dict.get("clips", {}))
+
+            speech_path, video_paths = asyncio.run(render_story_assets(
+                story_json_dict,
+                generate_voiceover,
+                get_image,
+                get_video,
+                on_media=on_media,
+                concurrency=concurrency,
+                completed=jobs.completed_stages(job),
+            ))
+    finally:
+        # The final render supersedes any preview update still pending
+        if preview:
+            preview.close()
+
+    if not video_paths:
+        jobs.finish_job(job, None, status="failed")
+        raise RuntimeError("No videos were generated.")
+
+    report((total_stages[0] - 1) / total_stages[0], "Combining videos and audio")
+    output_video_path = f"{output_directory}/{story_json_dict['title']}.mp4"
+    combine_videos_and_audio(video_paths, speech_path, output_video_path)
+    if package_video:
+        report((total_stages[0] - 1) / total_stages[0], "Packaging for streaming")
+        package_video(output_video_path)
+    jobs.finish_job(job, output_video_path)
+    report(1.0, "Done")
+
+    return output_video_path
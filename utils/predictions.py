@@ -0,0 +1,245 @@
+import asyncio
+import http.server
+import json
+import os
+import threading
+import time
+
+import utils.download_from_url as download
+import utils.providers as providers
+import utils.tracing as tracing
+
+
+# Replicate predictions are created without waiting for them. All pending
+# predictions of the process are then tracked by one poller task on the shared
+# download client's event loop, optionally woken up early by a local webhook
+# receiver, and their outputs are downloaded on the same loop. A clip in
+# flight costs an entry in a dict instead of a thread blocked in replicate.run.
+API_URL = os.environ.get("XFICTION_REPLICATE_API_URL", "https://api.replicate.com/v1")
+# Public URL Replicate should POST completed predictions to, e.g. through a tunnel
+WEBHOOK_URL = os.environ.get("XFICTION_REPLICATE_WEBHOOK_URL")
+WEBHOOK_PORT = int(os.environ.get("XFICTION_REPLICATE_WEBHOOK_PORT", 8910))
+# The receiver only listens locally; WEBHOOK_URL reaches it through the tunnel
+# or reverse proxy. Deliveries are not trusted either way, they only trigger a
+# status request to the API for the prediction they name.
+WEBHOOK_HOST = os.environ.get("XFICTION_REPLICATE_WEBHOOK_HOST", "127.0.0.1")
+
+# Seconds between two polls of the pending predictions. With a webhook the
+# poller only catches deliveries that got lost.
+POLL_INTERVAL = 2.0
+WEBHOOK_POLL_INTERVAL = 30.0
+# Prediction status requests sent at once by the poller
+MAX_CONCURRENT_POLLS = 16
+# Seconds a prediction may take before it is canceled and fails, well under the
+# queue's STALE_AFTER so a stuck clip fails its job instead of hanging it
+PREDICTION_TIMEOUT = 10 * 60
+TERMINAL_STATUSES = {"succeeded", "failed", "canceled"}
+
+
+class PredictionError(providers.ProviderError):
+    """
+    Raised when a prediction fails, is canceled or cannot be created.
+
+    :param status_code: HTTP status of the failed API call, if any, so throttling can be detected.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PredictionManager:
+    """
+    Create Replicate predictions and track all of them from one poller.
+
+    :param token: Replicate API token.
+    :param api_url: Base URL of the Replicate HTTP API, e.g. a local fake server.
+    :param webhook_url: Public URL of the webhook receiver, or None to only poll.
+    :param webhook_port: Local port the webhook receiver listens on.
+    :param webhook_host: Local address the webhook receiver listens on.
+    """
+
+    def __init__(self, token, api_url=API_URL, webhook_url=WEBHOOK_URL, webhook_port=WEBHOOK_PORT, webhook_host=WEBHOOK_HOST):
+        self.api_url = api_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.webhook_url = webhook_url
+        self.poll_interval = WEBHOOK_POLL_INTERVAL if webhook_url else POLL_INTERVAL
+        # Prediction id -> asyncio.Future, only touched on the download loop
+        self._pending = {}
+        self._poller = None
+        self._loop = None
+        self._poll_limit = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+        if webhook_url:
+            self._start_webhook_receiver(webhook_host, webhook_port)
+
+    def submit(self, model, inputs, output_path, files=None):
+        """
+        Start a prediction and download its output once it succeeds.
+
+        :param model: Model version as 'owner/name:version'.
+        :param inputs: Model inputs.
+        :param output_path: Path the output file is downloaded to.
+        :param files: Optional dict of input name -> local file path, uploaded first.
+        :return: concurrent.futures.Future resolving to output_path.
+        """
+        return download.submit(self._run(model, inputs, output_path, files or {}))
+
+    def run(self, model, inputs, output_path, files=None):
+        """Blocking version of submit."""
+        return self.submit(model, inputs, output_path, files).result()
+
+    @property
+    def pending(self):
+        """Number of predictions currently in flight."""
+        return len(self._pending)
+
+    async def _run(self, model, inputs, output_path, files):
+        self._loop = asyncio.get_running_loop()
+        start = time.time()
+        inputs = dict(inputs)
+        for name, path in files.items():
+            inputs[name] = await self._upload(path)
+
+        prediction = await self._create(model, inputs)
+        created = time.time()
+        result = self._loop.create_future()
+        self._pending[prediction["id"]] = result
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+
+        try:
+            prediction = await asyncio.wait_for(result, PREDICTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._pending.pop(prediction["id"], None)
+            await self._cancel(prediction["id"])
+            raise PredictionError(f"Prediction {prediction['id']} did not complete within {PREDICTION_TIMEOUT}s")
+        metrics = prediction.get("metrics") or {}
+        tracing.record(
+            "replicate.prediction",
+            time.time() - created,
+            model=model,
+            status=prediction["status"],
+            predict_time=metrics.get("predict_time"),
+            upload_time=created - start,
+        )
+        if prediction["status"] != "succeeded":
+            raise PredictionError(f"Prediction {prediction['id']} {prediction['status']}: {prediction.get('error')}")
+
+        output = prediction["output"]
+        # Some models return a list of files, the last one being the final output
+        url = output[-1] if isinstance(output, list) else output
+        if await download.async_download_to_file(url, output_path) is None:
+            raise PredictionError(f"Download of prediction {prediction['id']} failed")
+        return output_path
+
+    async def _upload(self, path):
+        with open(path, "rb") as f:
+            response = await download.request(
+                "POST",
+                f"{self.api_url}/files",
+                headers=self.headers,
+                files={"content": (os.path.basename(path), f.read(), "application/octet-stream")},
+            )
+        self._check(response, "File upload")
+        return response.json()["urls"]["get"]
+
+    async def _create(self, model, inputs):
+        body = {"version": model.split(":")[-1], "input": inputs}
+        if self.webhook_url:
+            body.update(webhook=self.webhook_url, webhook_events_filter=["completed"])
+        response = await download.request("POST", f"{self.api_url}/predictions", headers=self.headers, json=body)
+        self._check(response, "Prediction creation")
+        return response.json()
+
+    async def _cancel(self, prediction_id):
+        # Best effort, so Replicate stops billing a prediction nobody waits for
+        try:
+            await download.request("POST", f"{self.api_url}/predictions/{prediction_id}/cancel", headers=self.headers)
+        except Exception as e:
+            print(f"Canceling prediction {prediction_id} failed: {e!r}")
+
+    @staticmethod
+    def _check(response, action):
+        if response.status_code >= 400:
+            raise PredictionError(f"{action} failed with status {response.status_code}: {response.text[:200]}", response.status_code)
+
+    async def _refresh(self, prediction_id):
+        async with self._poll_limit:
+            try:
+                response = await download.request("GET", f"{self.api_url}/predictions/{prediction_id}", headers=self.headers)
+            except Exception as e:
+                print(f"Polling prediction {prediction_id} failed: {e!r}")
+                return
+        if response.status_code == 200:
+            self._resolve(response.json())
+        elif 400 <= response.status_code < 500 and response.status_code != 429:
+            # The prediction is gone or the token was rejected, polling again will not help;
+            # throttling and server errors are retried on the next round
+            self._fail(prediction_id, PredictionError(
+                f"Polling prediction {prediction_id} failed with status {response.status_code}: {response.text[:200]}",
+                response.status_code,
+            ))
+
+    async def _poll(self):
+        # Runs until nothing is pending; submit starts a new poller after that
+        while self._pending:
+            await asyncio.sleep(self.poll_interval)
+            await asyncio.gather(*(self._refresh(prediction_id) for prediction_id in list(self._pending)))
+
+    def _wake(self, prediction_id):
+        # A webhook delivery only says which prediction to look at
+        if prediction_id in self._pending:
+            asyncio.ensure_future(self._refresh(prediction_id))
+
+    def _resolve(self, prediction):
+        if prediction.get("status") not in TERMINAL_STATUSES:
+            return
+        result = self._pending.pop(prediction.get("id"), None)
+        if result and not result.done():
+            result.set_result(prediction)
+
+    def _fail(self, prediction_id, error):
+        result = self._pending.pop(prediction_id, None)
+        if result and not result.done():
+            result.set_exception(error)
+
+    def _start_webhook_receiver(self, host, port):
+        manager = self
+
+        class WebhookHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.end_headers()
+                try:
+                    prediction_id = json.loads(body).get("id")
+                except (json.JSONDecodeError, AttributeError):
+                    return
+                # The body is unauthenticated, so its status and output are
+                # ignored and the prediction is fetched from the API instead
+                if manager._loop and isinstance(prediction_id, str):
+                    manager._loop.call_soon_threadsafe(manager._wake, prediction_id)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), WebhookHandler)
+        threading.Thread(target=server.serve_forever, name="replicate-webhooks", daemon=True).start()
+
+
+_manager = None
+_lock = threading.Lock()
+
+
+def get_manager(token):
+    """
+    Return the process-wide prediction manager, created on first use.
+
+    :param token: Replicate API token.
+    """
+    global _manager
+    with _lock:
+        if _manager is None:
+            _manager = PredictionManager(token)
+        return _manager
@@ -0,0 +1,98 @@
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.segments as segments
+import utils.tracing as tracing
+
+
+# A low resolution preview of a story is rebuilt every time a clip or the
+# voiceover lands, so users see the combined video long before the final
+# render. Each clip is encoded once into a small segment with the 'preview'
+# profile (see utils/segments.py); an update only encodes the new clip and
+# then joins the segments with a stream copy.
+PREVIEW_DIRECTORY = "media/previews"
+# Encoder threads of a preview segment, kept low so the previews do not
+# compete with the clip downloads and the final render
+PREVIEW_THREADS = 2
+
+
+class PreviewRenderer:
+    """
+    Keep a preview video up to date while the clips of a story arrive.
+
+    All the work runs on one background thread, so add_clip and set_audio
+    return immediately and can be called from the event loop.
+
+    :param output_path: Path of the preview MP4, replaced atomically on every update.
+    :param on_update: Optional callback called with (output_path, nb_clips) after each update.
+    :param profile: Encode profile of the segments.
+    """
+
+    def __init__(self, output_path, on_update=None, profile="preview"):
+        self.output_path = output_path
+        self.on_update = on_update
+        self.profile = encode_profiles.get_profile(profile)
+        self.clips = {}
+        self.audio_path = None
+        self._segments = {}
+        self._frame = None
+        self._rendered = None
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+
+    def add_clip(self, clip_index, video_path):
+        """Add or replace the clip at clip_index and schedule an update."""
+        with self._lock:
+            self.clips[clip_index] = video_path
+        self._executor.submit(self._refresh)
+
+    def set_audio(self, audio_path):
+        """Set the voiceover and schedule an update."""
+        with self._lock:
+            self.audio_path = audio_path
+        self._executor.submit(self._refresh)
+
+    def close(self):
+        """Drop pending updates and wait for the running one."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _refresh(self):
+        with self._lock:
+            clips = sorted(self.clips.items())
+            audio_path = self.audio_path
+        # Several additions can be folded into one update
+        state = (tuple(clips), audio_path)
+        if not clips or state == self._rendered:
+            return
+
+        try:
+            with tracing.span("preview", clips=len(clips)) as preview_span:
+                start = time.perf_counter()
+                segment_paths = [self._segment(video_path) for _, video_path in clips]
+                os.makedirs(os.path.dirname(self.output_path) or ".", exist_ok=True)
+                tmp_path = f"{self.output_path}.tmp.mp4"
+                audio_track = segments.encode_audio(audio_path, self.profile["audio_bitrate"]) if audio_path else None
+                ffmpeg_tools.concat_stream_copy(segment_paths, audio_track, tmp_path, copy_audio=True)
+                os.replace(tmp_path, self.output_path)
+                preview_span.set(render_time=time.perf_counter() - start)
+        except subprocess.CalledProcessError as e:
+            print(f"Preview update failed: {e.stderr}")
+            return
+
+        self._rendered = state
+        if self.on_update:
+            self.on_update(self.output_path, len(clips))
+
+    def _segment(self, video_path):
+        if video_path not in self._segments:
+            # Every segment gets the size and frame rate of the first clip, so
+            # they can be joined without re-encoding
+            if self._frame is None:
+                self._frame = segments.target_frame([video_path], self.profile["max_height"])
+            self._segments[video_path], _ = segments.encode_segment(video_path, self._frame, self.profile, threads=PREVIEW_THREADS)
+        return self._segments[video_path]
@@ -0,0 +1,154 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import utils.jobs as jobs
+
+
+# Example prompts are generated ahead of time and kept in a pool on disk, so
+# the "Generate Example Prompt" button only pops prompts from memory. One
+# background thread tops the pool up once it runs low, with a pause between
+# LLM calls so refills never arrive as a burst.
+POOL_PATH = os.path.join(jobs.JOBS_DIRECTORY, "example_prompts.json")
+# Prompts kept ready, and the level below which a refill starts
+POOL_CAPACITY = 30
+LOW_WATER_MARK = 9
+# Seconds between two refill calls
+REFILL_INTERVAL = 10
+# Prompts already served are remembered so they are not offered again
+SEEN_LIMIT = 1000
+
+
+def parse_prompts(text):
+    """
+    Extract the prompts from an LLM answer.
+
+    The system prompt asks for an object with a repeated "Prompt" key, which
+    json.loads would collapse to its last value, so every value is kept.
+
+    :param text: JSON text returned by the LLM.
+    :return: List of prompt strings.
+    """
+    prompts = []
+
+    def collect(pairs):
+        for _, value in pairs:
+            if isinstance(value, str):
+                prompts.append(value.strip())
+            elif isinstance(value, list):
+                prompts.extend(item.strip() for item in value if isinstance(item, str))
+        return {}
+
+    json.loads(text, object_pairs_hook=collect)
+    return [prompt for prompt in prompts if prompt]
+
+
+def _normalize(prompt):
+    return " ".join(prompt.lower().strip(' "\'.').split())
+
+
+class PromptPool:
+    """
+    Persisted pool of example prompts, refilled in the background.
+
+    :param generate: Callable returning the JSON text of a batch of prompts, or None on failure.
+    :param path: JSON file the pool is kept in.
+    :param capacity: Number of prompts a refill tops the pool up to.
+    :param low_water_mark: A take leaving fewer prompts than this starts a refill.
+    :param refill_interval: Seconds between two refill calls.
+    """
+
+    def __init__(self, generate, path=POOL_PATH, capacity=POOL_CAPACITY, low_water_mark=LOW_WATER_MARK, refill_interval=REFILL_INTERVAL):
+        self.generate = generate
+        self.path = path
+        self.capacity = capacity
+        self.low_water_mark = low_water_mark
+        self.refill_interval = refill_interval
+        self.prompts = collections.deque()
+        self.seen = collections.OrderedDict()
+        self.llm_calls = 0
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._load()
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def take(self, count=3):
+        """
+        Pop prompts from the pool without waiting for the LLM.
+
+        :param count: Number of prompts wanted.
+        :return: List of up to count prompts, fewer if the pool is running dry.
+        """
+        with self._lock:
+            prompts = [self.prompts.popleft() for _ in range(min(count, len(self.prompts)))]
+            self._save()
+        self.refill_if_low()
+        return prompts
+
+    def refill_if_low(self):
+        """Start the background refill if the pool is below its low-water mark."""
+        with self._lock:
+            if self._refilling or len(self.prompts) >= self.low_water_mark:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, name="prompt-pool-refill", daemon=True).start()
+
+    def add(self, prompts):
+        """
+        Add prompts that were not seen before.
+
+        :return: Number of prompts added.
+        """
+        added = 0
+        with self._lock:
+            for prompt in prompts:
+                key = _normalize(prompt)
+                if key in self.seen:
+                    continue
+                self.seen[key] = None
+                self.prompts.append(prompt)
+                added += 1
+            while len(self.seen) > SEEN_LIMIT:
+                self.seen.popitem(last=False)
+            self._save()
+        return added
+
+    def _refill(self):
+        try:
+            failures = 0
+            while len(self.prompts) < self.capacity and failures < 3:
+                start = time.perf_counter()
+                text = self.generate()
+                self.llm_calls += 1
+                try:
+                    added = self.add(parse_prompts(text)) if text else 0
+                except (ValueError, TypeError) as e:
+                    print(f"Unusable example prompts: {e}")
+                    added = 0
+                # Repeated duplicates or errors stop the refill until the next take
+                failures = failures + 1 if not added else 0
+                time.sleep(max(0.0, self.refill_interval - (time.perf_counter() - start)))
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.prompts.extend(state.get("prompts", []))
+        self.seen.update((key, None) for key in state.get("seen", []))
+
+    def _save(self):
+        # Called with the lock held
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"prompts": list(self.prompts), "seen": list(self.seen)}, f, indent=2)
+        os.replace(tmp_path, self.path)
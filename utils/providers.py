@@ -0,0 +1,442 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+import utils.ffmpeg_tools as ffmpeg_tools
+
+
+# Generation backends for each stage of the pipeline. The real ones call
+# OpenAI and Replicate; the offline ones produce deterministic synthetic
+# media locally so the pipeline can be benchmarked and load-tested for free.
+STAGES = ("llm", "tts", "image", "video")
+DEFAULT_PROVIDERS = {
+    "llm": "openai",
+    "tts": "openai",
+    "image": "openai",
+    "video": "replicate",
+}
+
+_registry = {stage: {} for stage in STAGES}
+_instances = {}
+_lock = threading.Lock()
+
+
+class ProviderError(Exception):
+    """Raised when a provider fails to produce an asset."""
+
+
+def register_provider(stage, name):
+    """
+    Class decorator registering a backend for a stage.
+
+    :param stage: One of STAGES.
+    :param name: Name used to select the backend, e.g. 'openai' or 'offline'.
+    """
+    def decorator(cls):
+        cls.name = name
+        _registry[stage][name] = cls
+        return cls
+    return decorator
+
+
+def _configured_name(stage):
+    # XFICTION_PROVIDER_<STAGE> wins over XFICTION_PROVIDER, which wins over the default
+    return (
+        os.environ.get(f"XFICTION_PROVIDER_{stage.upper()}")
+        or os.environ.get("XFICTION_PROVIDER")
+        or DEFAULT_PROVIDERS[stage]
+    )
+
+
+def get_provider(stage):
+    """
+    Return the configured backend instance for a stage.
+
+    :param stage: One of STAGES.
+    :return: Provider instance, created on first use.
+    """
+    with _lock:
+        if stage not in _instances:
+            name = _configured_name(stage)
+            if name not in _registry[stage]:
+                raise ValueError(f"Unknown {stage} provider '{name}', available: {sorted(_registry[stage])}")
+            _instances[stage] = _registry[stage][name]()
+        return _instances[stage]
+
+
+def set_provider(stage, name, **options):
+    """
+    Select and configure the backend for a stage.
+
+    :param stage: One of STAGES.
+    :param name: Registered backend name.
+    :param options: Keyword arguments for the backend constructor.
+    :return: The new provider instance.
+    """
+    with _lock:
+        _instances[stage] = _registry[stage][name](**options)
+        return _instances[stage]
+
+
+def use_offline_providers(**options):
+    """Switch every stage to its offline backend, passing options to each of them."""
+    for stage in STAGES:
+        set_provider(stage, "offline", **options)
+
+
+def _secret(name):
+    value = os.environ.get(name)
+    if value:
+        return value
+    import streamlit as st
+    return st.secrets[name]
+
+
+_openai_client = None
+
+
+def _get_openai_client():
+    global _openai_client
+    with _lock:
+        if _openai_client is None:
+            from openai import OpenAI
+            _openai_client = OpenAI(api_key=_secret("OPENAI_API_KEY"))
+        return _openai_client
+
+
+@register_provider("llm", "openai")
+class OpenAIChatProvider:
+    model = "gpt-4-1106-preview"
+
+    def complete_json(self, system_prompt, user_prompt, temperature=None):
+        options = {} if temperature is None else {"temperature": temperature}
+        response = _get_openai_client().chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            response_format={"type": "json_object"},
+            **options,
+        )
+        return response.choices[0].message.content
+
+    def stream_json(self, system_prompt, user_prompt, temperature=None):
+        """Like complete_json, but yield the response text piece by piece as it is generated."""
+        options = {} if temperature is None else {"temperature": temperature}
+        stream = _get_openai_client().chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            response_format={"type": "json_object"},
+            stream=True,
+            **options,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+@register_provider("tts", "openai")
+class OpenAISpeechProvider:
+
+    def synthesize(self, text, output_path, model="tts-1-hd", voice="onyx"):
+        response = _get_openai_client().audio.speech.create(model=model, voice=voice, input=text)
+        response.stream_to_file(output_path)
+        return output_path
+
+
+# DALL-E 3 always returns PNG; other output formats need a conversion
+PROVIDER_IMAGE_FORMAT = ".png"
+# Images a single request can return per model. DALL-E 3 only accepts n=1.
+MULTI_IMAGE_MODELS = {"dall-e-2": 10}
+# Characters of base64 decoded at a time, a multiple of 4 so chunks decode independently
+BASE64_CHUNK_SIZE = 4 * 64 * 1024
+
+
+def max_images_per_request(model):
+    """Return how many images one generate_batch call may ask for with this model."""
+    return MULTI_IMAGE_MODELS.get(model, 1)
+
+
+def write_base64_to_file(data, output_path, chunk_size=BASE64_CHUNK_SIZE):
+    """
+    Decode a base64 payload to a file chunk by chunk.
+
+    Only one decoded chunk is held in memory at a time instead of a full copy
+    of the image.
+
+    :param data: Base64 encoded str.
+    :param output_path: Path of the decoded file.
+    :return: Number of bytes written.
+    """
+    nb_bytes = 0
+    with open(output_path, "wb") as output_file:
+        for start in range(0, len(data), chunk_size):
+            nb_bytes += output_file.write(base64.b64decode(data[start:start + chunk_size]))
+    return nb_bytes
+
+
+def _convert_image(source_path, output_path, resize_to=None):
+    # The only place image pixels are decoded, when a resize or format change was asked for
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        if resize_to:
+            image = image.resize(resize_to)
+        image.save(output_path)
+    os.remove(source_path)
+
+
+@register_provider("image", "openai")
+class OpenAIImageProvider:
+    """
+    DALL-E image backend.
+
+    The provider's bytes are written straight to output_path. They are only
+    decoded when resize_to is given or output_path is not a PNG.
+
+    :param response_format: 'url' to download the image, or 'b64_json' to receive it inline.
+    """
+
+    def __init__(self, response_format="url"):
+        self.response_format = response_format
+
+    def generate(self, prompt, output_path, size="1024x1792", quality="standard", style="vivid", model="dall-e-3", resize_to=None):
+        return self.generate_batch(prompt, [output_path], size, quality, style, model, resize_to)[0]
+
+    def generate_batch(self, prompt, output_paths, size="1024x1792", quality="standard", style="vivid", model="dall-e-3", resize_to=None):
+        """
+        Generate one candidate image per output path in a single request.
+
+        :param output_paths: Paths of the candidates, at most max_images_per_request(model).
+        :return: The output paths.
+        """
+        import utils.download_from_url as download
+
+        options = {"quality": quality, "style": style} if model == "dall-e-3" else {}
+        response = _get_openai_client().images.generate(
+            model=model,
+            prompt=prompt,
+            size=size,
+            n=len(output_paths),
+            response_format=self.response_format,
+            **options,
+        )
+        # A short batch would leave some output paths unwritten; failing the
+        # whole request lets the caller retry it or fall back
+        if len(response.data) != len(output_paths):
+            raise ProviderError(f"Requested {len(output_paths)} images, received {len(response.data)}")
+
+        for image, output_path in zip(response.data, output_paths):
+            needs_conversion = resize_to is not None or os.path.splitext(str(output_path))[1].lower() != PROVIDER_IMAGE_FORMAT
+            raw_path = f"{output_path}.raw{PROVIDER_IMAGE_FORMAT}" if needs_conversion else output_path
+
+            if self.response_format == "b64_json":
+                write_base64_to_file(image.b64_json, raw_path)
+            elif download.download_to_file(image.url, raw_path) is None:
+                raise ProviderError("Image download failed")
+
+            if needs_conversion:
+                _convert_image(raw_path, output_path, resize_to)
+        return output_paths
+
+@register_provider("video", "replicate")
+class ReplicateVideoProvider:
+    model = "stability-ai/stable-video-diffusion:3f0457e4619daac51203dedb472816fd4af51f3149fa7a9e0b5ffcf1b8172438"
+
+    def generate(self, image_path, output_path, video_length="25_frames_with_svd_xt"):
+        import utils.predictions as predictions
+
+        # The prediction runs on Replicate while this thread only waits for the
+        # manager, which polls every pending prediction of the process at once
+        manager = predictions.get_manager(_secret("REPLICATE_API_TOKEN"))
+        return manager.run(self.model, {"video_length": video_length}, output_path, files={"input_image": image_path})
+
+    async def generate_async(self, image_path, output_path, video_length="25_frames_with_svd_xt"):
+        """Like generate, but wait for the prediction without holding a thread."""
+        import utils.predictions as predictions
+
+        manager = predictions.get_manager(_secret("REPLICATE_API_TOKEN"))
+        return await asyncio.wrap_future(manager.submit(self.model, {"video_length": video_length}, output_path, files={"input_image": image_path}))
+
+
+# Seconds each offline stage takes, roughly in proportion to the real APIs.
+# Scaled by the latency_scale option or XFICTION_OFFLINE_LATENCY_SCALE.
+OFFLINE_LATENCY = {
+    "llm": 20.0,
+    "tts": 5.0,
+    "image": 12.0,
+    "video": 60.0,
+}
+
+
+class OfflineProvider:
+    """
+    Base class for the offline backends.
+
+    :param latency_scale: Multiplier applied to OFFLINE_LATENCY.
+    :param failure_rate: Probability in [0, 1] that a call raises ProviderError.
+    :param seed: Seed of the failure injection, for reproducible runs.
+    """
+    stage = None
+    model = "offline"
+
+    def __init__(self, latency_scale=None, failure_rate=None, seed=None):
+        if latency_scale is None:
+            latency_scale = float(os.environ.get("XFICTION_OFFLINE_LATENCY_SCALE", 0.0))
+        if failure_rate is None:
+            failure_rate = float(os.environ.get("XFICTION_OFFLINE_FAILURE_RATE", 0.0))
+        self.latency = OFFLINE_LATENCY[self.stage] * latency_scale
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def simulate(self):
+        """Wait for the configured latency and randomly fail."""
+        time.sleep(self.latency)
+        self.inject_failure()
+
+    async def simulate_async(self):
+        """Like simulate, without blocking the event loop."""
+        await asyncio.sleep(self.latency)
+        self.inject_failure()
+
+    def inject_failure(self):
+        """Raise ProviderError with probability failure_rate."""
+        with self._random_lock:
+            failed = self._random.random() < self.failure_rate
+        if failed:
+            raise ProviderError(f"Injected {self.stage} failure")
+
+
+def _seed_of(text):
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _run_ffmpeg(arguments):
+    subprocess.run([ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", *arguments], check=True)
+
+
+async def _run_ffmpeg_async(arguments):
+    command = [ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", *arguments]
+    process = await asyncio.create_subprocess_exec(*command)
+    if await process.wait():
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+@register_provider("llm", "offline")
+class OfflineChatProvider(OfflineProvider):
+    stage = "llm"
+    nb_clips = 6
+
+    # Pieces the offline story is streamed in, with the latency spread across them
+    stream_chunk_size = 40
+
+    def complete_json(self, system_prompt, user_prompt, temperature=None):
+        self.simulate()
+        return self._respond(user_prompt)
+
+    def stream_json(self, system_prompt, user_prompt, temperature=None):
+        text = self._respond(user_prompt)
+        nb_chunks = max(1, -(-len(text) // self.stream_chunk_size))
+        for start in range(0, len(text), self.stream_chunk_size):
+            time.sleep(self.latency / nb_chunks)
+            yield text[start:start + self.stream_chunk_size]
+        self.inject_failure()
+
+    def _respond(self, user_prompt):
+        rng = random.Random(_seed_of(user_prompt))
+
+        # The example prompt generator asks for prompts, everything else is a story.
+        # Like the sampled real model, repeated calls give different prompts.
+        if "example prompts" in user_prompt.lower():
+            with self._random_lock:
+                numbers = [self._random.randrange(10 ** 6) for _ in range(3)]
+            return json.dumps({f"Prompt {i + 1}": f"Offline example prompt {number}" for i, number in enumerate(numbers)})
+
+        return json.dumps({
+            "title": f"Offline story {rng.randrange(10 ** 6)}",
+            "voiceover_text": " ".join(f"Sentence {i + 1} about {user_prompt}." for i in range(5)),
+            "video_logline": f"An offline story about {user_prompt}",
+            "character": "An offline character, 30 years old, short hair, grey suit",
+            "visual_style": "b/w, old film still, archive material, photorealistic, story from the past",
+            "clips": {
+                f"clip{i + 1}": {
+                    "character_visible": str(rng.random() < 0.5),
+                    "image_prompt": f"Offline shot {i + 1} of {user_prompt}",
+                }
+                for i in range(self.nb_clips)
+            },
+        })
+
+
+@register_provider("tts", "offline")
+class OfflineSpeechProvider(OfflineProvider):
+    stage = "tts"
+    # Characters per second of a typical voiceover, used to size the sine wave
+    characters_per_second = 15
+
+    def synthesize(self, text, output_path, model="tts-1-hd", voice="onyx"):
+        self.simulate()
+        duration = max(1.0, len(text) / self.characters_per_second)
+        frequency = 220 + _seed_of(text) % 440
+        _run_ffmpeg([
+            "-f", "lavfi", "-i", f"sine=frequency={frequency}:duration={duration:.2f}",
+            "-c:a", "libmp3lame", "-q:a", "6", str(output_path),
+        ])
+        return output_path
+
+
+@register_provider("image", "offline")
+class OfflineImageProvider(OfflineProvider):
+    stage = "image"
+
+    def generate(self, prompt, output_path, size="1024x1792", quality="standard", style="vivid", model="dall-e-3", resize_to=None):
+        return self.generate_batch(prompt, [output_path], size, quality, style, model, resize_to)[0]
+
+    def generate_batch(self, prompt, output_paths, size="1024x1792", quality="standard", style="vivid", model="dall-e-3", resize_to=None):
+        from PIL import Image
+
+        self.simulate()
+        width, height = resize_to or (int(value) for value in size.split("x"))
+        for candidate, output_path in enumerate(output_paths):
+            seed = _seed_of(f"{prompt}#{candidate}" if candidate else prompt)
+            color = (seed & 0xFF, (seed >> 8) & 0xFF, (seed >> 16) & 0xFF)
+            Image.new("RGB", (width, height), color).save(output_path)
+        return output_paths
+
+@register_provider("video", "offline")
+class OfflineVideoProvider(OfflineProvider):
+    stage = "video"
+    fps = 7
+    # Longest side of the generated clip, like the SVD output
+    max_side = 1024
+
+    def generate(self, image_path, output_path, video_length="25_frames_with_svd_xt"):
+        self.simulate()
+        _run_ffmpeg(self._ffmpeg_arguments(image_path, output_path, video_length))
+        return output_path
+
+    async def generate_async(self, image_path, output_path, video_length="25_frames_with_svd_xt"):
+        """Like generate, without holding a thread, like the Replicate backend."""
+        await self.simulate_async()
+        await _run_ffmpeg_async(self._ffmpeg_arguments(image_path, output_path, video_length))
+        return output_path
+
+    def _ffmpeg_arguments(self, image_path, output_path, video_length):
+        nb_frames = int(video_length.split("_")[0])
+        return [
+            "-loop", "1", "-framerate", str(self.fps), "-i", image_path,
+            "-frames:v", str(nb_frames),
+            "-vf", f"scale='min({self.max_side},iw)':'min({self.max_side},ih)':force_original_aspect_ratio=decrease:force_divisible_by=2",
+            "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", str(output_path),
+        ]
@@ -0,0 +1,335 @@
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import utils.jobs as jobs
+import utils.tracing as tracing
+
+
+# Request budgets per provider model. The state of each model's limiter (token
+# bucket, concurrency window and requests in flight) is kept in a SQLite
+# database next to the job queue, so the app and every worker process draw on
+# one budget instead of each assuming they own it. The defaults fit a low
+# OpenAI/Replicate usage tier; override them with XFICTION_RATE_LIMITS, e.g.
+# '{"openai/dall-e-3": {"requests_per_minute": 50}}'.
+RATE_LIMITS = {
+    "openai/gpt-4-1106-preview": {"requests_per_minute": 500, "max_concurrency": 16},
+    "openai/tts-1-hd": {"requests_per_minute": 50, "max_concurrency": 4},
+    "openai/dall-e-3": {"requests_per_minute": 15, "max_concurrency": 6},
+    "replicate/stability-ai/stable-video-diffusion:3f0457e4619daac51203dedb472816fd4af51f3149fa7a9e0b5ffcf1b8172438": {"requests_per_minute": 60, "max_concurrency": 12},
+}
+# Models without an entry, e.g. those of the offline providers, only get a concurrency cap
+DEFAULT_RATE_LIMIT = {"requests_per_minute": None, "max_concurrency": 64}
+LIMITS_DB_PATH = os.path.join(jobs.JOBS_DIRECTORY, "rate_limits.sqlite3")
+
+# The concurrency limit is multiplied by this factor on every throttled call
+# or latency spike, and grows by one per limit's worth of successful calls
+DECREASE_FACTOR = 0.5
+# A call slower than this multiple of the typical latency counts as congestion
+LATENCY_TOLERANCE = 3.0
+# Weight of a new sample in the typical latency average
+LATENCY_SMOOTHING = 0.2
+# Throttled calls are retried with exponential backoff this many times
+MAX_THROTTLE_RETRIES = 4
+BACKOFF_BASE = 2.0
+# Seconds between two checks while every slot is taken, possibly by another process
+POLL_INTERVAL = 0.1
+# Slots of processes that exited are freed right away; this bounds how long a
+# slot of a process that is hung or not yet reaped can be held
+SLOT_TIMEOUT = 60 * 60
+
+
+def _configured_limits():
+    limits = {model: dict(options) for model, options in RATE_LIMITS.items()}
+    for name, options in json.loads(os.environ.get("XFICTION_RATE_LIMITS") or "{}").items():
+        limits.setdefault(name, dict(DEFAULT_RATE_LIMIT)).update(options)
+    return limits
+
+
+def is_throttled(error):
+    """True if a provider exception is a rate limit (HTTP 429) response."""
+    for source in (error, getattr(error, "response", None)):
+        if getattr(source, "status_code", None) == 429 or getattr(source, "status", None) == 429:
+            return True
+    message = str(error).lower()
+    return "rate limit" in message or "too many requests" in message
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS limiters (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            refilled_at REAL NOT NULL,
+            concurrency REAL NOT NULL,
+            paused_until REAL NOT NULL,
+            typical_latency REAL
+        )
+        """
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS slots (slot_id TEXT PRIMARY KEY, name TEXT NOT NULL, pid INTEGER NOT NULL, started_at REAL NOT NULL)")
+    return conn
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket plus AIMD concurrency window for one provider model.
+
+    The token bucket keeps the request rate under requests_per_minute. The
+    concurrency window starts at max_concurrency, is cut by DECREASE_FACTOR
+    when the provider throttles or slows down, and grows back by one request
+    per window of successful calls. Both live in db_path, shared by every
+    limiter of the same name in any process.
+
+    :param name: Name used in traces, e.g. 'openai/dall-e-3'.
+    :param requests_per_minute: Request budget, or None for no rate limit.
+    :param max_concurrency: Upper bound of the concurrency window.
+    :param min_concurrency: Lower bound of the concurrency window.
+    :param db_path: SQLite database holding the shared state.
+    """
+
+    def __init__(self, name, requests_per_minute=None, max_concurrency=8, min_concurrency=1, db_path=LIMITS_DB_PATH):
+        self.name = name
+        self.rate = requests_per_minute / 60 if requests_per_minute else None
+        # Allow a burst of up to max_concurrency requests after an idle period
+        self.burst = max_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.db_path = db_path
+        # Concurrency limit as of the last slot taken or released by this limiter
+        self.limit = max_concurrency
+
+    @contextlib.contextmanager
+    def _state(self):
+        # Read, modify and write the shared state in one write transaction
+        conn = _connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT * FROM limiters WHERE name = ?", (self.name,)).fetchone()
+            if row is None:
+                state = {"tokens": float(self.burst), "refilled_at": now, "concurrency": float(self.max_concurrency), "paused_until": 0.0, "typical_latency": None}
+            else:
+                state = dict(row)
+            # The configured limits may have changed since the state was written
+            state["concurrency"] = min(self.max_concurrency, max(self.min_concurrency, state["concurrency"]))
+            if self.rate:
+                state["tokens"] = min(self.burst, state["tokens"] + (now - state["refilled_at"]) * self.rate)
+            state["refilled_at"] = now
+            yield conn, state, now
+            conn.execute(
+                "INSERT OR REPLACE INTO limiters (name, tokens, refilled_at, concurrency, paused_until, typical_latency) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.name, state["tokens"], state["refilled_at"], state["concurrency"], state["paused_until"], state["typical_latency"]),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _in_flight(self, conn, now):
+        # Slots of processes that died without releasing them are dropped
+        rows = conn.execute("SELECT slot_id, pid, started_at FROM slots WHERE name = ?", (self.name,)).fetchall()
+        expired = [row["slot_id"] for row in rows if now - row["started_at"] > SLOT_TIMEOUT or not _process_alive(row["pid"])]
+        conn.executemany("DELETE FROM slots WHERE slot_id = ?", [(slot_id,) for slot_id in expired])
+        return len(rows) - len(expired)
+
+    def try_acquire(self):
+        """
+        Take a request slot if one may start now.
+
+        :return: Tuple of (slot_id, None) on success, or (None, seconds to wait)
+            otherwise, the seconds being None while every slot is taken.
+        """
+        with self._state() as (conn, state, now):
+            self.limit = int(state["concurrency"])
+            if now < state["paused_until"]:
+                return None, state["paused_until"] - now
+            if self._in_flight(conn, now) >= int(state["concurrency"]):
+                return None, None
+            if self.rate and state["tokens"] < 1:
+                return None, (1 - state["tokens"]) / self.rate
+            if self.rate:
+                state["tokens"] -= 1
+            slot_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots (slot_id, name, pid, started_at) VALUES (?, ?, ?, ?)", (slot_id, self.name, os.getpid(), now))
+            return slot_id, None
+
+    def acquire(self):
+        """
+        Block until a request may start.
+
+        :return: Tuple of (slot_id, seconds spent waiting). Pass slot_id to release.
+        """
+        start = time.monotonic()
+        while True:
+            slot_id, timeout = self.try_acquire()
+            if slot_id:
+                return slot_id, time.monotonic() - start
+            time.sleep(POLL_INTERVAL if timeout is None else timeout)
+
+    def release(self, slot_id, latency=None, throttled=False):
+        """
+        Report the end of a request.
+
+        :param slot_id: Slot returned by acquire.
+        :param latency: Duration of a successful request, None if it failed.
+        :param throttled: True if the provider rejected it with a rate limit.
+        """
+        with self._state() as (conn, state, now):
+            conn.execute("DELETE FROM slots WHERE slot_id = ?", (slot_id,))
+            typical_latency = state["typical_latency"]
+            if throttled:
+                self._decrease(state)
+            elif latency is not None:
+                congested = typical_latency is not None and latency > LATENCY_TOLERANCE * typical_latency
+                if congested:
+                    self._decrease(state)
+                else:
+                    state["concurrency"] = min(self.max_concurrency, state["concurrency"] + 1 / state["concurrency"])
+                # Slow outliers would otherwise raise the bar for detecting the next one
+                sample = min(latency, LATENCY_TOLERANCE * typical_latency) if typical_latency else latency
+                state["typical_latency"] = sample if typical_latency is None else (
+                    (1 - LATENCY_SMOOTHING) * typical_latency + LATENCY_SMOOTHING * sample
+                )
+            self.limit = int(state["concurrency"])
+
+    def _decrease(self, state):
+        state["concurrency"] = max(self.min_concurrency, state["concurrency"] * DECREASE_FACTOR)
+
+    def pause(self, seconds):
+        """Hold back every new request for a while, e.g. after a 429."""
+        with self._state() as (conn, state, now):
+            state["paused_until"] = max(state["paused_until"], now + seconds)
+            # Drop the burst so requests resume at the sustained rate
+            state["tokens"] = min(state["tokens"], 0.0)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one request slot for the enclosed block."""
+        slot_id, waited = self.acquire()
+        try:
+            with self._measured(waited) as outcome:
+                yield
+        finally:
+            self.release(slot_id, **outcome)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """Like slot, but wait for the slot without blocking the event loop."""
+        # The shared state is read and written in SQLite transactions, which
+        # may wait on other processes, so they run in a thread
+        start = time.monotonic()
+        slot_id, timeout = await asyncio.to_thread(self.try_acquire)
+        while not slot_id:
+            await asyncio.sleep(POLL_INTERVAL if timeout is None else timeout)
+            slot_id, timeout = await asyncio.to_thread(self.try_acquire)
+        outcome = {}
+        try:
+            with self._measured(time.monotonic() - start) as outcome:
+                yield
+        finally:
+            await asyncio.to_thread(self.release, slot_id, **outcome)
+
+    @contextlib.contextmanager
+    def _measured(self, waited):
+        # Yields the keyword arguments of release, filled in once the block exits
+        tracing.set_attributes(rate_limit_wait=waited, concurrency_limit=self.limit)
+        outcome = {"latency": None, "throttled": False}
+        start = time.monotonic()
+        try:
+            yield outcome
+            outcome["latency"] = time.monotonic() - start
+        except Exception as e:
+            outcome["throttled"] = is_throttled(e)
+            raise
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func inside a slot, retrying it with backoff while the provider throttles.
+
+        :return: Whatever func returns.
+        """
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                self._back_off(e, attempt)
+
+    async def async_call(self, func, *args, **kwargs):
+        """Like call, for a coroutine function func."""
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            try:
+                async with self.async_slot():
+                    return await func(*args, **kwargs)
+            except Exception as e:
+                self._back_off(e, attempt)
+
+    def _back_off(self, error, attempt):
+        # Called while handling the error: re-raises it unless it is a throttle worth retrying
+        if not is_throttled(error) or attempt == MAX_THROTTLE_RETRIES:
+            raise
+        delay = BACKOFF_BASE * 2 ** attempt
+        print(f"{self.name} is rate limited, retrying in {delay:.1f}s")
+        self.pause(delay)
+
+    def stats(self):
+        """Return the current state of the limiter, for monitoring. Only reads the shared state."""
+        conn = _connect(self.db_path)
+        try:
+            row = conn.execute("SELECT concurrency, typical_latency FROM limiters WHERE name = ?", (self.name,)).fetchone()
+            slots = conn.execute("SELECT pid, started_at FROM slots WHERE name = ?", (self.name,)).fetchall()
+        finally:
+            conn.close()
+        now = time.time()
+        concurrency = self.max_concurrency if row is None else row["concurrency"]
+        return {
+            "limit": int(min(self.max_concurrency, max(self.min_concurrency, concurrency))),
+            "in_flight": sum(1 for slot in slots if now - slot["started_at"] <= SLOT_TIMEOUT and _process_alive(slot["pid"])),
+            "typical_latency": None if row is None else row["typical_latency"],
+        }
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(provider_name, model):
+    """
+    Return the limiter of a provider model, created on first use.
+
+    Limiters of the same model share their state across processes, see LIMITS_DB_PATH.
+
+    :param provider_name: Registered provider name, e.g. 'openai'.
+    :param model: Model name, e.g. 'dall-e-3'.
+    """
+    with _lock:
+        key = (provider_name, model)
+        if key not in _limiters:
+            name = f"{provider_name}/{model}"
+            _limiters[key] = AdaptiveLimiter(name, **_configured_limits().get(name, DEFAULT_RATE_LIMIT))
+        return _limiters[key]
+
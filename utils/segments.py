@@ -0,0 +1,153 @@
+import collections
+import os
+import subprocess
+import time
+
+import utils.asset_cache as asset_cache
+import utils.encode_profiles as encode_profiles
+import utils.ffmpeg_tools as ffmpeg_tools
+import utils.timing as timing
+import utils.tracing as tracing
+
+
+# Segment-level assembly for clips that cannot simply be stream copied. Each
+# clip is normalized once to a common size, frame rate and encoding and the
+# segment is cached under the hash of the clip's content, so regenerating one
+# clip only re-encodes that clip before the segments are joined again. The
+# voiceover is encoded to AAC once as well and then copied into every render.
+# Retiming planned by utils/timing.py is applied within the same encode.
+SEGMENT_DIRECTORY = "media/segments"
+
+
+def target_frame(video_paths, max_height=None):
+    """
+    Pick the size and frame rate all segments of a video are normalized to.
+
+    The most common format among the clips is used, so swapping one clip
+    does not change the frame of the others.
+
+    :param video_paths: Paths of the clips.
+    :param max_height: Optional height cap.
+    :return: Tuple of (width, height, fps), with even width and height.
+    """
+    formats = collections.Counter()
+    for path in video_paths:
+        infos = ffmpeg_tools.probe_media(path)
+        formats[(infos["width"], infos["height"], infos["fps"] or 25)] += 1
+    # most_common keeps the first seen format on ties
+    width, height, fps = formats.most_common(1)[0][0]
+
+    if max_height and height > max_height:
+        width, height = width * max_height / height, max_height
+    return int(width) // 2 * 2, int(height) // 2 * 2, fps
+
+
+def encode_segment(video_path, frame, profile, threads=None, rate=1.0, pad=0.0):
+    """
+    Normalize a clip to a silent segment, reusing the cached one if it exists.
+
+    :param video_path: Path of the clip.
+    :param frame: Tuple of (width, height, fps) from target_frame.
+    :param profile: Dict from encode_profiles.get_profile.
+    :param threads: Encoder threads, defaults to the profile's.
+    :param rate: Playback speed of the clip, from timing.plan_timing.
+    :param pad: Seconds to hold the last frame for, from timing.plan_timing.
+    :return: Tuple of (segment path, True if it was taken from the cache).
+    """
+    width, height, fps = frame
+    retiming = {"rate": round(rate, 4), "pad": round(pad, 3)} if rate != 1.0 or pad else {}
+    key = asset_cache.cache_key(
+        "segment",
+        clip=asset_cache.file_digest(video_path),
+        frame=[width, height, fps],
+        preset=profile["preset"],
+        crf=profile["crf"],
+        pix_fmt=profile["pix_fmt"],
+        **retiming,
+    )
+    cached_path = asset_cache.default_cache.lookup(key)
+    if cached_path:
+        return cached_path, True
+
+    filters = [f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2"]
+    if retiming:
+        filters.insert(0, f"setpts=(PTS-STARTPTS)/{rate:.6f}")
+    filters.append(f"fps={fps}")
+    if pad:
+        filters.append(f"tpad=stop_mode=clone:stop_duration={pad:.3f}")
+
+    os.makedirs(SEGMENT_DIRECTORY, exist_ok=True)
+    segment_path = os.path.join(SEGMENT_DIRECTORY, f"segment_{key}.mp4")
+    with tracing.span("assembly.segment", profile=profile["name"]) as segment_span:
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                "-i", video_path, "-an",
+                "-vf", ",".join(filters),
+                "-c:v", "libx264", "-preset", profile["preset"], "-crf", str(profile["crf"]),
+                "-pix_fmt", profile["pix_fmt"], "-threads", str(threads or profile["threads"]),
+                segment_path,
+            ],
+            check=True,
+            capture_output=True,
+        )
+        # Frames are counted from the segment's container, after retiming and padding
+        frames = (ffmpeg_tools.probe_media(segment_path)["duration"] or 0) * fps
+        segment_span.set(encode_fps=frames / (time.perf_counter() - start))
+    return asset_cache.default_cache.store(key, segment_path), False
+
+
+def encode_audio(audio_path, bitrate):
+    """
+    Encode a voiceover to an AAC track, reusing the cached one if it exists.
+
+    :return: Path to the .m4a file.
+    """
+    key = asset_cache.cache_key("audio_track", audio=asset_cache.file_digest(audio_path), bitrate=bitrate)
+    cached_path = asset_cache.default_cache.lookup(key)
+    if cached_path:
+        return cached_path
+
+    os.makedirs(SEGMENT_DIRECTORY, exist_ok=True)
+    track_path = os.path.join(SEGMENT_DIRECTORY, f"audio_{key}.m4a")
+    subprocess.run(
+        [
+            ffmpeg_tools.ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+            "-i", audio_path, "-vn", "-c:a", "aac", "-b:a", bitrate,
+            track_path,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return asset_cache.default_cache.store(key, track_path)
+
+
+def assemble_segments(video_paths, audio_path, output_path, profile=None, plan=None):
+    """
+    Join clips of mixed formats through cached normalized segments.
+
+    :param video_paths: A list of paths to the video files.
+    :param audio_path: Path to the audio file.
+    :param output_path: Path where the output video will be saved.
+    :param profile: Encode profile name or dict, defaults to XFICTION_ENCODE_PROFILE.
+    :param plan: Timing plan from timing.plan_timing, computed if not given.
+    :return: Path to the output video.
+    """
+    plan = plan or timing.plan_timing(video_paths, audio_path)
+    if not isinstance(profile, dict):
+        profile = encode_profiles.get_profile(profile)
+
+    with tracing.span("assembly.segments", clips=len(video_paths), profile=profile["name"]) as assembly_span:
+        start = time.perf_counter()
+        frame = target_frame(video_paths, profile["max_height"])
+        segments = [encode_segment(clip["path"], frame, profile, rate=clip["rate"], pad=clip["pad"]) for clip in plan["clips"]]
+        assembly_span.set(reused_segments=sum(1 for _, cached in segments if cached), rate=plan["rate"], duration=plan["duration"])
+        audio_track = encode_audio(audio_path, profile["audio_bitrate"])
+        ffmpeg_tools.concat_stream_copy([path for path, _ in segments], audio_track, output_path, copy_audio=True)
+        # Frames of the whole video over the whole assembly, so reused segments count as fast
+        encode_fps = plan["duration"] * frame[2] / (time.perf_counter() - start)
+        assembly_span.set(encode_fps=encode_fps)
+        print(f"Encoded {output_path} with the {profile['name']} profile at {encode_fps:.1f} fps")
+
+    return output_path
@@ -0,0 +1,121 @@
+import json
+
+
+class StoryStreamParser:
+    """
+    Incremental parser for the story JSON returned by the LLM.
+
+    Feed it the response text as it streams in. It reports every top-level
+    field as soon as its value is complete, and every clip of the 'clips'
+    object as soon as that clip's object is closed, so work on them can start
+    before the rest of the story has been generated.
+
+    feed returns a list of events:
+        ("field", key, value) for top-level fields such as 'voiceover_text'
+        ("clip", key, value) for each entry of 'clips', in order
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._pos = 0
+        # One frame per open object/array: [kind, path, key, expecting_key, value_start]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._primitive_start = None
+        self._events = []
+
+    def feed(self, chunk):
+        """
+        Parse the next piece of the response.
+
+        :param chunk: Text received from the stream.
+        :return: List of events completed by this chunk.
+        """
+        self.text += chunk
+        self._events = []
+        text = self.text
+
+        for i in range(self._pos, len(text)):
+            c = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._end_string(text[self._string_start:i + 1])
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._open(c, i)
+            elif c in "}]":
+                self._end_primitive(i)
+                frame = self._stack.pop()
+                if self._stack:
+                    self._complete_value(text[frame[4]:i + 1])
+            elif c == ":":
+                self._stack[-1][3] = False
+            elif c == ",":
+                self._end_primitive(i)
+                if self._stack[-1][0] == "{":
+                    self._stack[-1][3] = True
+            elif c.isspace():
+                self._end_primitive(i)
+            elif self._primitive_start is None and self._stack:
+                self._primitive_start = i
+
+        self._pos = len(text)
+        return self._events
+
+    @property
+    def done(self):
+        """True once the root object has been closed."""
+        return self._pos > 0 and not self._stack and self.text.strip().endswith("}")
+
+    def result(self):
+        """Return the complete story as a dict."""
+        return json.loads(self.text)
+
+    def _open(self, kind, position):
+        path = ()
+        if self._stack:
+            parent = self._stack[-1]
+            path = parent[1] + (parent[2] if parent[0] == "{" else None,)
+        # The value start is kept on the new frame so closing it yields the raw value
+        self._stack.append([kind, path, None, kind == "{", position])
+
+    def _end_string(self, raw):
+        frame = self._stack[-1] if self._stack else None
+        if frame is None:
+            return
+        if frame[0] == "{" and frame[3]:
+            frame[2] = json.loads(raw)
+        else:
+            self._complete_value(raw)
+
+    def _end_primitive(self, position):
+        if self._primitive_start is not None:
+            self._complete_value(self.text[self._primitive_start:position].strip())
+            self._primitive_start = None
+
+    def _complete_value(self, raw):
+        frame = self._stack[-1]
+        if frame[0] != "{":
+            return
+
+        # Only the root object (path ()) and the clips object are reported
+        path, key = frame[1], frame[2]
+        if path == ():
+            value = json.loads(raw)
+            self.fields[key] = value
+            self._events.append(("field", key, value))
+        elif path == ("clips",):
+            self._events.append(("clip", key, json.loads(raw)))
@@ -0,0 +1,59 @@
+import utils.ffmpeg_tools as ffmpeg_tools
+
+
+# Plans how the clips of a story are stretched to the length of the voiceover.
+# Durations come from the container headers (see ffmpeg_tools.probe_media),
+# so planning never decodes a frame; the plan is then applied while each clip
+# is encoded once (see utils/segments.py).
+
+# Largest playback speed change applied to a clip, as a fraction. Beyond it
+# the remaining gap is filled by holding the last frame of each clip.
+MAX_RATE_CHANGE = 0.15
+# Seconds of mismatch that are left alone
+TOLERANCE = 0.1
+
+
+def plan_timing(video_paths, audio_path, max_rate_change=MAX_RATE_CHANGE):
+    """
+    Compute how each clip is retimed so the video matches the voiceover.
+
+    A video shorter than the voiceover is slowed down by up to max_rate_change
+    and the rest of the gap is spread over the clips as freeze-frame padding.
+    A longer video is sped up by up to max_rate_change and keeps its end.
+
+    Clips are not fitted one by one: all of them play at the same rate and
+    get padding in proportion to their length, so they keep their relative
+    lengths and the cuts stay evenly paced.
+
+    :param video_paths: Paths of the clips, in order.
+    :param audio_path: Path of the voiceover.
+    :return: Dict with 'clips', a list of {'path', 'rate', 'pad', 'duration'} where rate
+        is the playback speed and pad the seconds the last frame is held, 'duration',
+        the planned video length, 'audio_duration', 'rate', the speed shared by all
+        clips, 'padded', True if any frame is held, and 'aligned', True if no clip
+        needs retiming.
+    """
+    durations = [ffmpeg_tools.probe_media(path)["duration"] or 0 for path in video_paths]
+    video_duration = sum(durations)
+    audio_duration = ffmpeg_tools.probe_media(audio_path)["duration"] or 0
+
+    rate, pad_total = 1.0, 0.0
+    aligned = not audio_duration or not video_duration or abs(audio_duration - video_duration) <= TOLERANCE
+    if not aligned:
+        # Playing at speed 'rate' turns d seconds into d / rate seconds
+        rate = min(1 + max_rate_change, max(1 - max_rate_change, video_duration / audio_duration))
+        pad_total = max(0.0, audio_duration - video_duration / rate)
+
+    clips = []
+    for path, duration in zip(video_paths, durations):
+        pad = pad_total * duration / video_duration if video_duration else 0.0
+        clips.append({"path": path, "rate": rate, "pad": pad, "duration": duration / rate + pad})
+
+    return {
+        "clips": clips,
+        "duration": sum(clip["duration"] for clip in clips),
+        "audio_duration": audio_duration,
+        "rate": rate,
+        "padded": pad_total > 0,
+        "aligned": aligned,
+    }
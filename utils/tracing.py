@@ -0,0 +1,322 @@
+import argparse
+import contextlib
+import contextvars
+import functools
+import http.server
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Spans of every process (app, workers) are appended to one JSONL file, so
+# the metrics endpoint can report latencies for the whole deployment.
+# Set XFICTION_TRACE_FILE to an empty string to disable tracing.
+TRACE_FILE = os.environ.get("XFICTION_TRACE_FILE", "media/reports/traces.jsonl")
+# Once the file grows past this size it is renamed to traces.jsonl.1, the
+# older files shifting up to TRACE_BACKUPS, so traces never take more than
+# about (TRACE_BACKUPS + 1) * TRACE_MAX_BYTES of disk
+TRACE_MAX_BYTES = int(os.environ.get("XFICTION_TRACE_MAX_BYTES", 64 * 1024 * 1024))
+TRACE_BACKUPS = 2
+
+# Only the tail of the trace file is read when computing percentiles
+SUMMARY_WINDOW_BYTES = 8 * 1024 * 1024
+PERCENTILES = (0.5, 0.95)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+
+
+class Span:
+    """A timed operation with free-form attributes such as bytes or fps."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        """Add attributes to the span."""
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "pid": os.getpid(),
+            **self.attributes,
+        }
+
+
+def _export(record):
+    if not TRACE_FILE:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+        # A single append of one line is atomic enough to share the file between processes
+        with open(TRACE_FILE, "a") as f:
+            f.write(line)
+            size = f.tell()
+        if size > TRACE_MAX_BYTES:
+            _rotate()
+
+
+def _rotate():
+    # Every process appends to the file, so the rotation is done under a file
+    # lock by whichever process gets it first; the others find it small again
+    with open(f"{TRACE_FILE}.lock", "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(TRACE_FILE) <= TRACE_MAX_BYTES:
+                return
+        except FileNotFoundError:
+            return
+        for index in range(TRACE_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{TRACE_FILE}.{index}"):
+                os.replace(f"{TRACE_FILE}.{index}", f"{TRACE_FILE}.{index + 1}")
+        os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Time the enclosed block as a span.
+
+    Spans opened inside another span, including in asyncio tasks and
+    asyncio.to_thread calls started from it, are recorded as its children.
+
+    :param name: Span name, e.g. 'provider.image'.
+    :param attributes: Initial attributes of the span.
+    :return: The Span, to add attributes while it runs.
+    """
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        _export(current.to_dict())
+
+
+def traced(name):
+    """Decorator recording every call of the function as a span, also for coroutine functions."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    """Return the innermost running span, or None."""
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def attach(parent):
+    """
+    Make a span the parent of the spans opened in the enclosed block.
+
+    For work handed to another thread's event loop, which does not run in the
+    context of the code that scheduled it.
+
+    :param parent: Span from current_span, or None.
+    """
+    token = _current_span.set(parent)
+    try:
+        yield parent
+    finally:
+        _current_span.reset(token)
+
+
+def set_attributes(**attributes):
+    """Add attributes to the innermost running span, if any."""
+    current = _current_span.get()
+    if current:
+        current.set(**attributes)
+
+
+def record(name, duration, **attributes):
+    """Record a span that was measured elsewhere, e.g. the time a job waited in the queue."""
+    current = Span(name, attributes)
+    current.start = time.time() - duration
+    current.duration = duration
+    _export(current.to_dict())
+
+
+def _tail_lines(path, window_bytes):
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            offset = max(0, f.tell() - window_bytes)
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+
+    lines = data.splitlines()
+    if offset:
+        # The first line was cut by the seek
+        lines = lines[1:]
+    return lines, len(data)
+
+
+def load_spans(path=None, window_bytes=SUMMARY_WINDOW_BYTES):
+    """Read the most recent spans from the trace file, and from the last rotated one after a rotation."""
+    path = path or TRACE_FILE
+    lines, nb_bytes = _tail_lines(path, window_bytes)
+    if nb_bytes < window_bytes:
+        older_lines, _ = _tail_lines(f"{path}.1", window_bytes - nb_bytes)
+        lines = older_lines + lines
+
+    spans = []
+    for line in lines:
+        try:
+            spans.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return spans
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(spans):
+    """
+    Aggregate spans per name.
+
+    :return: Dict mapping span name to count, errors, sum, p50, p95 and summed bytes.
+    """
+    durations = {}
+    errors = {}
+    transferred = {}
+    for entry in spans:
+        name = entry["name"]
+        durations.setdefault(name, []).append(entry["duration"])
+        errors[name] = errors.get(name, 0) + (1 if entry.get("error") else 0)
+        transferred[name] = transferred.get(name, 0) + entry.get("bytes", 0)
+
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "sum": sum(values),
+            "bytes": transferred[name],
+            **{f"p{int(fraction * 100)}": _percentile(values, fraction) for fraction in PERCENTILES},
+        }
+    return summary
+
+
+def prometheus_text(summary):
+    """Render a summary in the Prometheus text exposition format."""
+    lines = [
+        "# HELP xfiction_span_duration_seconds Duration of pipeline stages.",
+        "# TYPE xfiction_span_duration_seconds summary",
+    ]
+    for name, stats in sorted(summary.items()):
+        for fraction in PERCENTILES:
+            lines.append(f'xfiction_span_duration_seconds{{span="{name}",quantile="{fraction}"}} {stats[f"p{int(fraction * 100)}"]:.6f}')
+        lines.append(f'xfiction_span_duration_seconds_sum{{span="{name}"}} {stats["sum"]:.6f}')
+        lines.append(f'xfiction_span_duration_seconds_count{{span="{name}"}} {stats["count"]}')
+
+    lines.append("# HELP xfiction_span_errors_total Failed pipeline stages.")
+    lines.append("# TYPE xfiction_span_errors_total counter")
+    for name, stats in sorted(summary.items()):
+        lines.append(f'xfiction_span_errors_total{{span="{name}"}} {stats["errors"]}')
+
+    lines.append("# HELP xfiction_span_bytes_total Bytes transferred by pipeline stages.")
+    lines.append("# TYPE xfiction_span_bytes_total counter")
+    for name, stats in sorted(summary.items()):
+        if stats["bytes"]:
+            lines.append(f'xfiction_span_bytes_total{{span="{name}"}} {stats["bytes"]}')
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text(summarize(load_spans())).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=9464):
+    """
+    Serve /metrics for Prometheus from a background thread.
+
+    :param port: Port to listen on.
+    :return: The running server.
+    """
+    server = http.server.ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage latency of the X-Fiction pipeline")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve Prometheus metrics on PORT")
+    args = parser.parse_args()
+
+    if args.serve:
+        server = start_metrics_server(args.serve)
+        print(f"Serving metrics on http://localhost:{args.serve}/metrics")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    for name, stats in sorted(summarize(load_spans()).items()):
+        print(f"{name:30} n={stats['count']:<6} p50={stats['p50']:.3f}s p95={stats['p95']:.3f}s errors={stats['errors']}")
+
+
+if __name__ == "__main__":
+    main()